@@ -0,0 +1,103 @@
+import argparse
+import io
+import pathlib
+import random
+import tempfile
+import threading
+import time
+from typing import *
+
+from src.bench.common import connected_pair
+from src.peer.rfc import RFC, RFCIndex
+from src.peer.search import SearchIndex, search_path
+from src.peer.server import RESPONSE_CACHE, server_receiver
+from src.utils.http import (
+    SUCCESS_CODE,
+    make_request,
+    parse_response,
+    recv_file_response,
+)
+from src.utils.metrics import ServerMetrics
+from src.utils.utils import recv_message, send_message
+
+BUDGETS = {"off": 0, "on": RESPONSE_CACHE.budget}
+
+
+def zipf(count: int, s: float) -> list[float]:
+    """Weights of ranks 1 to count under a Zipf distribution with exponent s; 0 is
+    uniform."""
+    return [1 / rank**s for rank in range(1, count + 1)]
+
+
+def make_index(directory: pathlib.Path, count: int, size: int) -> RFCIndex:
+    rfcs = []
+    for n in range(1, count + 1):
+        path = directory.joinpath(f"rfc{n}.txt")
+        path.write_bytes(f"RFC {n}\n".encode() * (size // 8))
+        rfcs.append(RFC(n, f"rfc{n}", "localhost", str(path)))
+    return RFCIndex(rfcs)
+
+
+def run(rfc_index: RFCIndex, budget: int, count: int, s: float, seed: int) -> float:
+    """Fetches count RFCs, one at a time, numbers drawn with Zipf exponent s, from a
+    peer server receiver; returns fetches per second."""
+    RESPONSE_CACHE.clear()
+    RESPONSE_CACHE.resize(budget)
+
+    rng = random.Random(seed)
+    numbers = sorted(rfc_index.local)
+    draws = rng.choices(numbers, zipf(len(numbers), s), k=count)
+
+    client, server = connected_pair(nodelay=True)
+    # Never searched, so never built.
+    search_index = SearchIndex(search_path("localhost", 0))
+    receiver = threading.Thread(
+        target=server_receiver,
+        args=(rfc_index, search_index, server, ServerMetrics()),
+        daemon=True,
+    )
+    receiver.start()
+
+    start = time.perf_counter()
+
+    for number in draws:
+        send_message(
+            make_request("getrfc", "localhost", {"RFC-Number": number}), client
+        )
+        assert parse_response(recv_message(client)).status == SUCCESS_CODE
+        recv_file_response(client, io.BytesIO())
+
+    elapsed = time.perf_counter() - start
+
+    client.close()
+    receiver.join()
+
+    return count / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="GetRFC with and without the cache")
+    parser.add_argument("--count", type=int, default=20000, help="fetches per case")
+    parser.add_argument("--rfcs", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=16 << 10, help="bytes per RFC")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'cache':>8}{'fetch/s':>12}{'hit ratio':>12}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        rfc_index = make_index(pathlib.Path(directory), args.rfcs, args.size)
+
+        for name, budget in BUDGETS.items():
+            rate = run(rfc_index, budget, args.count, args.skew, args.seed)
+            lookups = RESPONSE_CACHE.hits + RESPONSE_CACHE.misses
+            ratio = RESPONSE_CACHE.hits / lookups if lookups else 0.0
+
+            print(f"{name:>8}{rate:>12.0f}{ratio:>12.2f}", flush=True)
+
+    RESPONSE_CACHE.resize(BUDGETS["on"])
+
+
+if __name__ == "__main__":
+    main()
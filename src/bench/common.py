@@ -0,0 +1,95 @@
+import contextlib
+import socket
+import threading
+import time
+from typing import *
+
+# Fixtures shared by the benchmarks: connected socket pairs, and proxies to run local
+# peers behind, over throttled links.
+
+
+def connected_pair(nodelay: bool = False) -> tuple[socket.socket, socket.socket]:
+    """A client socket, and the server socket it's connected to. With nodelay, the
+    server side sends without Nagle's algorithm, as the servers' own sockets do."""
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    if nodelay:
+        server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client, server
+
+
+class Link:
+    """A shared, rate-limited link: each chunk reserves its transmission time."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.free_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def transmit(self, size: int) -> None:
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            start = max(time.monotonic(), self.free_at)
+            self.free_at = start + size / self.rate
+
+        time.sleep(max(0.0, self.free_at - time.monotonic()))
+
+
+class StalledLink(Link):
+    """A link that stops carrying anything, without closing, after limit bytes."""
+
+    def __init__(self, rate: float, limit: int) -> None:
+        super().__init__(rate)
+        self.limit = limit
+        self.sent = 0
+
+    def transmit(self, size: int) -> None:
+        with self.lock:
+            self.sent += size
+            stalled = self.sent > self.limit
+
+        if stalled:
+            threading.Event().wait()
+        super().transmit(size)
+
+
+def pump(
+    source: socket.socket,
+    sink: socket.socket,
+    link: Optional[Link],
+    delay: float = 0.0,
+) -> None:
+    try:
+        while data := source.recv(1 << 16):
+            time.sleep(delay)
+            if link is not None:
+                link.transmit(len(data))
+            sink.sendall(data)
+    except OSError:
+        pass
+    finally:
+        with contextlib.suppress(OSError):
+            sink.shutdown(socket.SHUT_WR)
+
+
+def proxy(
+    listener: socket.socket,
+    upstream: tuple[str, int],
+    link: Link,
+    delay: float = 0.0,
+) -> None:
+    """Forwards connections to upstream, delaying requests by delay seconds, and
+    throttling responses to the link's rate."""
+    while True:
+        downstream, _ = listener.accept()
+        downstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        upstream_socket = socket.create_connection(upstream)
+
+        for args in (
+            (downstream, upstream_socket, None, delay),
+            (upstream_socket, downstream, link, 0.0),
+        ):
+            threading.Thread(target=pump, args=args, daemon=True).start()
@@ -0,0 +1,176 @@
+import argparse
+import contextlib
+import io
+import random
+import socket
+import statistics
+import threading
+import time
+from typing import *
+
+from src.peer.dht import ALPHA, ID_BITS, K, DHTNode, rfc_key
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, Holder, RFCIndex
+from src.peer.server import server
+from src.server.server import ServerMode
+
+# Below the ephemeral port range, so the peers' own connections never take a port
+# a later peer is to listen on.
+START_PORT = 20000
+
+
+def start_overlay(
+    size: int,
+    port: int,
+    rfcs: dict[int, set[Holder]],
+    rng: random.Random,
+    k: int,
+    alpha: int,
+) -> list[DHTNode]:
+    """size peers, each serving the RFCs rfcs gives it, joining one at a time through
+    a random peer already in."""
+    hostname = socket.gethostname()
+    # Shared, as the peers share a process; per peer, they'd hold thousands of sockets.
+    pool = ConnectionPool()
+    nodes = []
+
+    for i in range(size):
+        holder = (hostname, port + i)
+        rfc_index = RFCIndex(
+            RFC(n, f"rfc{n}", hostname, "") for n, h in rfcs.items() if holder in h
+        )
+        node = DHTNode(*holder, pool, k, alpha)
+        threading.Thread(
+            target=server,
+            args=(*holder, rfc_index, ServerMode.asyncio),
+            kwargs={"dht": node},
+            daemon=True,
+        ).start()
+        nodes.append(node)
+
+    for node in nodes:
+        for _ in range(200):
+            try:
+                socket.create_connection(node.address).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError(f"Peer {node.address} did not start")
+
+    for i, node in enumerate(nodes):
+        bootstraps = [rng.choice(nodes[:i]).address] if i else []
+        node.join(bootstraps)
+
+    return nodes
+
+
+def settle(nodes: list[DHTNode], rfcs: dict[int, set[Holder]], timeout: float) -> float:
+    """Waits for every peer to have published its RFCs, and handed off its records;
+    returns how long that took."""
+    held = {node.address: set() for node in nodes}
+    for number, holders in rfcs.items():
+        for holder in holders:
+            held[holder].add(number)
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if all(
+            held[node.address] <= set(node.published) and not node.newcomers
+            for node in nodes
+        ):
+            break
+        time.sleep(0.2)
+
+    # One more pass, for any hand-offs still under way.
+    time.sleep(2.0)
+    return time.perf_counter() - start
+
+
+def lookups(
+    nodes: list[DHTNode],
+    rfcs: dict[int, set[Holder]],
+    count: int,
+    rng: random.Random,
+) -> dict[str, float]:
+    """count FindValue lookups, of random RFCs from random peers, over the network,
+    ignoring what peers hold or have cached themselves; and as many FindNode lookups
+    of random IDs, which run until they converge."""
+    numbers = sorted(rfcs)
+    values, latencies, found, recall, closest = [], [], 0, [], []
+
+    for _ in range(count):
+        node, number = rng.choice(nodes), rng.choice(numbers)
+        start = time.perf_counter()
+        lookup = node.lookup(rfc_key(number), value=True)
+        latencies.append(time.perf_counter() - start)
+
+        values.append(lookup)
+        found += bool(lookup.holders & rfcs[number])
+        recall.append(len(lookup.holders & rfcs[number]) / len(rfcs[number]))
+
+        closest.append(rng.choice(nodes).lookup(rng.getrandbits(ID_BITS)))
+
+    latencies.sort()
+    return {
+        "found": found / count,
+        "recall": statistics.mean(recall),
+        "value_rounds": statistics.mean(lookup.rounds for lookup in values),
+        "value_msgs": statistics.mean(lookup.messages for lookup in values),
+        "p50_ms": latencies[len(latencies) // 2] * 1e3,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1e3,
+        "node_rounds": statistics.mean(lookup.rounds for lookup in closest),
+        "node_msgs": statistics.mean(lookup.messages for lookup in closest),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="RFC lookups over a local DHT")
+    parser.add_argument(
+        "--peers", default="32,128,256", help="comma separated overlay sizes"
+    )
+    parser.add_argument("--rfcs-per-peer", type=int, default=2)
+    parser.add_argument("--holders", type=int, default=2, help="peers per RFC")
+    parser.add_argument("--lookups", type=int, default=300)
+    parser.add_argument("--k", type=int, default=K)
+    parser.add_argument("--alpha", type=int, default=ALPHA)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(
+        f"k {args.k}, alpha {args.alpha}; RFCQuery to every peer takes N - 1 messages"
+    )
+    print(
+        f"{'':>24}{'FindValue':-^42}{'FindNode':-^16}\n"
+        f"{'peers':>6}{'contacts':>9}{'settle s':>9}{'found':>8}{'recall':>8}"
+        f"{'rounds':>7}{'msgs':>6}{'p50 ms':>8}{'p99 ms':>8}"
+        f"{'rounds':>8}{'msgs':>8}"
+    )
+
+    port = START_PORT
+    for size in map(int, args.peers.split(",")):
+        rng = random.Random(args.seed)
+        hostname = socket.gethostname()
+        holders = [(hostname, port + i) for i in range(size)]
+        count = size * args.rfcs_per_peer // args.holders
+        rfcs = {n: set(rng.sample(holders, args.holders)) for n in range(1, count + 1)}
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            nodes = start_overlay(size, port, rfcs, rng, args.k, args.alpha)
+            settled = settle(nodes, rfcs, timeout=120.0)
+            results = lookups(nodes, rfcs, args.lookups, rng)
+        contacts = statistics.mean(len(node.table) for node in nodes)
+
+        print(
+            f"{size:>6}{contacts:>9.1f}{settled:>9.1f}"
+            f"{results['found']:>8.3f}{results['recall']:>8.3f}"
+            f"{results['value_rounds']:>7.2f}{results['value_msgs']:>6.1f}"
+            f"{results['p50_ms']:>8.2f}{results['p99_ms']:>8.2f}"
+            f"{results['node_rounds']:>8.2f}{results['node_msgs']:>8.1f}",
+            flush=True,
+        )
+        port += size
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import socket
+import threading
+import time
+from typing import *
+
+from src.bench.common import connected_pair
+from src.utils.utils import Framing, recv_message, send_message
+
+KB = 1 << 10
+MB = 1 << 20
+
+SIZES = [1 * KB, 10 * KB, 100 * KB, 1 * MB, 10 * MB, 100 * MB]
+
+
+def legacy_recv_message(
+    peer_socket: socket.socket, header_size: int = 10, chunk_size: int = 1024
+) -> bytes:
+    """The original receive loop, kept verbatim for comparison."""
+    message = b""
+    t_message = peer_socket.recv(header_size)
+    message_len = int(t_message.decode()) if len(t_message) > 0 else 0
+
+    while message_len > 0:
+        chunk_size = min(chunk_size, message_len)
+
+        response = peer_socket.recv(chunk_size)
+        message += response
+
+        message_len -= chunk_size
+
+    return message
+
+
+def legacy_send_message(
+    data: bytes, peer_socket: socket.socket, header_size: int = 10
+) -> int:
+    header = f"{len(data):<{header_size}}"
+    message = header.encode() + data
+    return peer_socket.send(message)
+
+
+Send = Callable[[bytes, socket.socket], Any]
+Recv = Callable[[socket.socket], bytes]
+
+IMPLEMENTATIONS: dict[str, tuple[Send, Recv]] = {
+    "legacy": (legacy_send_message, legacy_recv_message),
+    "text": (
+        lambda data, s: send_message(data, s, framing=Framing.text),
+        lambda s: recv_message(s, framing=Framing.text),
+    ),
+    "binary": (
+        lambda data, s: send_message(data, s, framing=Framing.binary),
+        lambda s: recv_message(s, framing=Framing.binary),
+    ),
+}
+
+
+def run(name: str, size: int, count: int) -> Optional[float]:
+    """Returns throughput in MB/s, or None if a message arrived corrupted."""
+    send, recv = IMPLEMENTATIONS[name]
+    payload = bytes(size)
+    sender, receiver = connected_pair()
+    receiver.settimeout(10.0)
+
+    def send_all():
+        try:
+            for _ in range(count):
+                send(payload, sender)
+        except OSError:
+            pass
+
+    thread = threading.Thread(target=send_all, daemon=True)
+
+    start = time.perf_counter()
+    thread.start()
+
+    try:
+        for _ in range(count):
+            if len(recv(receiver)) != size:
+                return None
+    except (OSError, ValueError):
+        return None
+    finally:
+        elapsed = time.perf_counter() - start
+        sender.close()
+        receiver.close()
+
+    return size * count / elapsed / MB
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Framing layer throughput")
+    parser.add_argument("--volume", type=int, default=256, help="MB sent per case")
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=1 * MB,
+        help="largest message size for the quadratic legacy receive loop",
+    )
+    args = parser.parse_args()
+
+    print(f"{'size':>10}" + "".join(f"{name:>14}" for name in IMPLEMENTATIONS))
+
+    for size in SIZES:
+        count = min(1000, max(3, args.volume * MB // size))
+        row = f"{size // KB:>8}KB"
+
+        for name in IMPLEMENTATIONS:
+            if name == "legacy" and size > args.legacy_max:
+                row += f"{'skipped':>14}"
+                continue
+
+            throughput = run(name, size, count if name != "legacy" else min(count, 20))
+            row += (
+                f"{'corrupt':>14}" if throughput is None else f"{throughput:>9.1f}MB/s"
+            )
+
+        print(row, flush=True)
+
+
+if __name__ == "__main__":
+    main()
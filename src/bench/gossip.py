@@ -0,0 +1,175 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import socket
+import statistics
+import threading
+import time
+from typing import *
+
+from src.peer.gossip import FANOUT, GOSSIP_INTERVAL, GossipNode
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, RFCIndex, dump_rfc_index
+from src.peer.server import server
+from src.server.server import ServerMode
+
+# Below the ephemeral port range, so the peers' own connections never take a port
+# a later peer is to listen on.
+START_PORT = 22000
+
+
+def start_peers(
+    size: int, port: int, rfcs_per_peer: int, fanout: int, interval: float
+) -> tuple[list[GossipNode], list[RFCIndex]]:
+    """size peers, each holding rfcs_per_peer RFCs of its own, and knowing of every
+    other, as from PQuery."""
+    hostname = socket.gethostname()
+    # Shared, as the peers share a process.
+    pool = ConnectionPool()
+    nodes, indexes = [], []
+
+    for i in range(size):
+        first = i * rfcs_per_peer + 1
+        rfc_index = RFCIndex(
+            RFC(n, f"rfc{n}", hostname, "") for n in range(first, first + rfcs_per_peer)
+        )
+        node = GossipNode(hostname, port + i, pool, fanout, interval)
+        threading.Thread(
+            target=server,
+            args=(hostname, port + i, rfc_index, ServerMode.asyncio),
+            kwargs={"gossip": node},
+            daemon=True,
+        ).start()
+        nodes.append(node)
+        indexes.append(rfc_index)
+
+    for node in nodes:
+        for _ in range(200):
+            try:
+                socket.create_connection(node.address).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError(f"Peer {node.address} did not start")
+
+    return nodes, indexes
+
+
+def converged(nodes: list[GossipNode], indexes: list[RFCIndex]) -> bool:
+    """Whether every peer's view holds every other peer's current version."""
+    expected = {node.address: index.version_tag for node, index in zip(nodes, indexes)}
+    for node in nodes:
+        with node.view.lock:
+            versions = dict(node.view.versions)
+        if any(
+            versions.get(address) != version
+            for address, version in expected.items()
+            if address != node.address
+        ):
+            return False
+    return True
+
+
+def wait(
+    nodes: list[GossipNode], indexes: list[RFCIndex], timeout: float
+) -> dict[str, float]:
+    """Waits for the peers to converge; returns how long that took, the rounds each
+    peer ran meanwhile, and the bytes each exchanged per round."""
+    rounds = [node.rounds.value for node in nodes]
+    exchanged = sum(node.exchanged.value for node in nodes)
+    start = time.perf_counter()
+
+    while not converged(nodes, indexes):
+        if time.perf_counter() - start > timeout:
+            raise RuntimeError(f"No convergence within {timeout}s")
+        time.sleep(0.02)
+
+    elapsed = time.perf_counter() - start
+    rounds = statistics.mean(node.rounds.value - r for node, r in zip(nodes, rounds))
+    exchanged = sum(node.exchanged.value for node in nodes) - exchanged
+
+    return {
+        "seconds": elapsed,
+        "rounds": rounds,
+        "bytes": exchanged / max(1.0, rounds * len(nodes)),
+    }
+
+
+def run(
+    size: int,
+    port: int,
+    rfcs_per_peer: int,
+    fanout: int,
+    interval: float,
+    results: multiprocessing.Queue,
+) -> None:
+    """Measures size peers converging, then one update spreading; in a process of
+    its own, so that no other peers are left gossiping."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes, indexes = start_peers(size, port, rfcs_per_peer, fanout, interval)
+        for node in nodes:
+            node.join(other.address for other in nodes)
+        initial = wait(nodes, indexes, timeout=300.0)
+
+        # One peer gains an RFC.
+        hostname, number = socket.gethostname(), size * rfcs_per_peer + 1
+        indexes[size // 2].add(RFC(number, f"rfc{number}", hostname, ""))
+        update = wait(nodes, indexes, timeout=300.0)
+
+    queries = sum(len(dump_rfc_index(index)) for index in indexes) * (size - 1)
+    results.put((initial, update, queries))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Gossiping the RFC index")
+    parser.add_argument(
+        "--peers", default="16,64,128", help="comma separated peer counts"
+    )
+    parser.add_argument("--rfcs-per-peer", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=FANOUT)
+    parser.add_argument(
+        "--interval", type=float, default=GOSSIP_INTERVAL / 4, help="seconds"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"fanout {args.fanout}, every {args.interval}s; "
+        "RFCQuery counts every peer fetching every other's full index"
+    )
+    print(
+        f"{'':>6}{'converge':-^30}{'one update':-^30}{'RFCQuery':-^10}\n"
+        f"{'peers':>6}{'s':>8}{'rounds':>8}{'KB/round':>14}"
+        f"{'s':>8}{'rounds':>8}{'KB/round':>14}{'MB':>10}"
+    )
+
+    for size in map(int, args.peers.split(",")):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run,
+            args=(
+                size,
+                START_PORT,
+                args.rfcs_per_peer,
+                args.fanout,
+                args.interval,
+                results,
+            ),
+        )
+        process.start()
+        initial, update, queries = results.get()
+        process.kill()
+        process.join()
+
+        print(
+            f"{size:>6}{initial['seconds']:>8.2f}{initial['rounds']:>8.1f}"
+            f"{initial['bytes'] / 1e3:>14.1f}"
+            f"{update['seconds']:>8.2f}{update['rounds']:>8.1f}"
+            f"{update['bytes'] / 1e3:>14.1f}{queries / 1e6:>10.2f}",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import collections
+import contextlib
+import io
+import os
+import pathlib
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from typing import *
+
+from src.bench.common import Link, proxy
+from src.peer.client import get_rfc
+from src.peer.holders import EXPLORE, HolderTable, Transfer
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, Holder, RFCIndex
+from src.peer.server import server
+
+KB = 1 << 10
+MB = 1 << 20
+START_PORT = 42800
+OUT_DIR = pathlib.Path("out/")
+
+
+def start_holders(
+    rfcs: list[RFC], rates: list[float], delays: list[float]
+) -> list[Holder]:
+    """Starts a peer server holding every RFC per rate, each behind a proxy of that
+    rate, and delay, returning the proxies' addresses."""
+    hostname = socket.gethostname()
+    holders = []
+
+    for i, (rate, delay) in enumerate(zip(rates, delays)):
+        port = START_PORT + 2 * i
+        threading.Thread(
+            target=server, args=(hostname, port, RFCIndex(rfcs)), daemon=True
+        ).start()
+
+        listener = socket.create_server((hostname, port + 1))
+        threading.Thread(
+            target=proxy,
+            args=(listener, (hostname, port), Link(rate * MB), delay),
+            daemon=True,
+        ).start()
+
+        holders.append((hostname, port + 1))
+
+    time.sleep(0.5)
+    return holders
+
+
+def run(
+    choose: Callable[[list[Holder]], Holder],
+    table: Optional[HolderTable],
+    holders: list[Holder],
+    numbers: list[int],
+    count: int,
+    rng: random.Random,
+) -> tuple[list[float], collections.Counter]:
+    """count downloads of random RFCs, each from the holder choose picks; returns
+    how long each took, and how many each holder served."""
+    pool = ConnectionPool()
+    seconds, served = [], collections.Counter()
+
+    for _ in range(count):
+        number, holder = rng.choice(numbers), choose(holders)
+        transfer = Transfer()
+
+        start = time.perf_counter()
+        pool.request(holder, lambda s: get_rfc(holder[0], number, s, transfer=transfer))
+        seconds.append(time.perf_counter() - start)
+
+        served[holder] += 1
+        if table is not None:
+            table.record(holder, transfer)
+
+    pool.close()
+    return seconds, served
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Holder selection for GetRFC")
+    parser.add_argument(
+        "--rates", default="0.5,1,4,16", help="comma separated holder MB/s"
+    )
+    parser.add_argument(
+        "--delays", default="40,20,10,2", help="comma separated holder delays, in ms"
+    )
+    parser.add_argument("--size", type=int, default=256, help="RFC size, in KB")
+    parser.add_argument("--rfcs", type=int, default=20)
+    parser.add_argument("--downloads", type=int, default=200)
+    parser.add_argument("--explore", type=float, default=EXPLORE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rates = [float(rate) for rate in args.rates.split(",")]
+    delays = [float(delay) / 1e3 for delay in args.delays.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        hostname = socket.gethostname()
+        rfcs = []
+        for number in range(1, args.rfcs + 1):
+            path = pathlib.Path(tmp).joinpath(f"rfc{number}.txt")
+            path.write_bytes(os.urandom(args.size * KB))
+            rfcs.append(RFC(number, f"rfc{number}", hostname, str(path)))
+
+        holders = start_holders(rfcs, rates, delays)
+        numbers = [rfc.number for rfc in rfcs]
+        fastest = min(
+            range(len(holders)),
+            key=lambda i: delays[i] + args.size * KB / (rates[i] * MB),
+        )
+
+        print(
+            f"{len(holders)} holders at {args.rates} MB/s, {args.delays} ms; "
+            f"{args.downloads} downloads of {args.size} KB RFCs"
+        )
+        print(
+            f"{'choice':>10}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}  served per holder"
+        )
+
+        for name in ("random", "adaptive", "fastest"):
+            rng = random.Random(args.seed)
+            table = None
+            match name:
+                case "random":
+                    choose = rng.choice
+                case "adaptive":
+                    table = HolderTable(args.explore, random.Random(args.seed))
+                    choose = table.choose
+                case _:
+                    choose = lambda holders: holders[fastest]
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, served = run(
+                    choose, table, holders, numbers, args.downloads, rng
+                )
+
+            seconds.sort()
+            print(
+                f"{name:>10}{statistics.mean(seconds) * 1e3:>10.1f}"
+                f"{seconds[len(seconds) // 2] * 1e3:>9.1f}"
+                f"{seconds[int(len(seconds) * 0.95)] * 1e3:>9.1f}"
+                f"  {[served[holder] for holder in holders]}",
+                flush=True,
+            )
+
+        for rfc in rfcs:
+            OUT_DIR.joinpath(pathlib.Path(rfc.path).name).unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import contextlib
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from typing import *
+
+from src.peer.indexer import Indexer
+
+DATA_DIR = pathlib.Path("data/")
+FILES = [1_000, 10_000, 50_000]
+SUBDIRS = 100
+
+
+def make_tree(directory: pathlib.Path, count: int) -> None:
+    """count RFC files, copied round-robin from data/, spread over subdirectories."""
+    sources = sorted(DATA_DIR.glob("*.txt"))
+
+    for i in range(count):
+        subdir = directory.joinpath(f"{i % SUBDIRS:02}")
+        subdir.mkdir(exist_ok=True)
+        shutil.copyfile(sources[i % len(sources)], subdir.joinpath(f"rfc{i}.txt"))
+
+
+def scan(directory: pathlib.Path, manifest: pathlib.Path, workers: int) -> float:
+    start = time.perf_counter()
+    Indexer(directory, "bench", manifest, workers).index()
+    return time.perf_counter() - start
+
+
+def measure(count: int, workers: int, directory: pathlib.Path) -> dict[str, float]:
+    """Indexes a tree of count files from scratch, in-process and with a pool; then
+    again, with the manifest from before; then after touching 1% of the files."""
+    make_tree(directory, count)
+    manifest = directory.joinpath("manifest.json")
+
+    serial = scan(directory, manifest, 1)
+    manifest.unlink()
+    pool = scan(directory, manifest, workers)
+    warm = scan(directory, manifest, workers)
+
+    for path in sorted(directory.rglob("*.txt"))[::100]:
+        os.utime(path, ns=(0, 0))
+    touched = scan(directory, manifest, workers)
+
+    return {"serial s": serial, "pool s": pool, "warm s": warm, "1% s": touched}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Data directory indexing")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="pool size")
+    args = parser.parse_args()
+
+    columns = ["serial s", "pool s", "warm s", "1% s"]
+    print(f"{'files':>10}" + "".join(f"{c:>10}" for c in columns))
+
+    for count in FILES:
+        # The tree repeats data/, so most of its files repeat an RFC; not worth a
+        # warning each time.
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            results = measure(count, args.workers, pathlib.Path(directory))
+
+        print(
+            f"{count:>10}" + "".join(f"{results[c]:>10.3f}" for c in columns),
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+import argparse
+import csv
+import json
+import os
+import pathlib
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import *
+
+from src.peer.client import (
+    get_rfc_request,
+    keep_alive,
+    p_query,
+    recv_rfc,
+    register,
+    rfc_query,
+)
+from src.peer.peer import load_peer
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, RFCIndex, Holder
+from src.peer.server import server
+from src.server.server import PORT, ServerMode
+from src.utils.http import SUCCESS_CODE, send_recv_http_request
+from src.utils.utils import send_message
+
+DATA_DIR = pathlib.Path("data/")
+START_PORT = 43000
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# The scenarios of src/peer/__main__.py: in task_1 a single peer holds every RFC, and
+# every other fetches from it; in task_2 every peer holds its own RFCs, and fetches
+# from all the others.
+SCENARIOS = ["task_1", "task_2"]
+COMMANDS = ["register", "keepalive", "pquery", "rfcquery", "getrfc"]
+DEFAULT_MIX = "keepalive=2,pquery=1,rfcquery=1,getrfc=6"
+
+
+@dataclass
+class Config:
+    scenario: str
+    peers: int
+    rfcs_per_peer: int
+    sizes: str
+    mix: dict[str, float]
+    concurrency: int
+    duration: float
+    rs_mode: str
+    peer_mode: str
+    seed: int
+
+
+@dataclass
+class Samples:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    bytes: int = 0
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    """Parses "command=weight,..." into a dict of weights."""
+    mix = {}
+
+    for part in value.split(","):
+        command, _, weight = part.partition("=")
+        if command.strip() not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {command!r}")
+        mix[command.strip()] = float(weight or 1)
+
+    return mix
+
+
+def sample_sizes(spec: str, count: int, rng: random.Random) -> Optional[list[int]]:
+    """File sizes drawn from a distribution: "fixed:SIZE", "uniform:MIN:MAX", or
+    "lognormal:MEDIAN:SIGMA", in bytes. "data" means the real RFCs under data/."""
+    kind, *params = spec.split(":")
+
+    match kind, [float(p) for p in params]:
+        case "data", []:
+            return None
+        case "fixed", [size]:
+            return [int(size)] * count
+        case "uniform", [low, high]:
+            return [rng.randint(int(low), int(high)) for _ in range(count)]
+        case "lognormal", [median, sigma]:
+            return [
+                max(1, int(median * rng.lognormvariate(0, sigma))) for _ in range(count)
+            ]
+        case _:
+            raise ValueError(f"bad size distribution {spec!r}")
+
+
+def make_files(
+    numbers: list[int], spec: str, directory: pathlib.Path, rng: random.Random
+) -> dict[int, pathlib.Path]:
+    """Writes a file per RFC number, of sizes drawn from spec, cut from the real RFC
+    text so it compresses like the real thing."""
+    if (sizes := sample_sizes(spec, len(numbers), rng)) is None:
+        files = sorted(DATA_DIR.glob("rfc*.txt"))
+        return {n: files[i % len(files)] for i, n in enumerate(numbers)}
+
+    text = b"".join(path.read_bytes() for path in sorted(DATA_DIR.glob("rfc*.txt")))
+    paths = {}
+
+    for number, size in zip(numbers, sizes):
+        start = rng.randrange(len(text))
+        body = (text[start:] + text) * (size // len(text) + 1)
+        paths[number] = directory.joinpath(f"rfc{number}.txt")
+        paths[number].write_bytes(body[:size])
+
+    return paths
+
+
+def proc_cpu_seconds(pid: int) -> float:
+    """User plus system CPU time of a process, from /proc."""
+    stat = pathlib.Path(f"/proc/{pid}/stat").read_text()
+    # The command name may hold spaces; fields are counted from after it.
+    fields = stat[stat.rindex(")") + 2 :].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def proc_rss_bytes(pid: int) -> int:
+    for line in pathlib.Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def start_rs(mode: str) -> subprocess.Popen:
+    rs = subprocess.Popen(
+        [sys.executable, "-m", "src.server.server", "--mode", mode],
+        stdout=subprocess.DEVNULL,
+    )
+    address = (socket.gethostname(), PORT)
+
+    for _ in range(100):
+        if rs.poll() is not None:
+            raise RuntimeError("RS exited; is one already running?")
+        try:
+            socket.create_connection(address).close()
+            return rs
+        except OSError:
+            time.sleep(0.05)
+
+    rs.kill()
+    raise RuntimeError("RS did not start")
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Load:
+    """One run: a local RS, config.peers peer servers, and config.concurrency workers
+    issuing the command mix against them, each acting as one of the peers."""
+
+    def __init__(self, config: Config, directory: pathlib.Path) -> None:
+        self.config = config
+        self.directory = directory
+        self.hostname = socket.gethostname()
+        self.rng = random.Random(config.seed)
+
+        self.holdings: dict[Holder, list[int]] = {}
+        self.pool = ConnectionPool()
+        self.samples = {command: Samples() for command in COMMANDS}
+        self.lock = threading.Lock()
+
+    def start_peers(self) -> None:
+        config = self.config
+        holders = 1 if config.scenario == "task_1" else config.peers
+        per_holder = config.rfcs_per_peer * (config.peers if holders == 1 else 1)
+        numbers = list(range(1, holders * per_holder + 1))
+        paths = make_files(numbers, config.sizes, self.directory, self.rng)
+
+        for i in range(config.peers):
+            holder = (self.hostname, START_PORT + i)
+            held = numbers[i * per_holder : (i + 1) * per_holder] if i < holders else []
+            rfc_index = RFCIndex(
+                RFC(n, f"rfc{n}", self.hostname, str(paths[n])) for n in held
+            )
+            mode = ServerMode[config.peer_mode]
+            threading.Thread(
+                target=server, args=(*holder, rfc_index, mode), daemon=True
+            ).start()
+
+            if held:
+                self.holdings[holder] = held
+
+        time.sleep(0.2)
+
+    def register_peers(self) -> list[socket.socket]:
+        """Registers every peer with the RS, over connections held open for the run,
+        as real peers would."""
+        connections = []
+
+        for i in range(self.config.peers):
+            rs_socket = socket.create_connection((self.hostname, PORT))
+            send_recv_http_request(register(self.hostname, START_PORT + i), rs_socket)
+            connections.append(rs_socket)
+
+        return connections
+
+    def worker(self, index: int, deadline: float) -> None:
+        rng = random.Random(self.config.seed * 1000 + index)
+        port = START_PORT + index % self.config.peers
+        me = (self.hostname, port)
+        commands, weights = zip(*self.config.mix.items())
+        samples = {command: Samples() for command in COMMANDS}
+
+        rs_socket = socket.create_connection((self.hostname, PORT))
+        peer = load_peer(send_recv_http_request(register(*me), rs_socket))
+        holders = [h for h in self.holdings if h != me] or list(self.holdings)
+
+        while time.monotonic() < deadline:
+            command = rng.choices(commands, weights)[0]
+            holder = rng.choice(holders)
+            start = time.perf_counter()
+
+            try:
+                match command:
+                    case "register":
+                        response = send_recv_http_request(register(*me), rs_socket)
+                    case "keepalive":
+                        request = keep_alive(self.hostname, peer)
+                        response = send_recv_http_request(request, rs_socket)
+                    case "pquery":
+                        request = p_query(self.hostname, peer)
+                        response = send_recv_http_request(request, rs_socket)
+                    case "rfcquery":
+                        request = rfc_query(holder[0])
+                        response = self.pool.request(
+                            holder, lambda s: send_recv_http_request(request, s)
+                        )
+                    case "getrfc":
+                        number = rng.choice(self.holdings[holder])
+                        response = self.pool.request(
+                            holder, lambda s: self.get_rfc(holder, number, s)
+                        )
+                        if response.status == SUCCESS_CODE:
+                            samples[command].bytes += int(
+                                response.getheader("RFC-Size")
+                            )
+            except OSError:
+                samples[command].errors += 1
+                continue
+
+            elapsed = time.perf_counter() - start
+            if response.status != SUCCESS_CODE:
+                samples[command].errors += 1
+            else:
+                samples[command].latencies.append(elapsed)
+
+        rs_socket.close()
+
+        with self.lock:
+            for command, sample in samples.items():
+                self.samples[command].latencies += sample.latencies
+                self.samples[command].errors += sample.errors
+                self.samples[command].bytes += sample.bytes
+
+    def get_rfc(self, holder: Holder, number: int, peer_socket: socket.socket):
+        send_message(get_rfc_request(holder[0], [number]), peer_socket)
+        response, _ = recv_rfc(peer_socket, self.directory.joinpath("out"))
+        return response
+
+    def run(self) -> dict[str, Any]:
+        config = self.config
+        self.directory.joinpath("out").mkdir()
+        self.start_peers()
+
+        rs = start_rs(config.rs_mode)
+
+        try:
+            rss_before = proc_rss_bytes(rs.pid)
+            connections = self.register_peers()
+            rss_after = proc_rss_bytes(rs.pid)
+
+            cpu_before = proc_cpu_seconds(rs.pid)
+            start = time.monotonic()
+            deadline = start + config.duration
+
+            workers = [
+                threading.Thread(target=self.worker, args=(i, deadline))
+                for i in range(config.concurrency)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            elapsed = time.monotonic() - start
+            rs_cpu = proc_cpu_seconds(rs.pid) - cpu_before
+            rs_rss = proc_rss_bytes(rs.pid)
+
+            for connection in connections:
+                connection.close()
+        finally:
+            rs.terminate()
+            rs.wait()
+            self.pool.close()
+
+        return self.report(elapsed, rs_cpu, rs_rss, rss_before, rss_after)
+
+    def report(
+        self,
+        elapsed: float,
+        rs_cpu: float,
+        rs_rss: int,
+        rss_before: int,
+        rss_after: int,
+    ) -> dict[str, Any]:
+        commands = {}
+        rs_requests = 0
+
+        for command, sample in self.samples.items():
+            if command not in self.config.mix:
+                continue
+
+            ordered = sorted(sample.latencies)
+            commands[command] = {
+                "count": len(ordered),
+                "errors": sample.errors,
+                "throughput": len(ordered) / elapsed,
+                "p50_ms": percentile(ordered, 0.50) * 1000,
+                "p95_ms": percentile(ordered, 0.95) * 1000,
+                "p99_ms": percentile(ordered, 0.99) * 1000,
+                "mb_per_s": sample.bytes / elapsed / (1 << 20),
+            }
+            if command in ("register", "keepalive", "pquery"):
+                rs_requests += len(ordered) + sample.errors
+
+        total = sum(c["count"] for c in commands.values())
+
+        return {
+            "revision": revision(),
+            "config": asdict(self.config),
+            "elapsed": elapsed,
+            "throughput": total / elapsed,
+            "commands": commands,
+            "rs": {
+                "cpu_percent": 100 * rs_cpu / elapsed,
+                "cpu_us_per_request": 1e6 * rs_cpu / max(1, rs_requests),
+                "rss_bytes": rs_rss,
+                "rss_bytes_per_peer": (rss_after - rss_before) / self.config.peers,
+            },
+        }
+
+
+def revision() -> Optional[str]:
+    """The git commit under test, so results can be compared across versions."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+CSV_FIELDS = [
+    "revision",
+    "scenario",
+    "peers",
+    "concurrency",
+    "command",
+    "count",
+    "errors",
+    "throughput",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "mb_per_s",
+    "rs_cpu_percent",
+    "rs_cpu_us_per_request",
+    "rs_rss_bytes_per_peer",
+]
+
+
+def write_csv(results: dict[str, Any], path: pathlib.Path) -> None:
+    """One row per command; appends to path, so runs across versions accumulate."""
+    config, rs = results["config"], results["rs"]
+    exists = path.exists()
+
+    with path.open("a", newline="") as file:
+        writer = csv.DictWriter(file, CSV_FIELDS)
+        if not exists:
+            writer.writeheader()
+
+        for command, stats in results["commands"].items():
+            writer.writerow(
+                {
+                    "revision": results["revision"],
+                    "scenario": config["scenario"],
+                    "peers": config["peers"],
+                    "concurrency": config["concurrency"],
+                    "command": command,
+                    **stats,
+                    "rs_cpu_percent": rs["cpu_percent"],
+                    "rs_cpu_us_per_request": rs["cpu_us_per_request"],
+                    "rs_rss_bytes_per_peer": rs["rss_bytes_per_peer"],
+                }
+            )
+
+
+def print_results(results: dict[str, Any]) -> None:
+    print(
+        f"{'command':>10}{'count':>9}{'errors':>8}{'req/s':>10}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'MB/s':>9}"
+    )
+    for command, s in results["commands"].items():
+        print(
+            f"{command:>10}{s['count']:>9}{s['errors']:>8}{s['throughput']:>10.0f}"
+            f"{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}"
+            f"{s['mb_per_s']:>9.1f}"
+        )
+
+    rs = results["rs"]
+    print(
+        f"\ntotal {results['throughput']:.0f} req/s; RS {rs['cpu_percent']:.1f}% CPU, "
+        f"{rs['cpu_us_per_request']:.0f}us CPU/request, "
+        f"{rs['rss_bytes'] / (1 << 20):.1f}MB RSS, "
+        f"{rs['rss_bytes_per_peer'] / 1024:.1f}KB/peer"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test against a local RS")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="task_2")
+    parser.add_argument("--peers", type=int, default=20)
+    parser.add_argument("--rfcs-per-peer", type=int, default=10)
+    parser.add_argument(
+        "--sizes",
+        default="data",
+        help='"data", "fixed:SIZE", "uniform:MIN:MAX" or "lognormal:MEDIAN:SIGMA"',
+    )
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    modes = [mode.name for mode in ServerMode]
+    parser.add_argument("--rs-mode", choices=modes, default=ServerMode.threaded.name)
+    parser.add_argument("--peer-mode", choices=modes, default=ServerMode.threaded.name)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=pathlib.Path, help="write results as JSON")
+    parser.add_argument("--csv", type=pathlib.Path, help="append results as CSV")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    config = Config(
+        scenario=args.scenario,
+        peers=args.peers,
+        rfcs_per_peer=args.rfcs_per_peer,
+        sizes=args.sizes,
+        mix=args.mix,
+        concurrency=args.concurrency,
+        duration=args.duration,
+        rs_mode=args.rs_mode,
+        peer_mode=args.peer_mode,
+        seed=args.seed,
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = Load(config, pathlib.Path(directory)).run()
+
+    print_results(results)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+    if args.csv is not None:
+        write_csv(results, args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import contextlib
+import http
+import http.client
+import http.server
+import io
+import platform
+import socket
+import time
+from io import BytesIO
+from typing import *
+
+from src.utils.http import (
+    SUCCESS_CODE,
+    TIME_FMT,
+    _make_response,
+    http_request,
+    http_response,
+    parse_request,
+    parse_response,
+)
+
+BODY = '{"hostname": "localhost", "cookie": 1, "port": 1234, "ttl": 7200}'
+
+
+class _FakeSocket(socket.socket):
+    def __init__(self, response: bytes):
+        self._file = BytesIO(response)
+
+    def makefile(self, *args, **kwargs):
+        return self._file
+
+
+class LegacyHTTPResponse(http.client.HTTPResponse):
+    """The original, stdlib backed parsers, kept verbatim for comparison."""
+
+    def __init__(self, response: bytes):
+        super().__init__(_FakeSocket(response))
+        self.content = b""
+
+        self.begin()
+
+        if (length := self.getheader("Content-Length")) is not None:
+            self.content = self.read(len(response))
+
+    def __str__(self) -> str:
+        return f"""{self.version} {self.status} {self.reason}
+{self.headers}"""
+
+
+class LegacyHTTPRequest(http.server.BaseHTTPRequestHandler):
+    def __init__(self, request: bytes):
+        self.rfile = BytesIO(request)
+        self.raw_requestline = self.rfile.readline()
+        self.error_code = self.error_message = None
+        self.parse_request()
+        self.content = self.rfile.read()
+        self.rfile.seek(0)
+
+    def __str__(self) -> str:
+        return f"""{self.command} {self.path} {self.protocol_version}
+{self.headers}"""
+
+
+def legacy_request(cookie: int) -> bytes:
+    headers = {"Peer-Cookie": cookie} | {
+        "Host": socket.gethostname(),
+        "OS": f"{platform.system()} {platform.release()}",
+        "Date": time.strftime(TIME_FMT, time.gmtime()) + "GMT",
+    }
+    request = _make_response(b"keepalive localhost HTTP/1.1", headers)
+    print(LegacyHTTPRequest(bytes(request)))
+    return request
+
+
+def legacy_response(cookie: int) -> bytes:
+    start_line = f"HTTP/1.1 200 {http.HTTPStatus(SUCCESS_CODE).phrase}".encode()
+    response = _make_response(start_line, {"Peer-Cookie": cookie}, BODY)
+    print(LegacyHTTPResponse(bytes(response)))
+    return response
+
+
+def legacy_round_trip(cookie: int) -> bytes:
+    request = LegacyHTTPRequest(legacy_request(cookie))
+    response = legacy_response(int(request.headers["Peer-Cookie"]))
+    return LegacyHTTPResponse(response).content
+
+
+@http_request
+def keep_alive(cookie: int):
+    return "keepalive", "localhost", {"Peer-Cookie": cookie}
+
+
+@http_response
+def keep_alive_response(cookie: int):
+    return SUCCESS_CODE, {"Peer-Cookie": cookie}, BODY
+
+
+def round_trip(cookie: int) -> bytes:
+    request = parse_request(keep_alive(cookie))
+    response = keep_alive_response(int(request.headers["Peer-Cookie"]))
+    return parse_response(response).content
+
+
+IMPLEMENTATIONS: dict[str, Callable[[int], bytes]] = {
+    "legacy": legacy_round_trip,
+    "current": round_trip,
+}
+
+
+def run(name: str, count: int) -> float:
+    """Returns round trips per second: a request made, then parsed, then its response
+    made, then parsed, all in memory."""
+    trip = IMPLEMENTATIONS[name]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for cookie in range(count):
+            assert trip(cookie) == BODY.encode()
+        elapsed = time.perf_counter() - start
+
+    return count / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pseudo-HTTP request round trips")
+    parser.add_argument("--count", type=int, default=20000, help="round trips per case")
+    args = parser.parse_args()
+
+    results = {name: run(name, args.count) for name in IMPLEMENTATIONS}
+
+    for name, rate in results.items():
+        print(f"{name:>10}{rate:>12.0f}/s")
+
+    print(f"{'speedup':>10}{results['current'] / results['legacy']:>12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
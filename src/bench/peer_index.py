@@ -0,0 +1,123 @@
+import argparse
+import time
+from typing import *
+
+from src.peer.peer import Peer, PeerIndex
+
+HISTORY = [1_000, 10_000, 100_000, 1_000_000]
+HOSTNAME = "bench.local"
+
+
+class LegacyPeerIndex:
+    """The original scan-based index, kept for comparison."""
+
+    def __init__(self) -> None:
+        self.peers: dict[int, Peer] = {}
+        self.id = 0
+
+    def register(self, hostname: str, port: int) -> Peer:
+        for p in self.peers.values():
+            if p.hostname == hostname and p.port == port:
+                p.refresh()
+                return p
+
+        peer = Peer(hostname=hostname, cookie=self.id, port=port)
+        self.peers[self.id] = peer
+        self.id += 1
+        return peer
+
+    def get(self, key: int) -> Optional[Peer]:
+        return self.peers.get(key)
+
+    def refresh(self, peer: Peer) -> None:
+        peer.refresh()
+
+    def leave(self, peer: Peer) -> None:
+        peer.leave()
+
+    def get_active_peers(self) -> dict[int, Peer]:
+        return {peer_id: peer for peer_id, peer in self.peers.items() if peer.active}
+
+
+def populate(peer_index: PeerIndex | LegacyPeerIndex, history: int, active: int):
+    """Registers history peers, of which all but the last active have since left.
+    The legacy index is filled directly, as its register is quadratic to build."""
+    for i in range(history):
+        if isinstance(peer_index, LegacyPeerIndex):
+            peer = Peer(hostname=HOSTNAME, cookie=i, port=i)
+            peer_index.peers[i] = peer
+            peer_index.id += 1
+        else:
+            peer = peer_index.register(HOSTNAME, i)
+
+        if i < history - active:
+            peer_index.leave(peer)
+
+
+def time_op(op: Callable[[int], Any], repeat: int) -> float:
+    """Mean microseconds per call."""
+    start = time.perf_counter()
+    for i in range(repeat):
+        op(i)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def measure(peer_index, history: int, active: int, repeat: int) -> dict[str, float]:
+    populate(peer_index, history, active)
+    cookies = list(range(history - active, history))
+
+    def keep_alive(i: int):
+        peer_index.refresh(peer_index.get(cookies[i % active]))
+
+    def p_query(i: int):
+        peer_index.get_active_peers()
+
+    def register_existing(i: int):
+        peer_index.register(HOSTNAME, cookies[i % active])
+
+    def leave_register(i: int):
+        peer = peer_index.get(cookies[i % active])
+        peer_index.leave(peer)
+        peer_index.register(HOSTNAME, peer.port)
+
+    def register_new(i: int):
+        peer_index.register(HOSTNAME, history + i)
+
+    return {
+        "keepalive": time_op(keep_alive, repeat),
+        "pquery": time_op(p_query, repeat),
+        "register": time_op(register_existing, repeat),
+        "leave+register": time_op(leave_register, repeat),
+        "register_new": time_op(register_new, repeat),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PeerIndex scaling with history")
+    parser.add_argument("--active", type=int, default=100, help="active peers")
+    parser.add_argument("--repeat", type=int, default=200, help="calls per operation")
+    parser.add_argument(
+        "--legacy-max", type=int, default=100_000, help="largest history for legacy"
+    )
+    args = parser.parse_args()
+
+    ops = ["keepalive", "pquery", "register", "leave+register", "register_new"]
+    print(f"{'index':>8}{'history':>10}" + "".join(f"{op:>16}" for op in ops))
+    print(f"{'':>18}" + "".join(f"{'(us/op)':>16}" for _ in ops))
+
+    for history in HISTORY:
+        indexes = {"current": PeerIndex(purge_after=float("inf"))}
+        if history <= args.legacy_max:
+            indexes["legacy"] = LegacyPeerIndex()
+
+        for name, peer_index in indexes.items():
+            results = measure(peer_index, history, args.active, args.repeat)
+            print(
+                f"{name:>8}{history:>10}"
+                + "".join(f"{results[op]:>16.2f}" for op in ops),
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import pathlib
+import tempfile
+import time
+from typing import *
+
+from src.server.persistence import SNAPSHOT_NAME, WAL_NAME, PersistentPeerIndex
+
+PEERS = [10_000, 100_000, 1_000_000]
+PORT = 6881
+INF = float("inf")
+
+
+def restore(directory: pathlib.Path) -> tuple[PersistentPeerIndex, float]:
+    start = time.perf_counter()
+    peer_index = PersistentPeerIndex(directory, purge_after=INF, compact_after=INF)
+    return peer_index, time.perf_counter() - start
+
+
+def measure(count: int, active: int, directory: pathlib.Path) -> dict[str, float]:
+    """Registers count peers, each on its own host, all but active of which then
+    leave, logging every change; then restarts from the log alone, and from a
+    snapshot."""
+    peer_index = PersistentPeerIndex(directory, purge_after=INF, compact_after=INF)
+
+    start = time.perf_counter()
+    peers = [peer_index.register(f"peer{i}.bench.local", PORT) for i in range(count)]
+    for peer in peers[: count - active]:
+        peer_index.leave(peer)
+    logged = (time.perf_counter() - start) / (2 * count - active) * 1e6
+
+    wal_size = directory.joinpath(WAL_NAME).stat().st_size
+    peer_index.wal.close()
+
+    peer_index, replay = restore(directory)
+    assert len(peer_index.peers) == count and len(peer_index.active) == active
+
+    start = time.perf_counter()
+    peer_index.close()
+    snapshot = time.perf_counter() - start
+    snapshot_size = directory.joinpath(SNAPSHOT_NAME).stat().st_size
+
+    peer_index, load = restore(directory)
+    assert peer_index.id == count and len(peer_index.active) == active
+    peer_index.close()
+
+    return {
+        "log us/op": logged,
+        "log MB": wal_size / 1e6,
+        "replay s": replay,
+        "snapshot s": snapshot,
+        "snapshot MB": snapshot_size / 1e6,
+        "load s": load,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PeerIndex persistence and restore")
+    parser.add_argument("--active", type=int, default=1000, help="active peers")
+    args = parser.parse_args()
+
+    columns = ["log us/op", "log MB", "replay s", "snapshot s", "snapshot MB", "load s"]
+    print(f"{'peers':>10}" + "".join(f"{c:>13}" for c in columns))
+
+    for count in PEERS:
+        with tempfile.TemporaryDirectory() as directory:
+            results = measure(count, min(args.active, count), pathlib.Path(directory))
+
+        print(
+            f"{count:>10}" + "".join(f"{results[c]:>13.2f}" for c in columns),
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
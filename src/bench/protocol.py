@@ -0,0 +1,90 @@
+import argparse
+import threading
+import time
+from typing import *
+
+from src.bench.common import connected_pair
+from src.peer.peer import PeerIndex
+from src.server.server import P2ServerCommands, server_receiver
+from src.server.shards import make_shards
+from src.utils.metrics import ServerMetrics
+from src.utils.http import (
+    SUCCESS_CODE,
+    Protocol,
+    make_request,
+    make_response,
+    parse_request,
+    parse_response,
+    send_recv_http_request,
+    use_protocol,
+)
+
+PROTOCOLS = [Protocol.text, Protocol.binary]
+
+
+def keep_alive_request(cookie: int) -> bytes:
+    return make_request(
+        P2ServerCommands.keepalive.name, "localhost", {"Peer-Cookie": cookie}
+    )
+
+
+def codec(protocol: Protocol, count: int) -> float:
+    """Encodes and parses count KeepAlive requests and responses, returning messages
+    per second."""
+    with use_protocol(protocol):
+        start = time.perf_counter()
+
+        for cookie in range(count):
+            parse_request(keep_alive_request(cookie))
+            parse_response(make_response(SUCCESS_CODE, {"Peer-Cookie": cookie}))
+
+        elapsed = time.perf_counter() - start
+
+    return 2 * count / elapsed
+
+
+def round_trip(protocol: Protocol, count: int) -> float:
+    """Sends count KeepAlives, one at a time, to an RS receiver, returning round
+    trips per second."""
+    peer_index = PeerIndex()
+    cookie = peer_index.register("localhost", 1234).cookie
+    client, server = connected_pair()
+
+    receiver = threading.Thread(
+        target=server_receiver,
+        args=(peer_index, server, ServerMetrics(), make_shards("localhost", 0, 1)),
+        daemon=True,
+    )
+    receiver.start()
+
+    with use_protocol(protocol):
+        start = time.perf_counter()
+
+        for _ in range(count):
+            response = send_recv_http_request(keep_alive_request(cookie), client)
+            assert response.status == SUCCESS_CODE
+
+        elapsed = time.perf_counter() - start
+
+    client.close()
+    receiver.join()
+
+    return count / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pseudo-HTTP against binary messages")
+    parser.add_argument("--count", type=int, default=20000, help="messages per case")
+    args = parser.parse_args()
+
+    print(f"{'protocol':>10}{'codec msg/s':>16}{'round trip/s':>16}")
+
+    for protocol in PROTOCOLS:
+        encoded = codec(protocol, args.count)
+        trips = round_trip(protocol, args.count)
+
+        print(f"{protocol.name:>10}{encoded:>16.0f}{trips:>16.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import contextlib
+import io
+import os
+import pathlib
+import random
+import socket
+import tempfile
+import threading
+import time
+from typing import *
+
+from src.bench.swarm import MB, RFC_NUMBER, digest
+from src.peer.client import get_rfc, with_retries
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, RFCIndex
+from src.peer.server import RESPONSE_CACHE, server
+from src.utils.digest import part_path
+
+START_PORT = 42500
+MAX_ATTEMPTS = 100
+
+
+class FlakyLink:
+    """Drops each connection after a random number of response bytes, exponentially
+    distributed around mean, and, with probability corrupt, flips one of the first
+    size bytes before that."""
+
+    def __init__(self, mean: float, corrupt: float, size: int, seed: int) -> None:
+        self.mean = mean
+        self.corrupt = corrupt
+        self.size = size
+        self.rng = random.Random(seed)
+        self.transferred = 0
+        self.lock = threading.Lock()
+
+    def pump(self, source: socket.socket, sink: socket.socket) -> None:
+        with self.lock:
+            budget = int(self.rng.expovariate(1 / self.mean))
+            flip = -1
+            if self.rng.random() < self.corrupt:
+                flip = self.rng.randrange(max(1, min(budget, self.size)))
+
+        sent = 0
+        try:
+            while sent < budget and (data := source.recv(1 << 16)):
+                data = data[: budget - sent]
+                if 0 <= flip - sent < len(data):
+                    i = flip - sent
+                    data = data[:i] + bytes([data[i] ^ 0xFF]) + data[i + 1 :]
+                sink.sendall(data)
+                sent += len(data)
+                with self.lock:
+                    self.transferred += len(data)
+        except OSError:
+            pass
+        finally:
+            for s in (source, sink):
+                with contextlib.suppress(OSError):
+                    s.shutdown(socket.SHUT_RDWR)
+
+    def proxy(self, listener: socket.socket, upstream: tuple[str, int]) -> None:
+        while True:
+            downstream, _ = listener.accept()
+            upstream_socket = socket.create_connection(upstream)
+
+            threading.Thread(
+                target=forward, args=(downstream, upstream_socket), daemon=True
+            ).start()
+            threading.Thread(
+                target=self.pump, args=(upstream_socket, downstream), daemon=True
+            ).start()
+
+
+def forward(source: socket.socket, sink: socket.socket) -> None:
+    with contextlib.suppress(OSError):
+        while data := source.recv(1 << 16):
+            sink.sendall(data)
+
+
+def download(
+    holder: tuple[str, int], out_dir: pathlib.Path, resume: bool
+) -> tuple[int, float]:
+    """Fetches the RFC until it arrives whole, returning the attempts it took, and
+    how long. Without resume, every attempt starts over."""
+    pool = ConnectionPool()
+    attempts = 0
+
+    def attempt():
+        nonlocal attempts
+        attempts += 1
+        if not resume:
+            part_path(out_dir, RFC_NUMBER).unlink(missing_ok=True)
+        return pool.request(
+            holder, lambda s: get_rfc(holder[0], RFC_NUMBER, s, out_dir)
+        )
+
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(io.StringIO()):
+        with_retries(attempt, MAX_ATTEMPTS)
+    elapsed = time.perf_counter() - start
+
+    pool.close()
+    return attempts, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Resumed against restarted GetRFC")
+    parser.add_argument("--size", type=int, default=64, help="RFC size, in MB")
+    parser.add_argument(
+        "--mean", type=float, default=32, help="mean MB sent before a drop"
+    )
+    parser.add_argument(
+        "--corrupt", type=float, default=0.2, help="chance a connection corrupts a byte"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    hostname = socket.gethostname()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp).joinpath(f"rfc{RFC_NUMBER}.txt")
+        path.write_bytes(os.urandom(args.size * MB))
+        expected = digest(path)
+
+        rfc_index = RFCIndex([RFC(RFC_NUMBER, "bench", hostname, str(path))])
+        threading.Thread(
+            target=server, args=(hostname, START_PORT, rfc_index), daemon=True
+        ).start()
+        # The whole file is sent from disk every time, as on a peer where it's cold.
+        RESPONSE_CACHE.resize(0)
+        time.sleep(0.2)
+
+        # Computes the RFC's digest, and its compressed variants, ahead of the runs.
+        with contextlib.redirect_stdout(io.StringIO()):
+            download((hostname, START_PORT), pathlib.Path(tmp, "warm"), resume=True)
+
+        print(f"{args.size} MB RFC, drops every {args.mean} MB on average")
+        print(f"{'mode':>8}{'attempts':>10}{'MB sent':>10}{'seconds':>10}")
+
+        for mode in ("restart", "resume"):
+            link = FlakyLink(args.mean * MB, args.corrupt, args.size * MB, args.seed)
+            listener = socket.create_server((hostname, 0))
+            threading.Thread(
+                target=link.proxy, args=(listener, (hostname, START_PORT)), daemon=True
+            ).start()
+
+            out_dir = pathlib.Path(tmp).joinpath(mode)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    attempts, elapsed = download(
+                        listener.getsockname(), out_dir, mode == "resume"
+                    )
+            except (OSError, ValueError):
+                print(f"{mode:>8}  gave up after {MAX_ATTEMPTS} attempts", flush=True)
+                continue
+
+            assert digest(out_dir.joinpath(path.name)) == expected
+
+            sent = link.transferred / MB
+            print(f"{mode:>8}{attempts:>10}{sent:>10.1f}{elapsed:>10.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import contextlib
+import io
+import pathlib
+import random
+import socket
+import tempfile
+import threading
+import time
+from typing import *
+
+from src.bench.cache import make_index
+from src.peer.client import rfc_query
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import Holder, load_rfc_index
+from src.peer.scatter import Scatter
+from src.peer.server import server
+from src.utils.http import SUCCESS_CODE, send_recv_http_request
+
+START_PORT = 42600
+# Listeners of peers that never answer, kept open.
+DEAD: list[socket.socket] = []
+
+
+def delayed(source: socket.socket, sink: socket.socket, delay: float) -> None:
+    with contextlib.suppress(OSError):
+        while data := source.recv(1 << 16):
+            time.sleep(delay)
+            sink.sendall(data)
+
+
+def forward(source: socket.socket, sink: socket.socket) -> None:
+    with contextlib.suppress(OSError):
+        while data := source.recv(1 << 16):
+            sink.sendall(data)
+
+
+def slow_link(upstream: Holder, delay: float) -> Holder:
+    """A proxy to upstream, holding back each of its responses by delay seconds."""
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def proxy():
+        while True:
+            downstream, _ = listener.accept()
+            upstream_socket = socket.create_connection(upstream)
+            for target, args in (
+                (forward, (downstream, upstream_socket)),
+                (delayed, (upstream_socket, downstream, delay)),
+            ):
+                threading.Thread(target=target, args=args, daemon=True).start()
+
+    threading.Thread(target=proxy, daemon=True).start()
+    return listener.getsockname()
+
+
+def dead_peer() -> Holder:
+    """Accepts connections, by way of its backlog, and never answers."""
+    listener = socket.create_server(("127.0.0.1", 0))
+    DEAD.append(listener)
+    return listener.getsockname()
+
+
+def query(holder: Holder, peer_socket: socket.socket) -> int:
+    response = send_recv_http_request(rfc_query(holder[0]), peer_socket)
+    assert response.status == SUCCESS_CODE
+    return len(load_rfc_index(response))
+
+
+Timings = tuple[float, float, float, int]
+
+
+def sequential(holders: list[Holder], deadline: float) -> Timings:
+    """RFCQuery to each holder in turn, as client_handler did, each allowed deadline
+    seconds. Returns when the first and last answers came, when it finished, and how
+    many holders answered."""
+    pool = ConnectionPool(timeout=deadline)
+    start, first, last, answered = time.perf_counter(), None, None, 0
+
+    for holder in holders:
+        try:
+            pool.request(holder, lambda s: query(holder, s))
+        except OSError:
+            continue
+        answered += 1
+        last = time.perf_counter() - start
+        first = first or last
+
+    pool.close()
+    return first, last, time.perf_counter() - start, answered
+
+
+def scattered(holders: list[Holder], deadline: float) -> Timings:
+    pool = ConnectionPool(timeout=deadline)
+    start, first, last, answered = time.perf_counter(), None, None, 0
+
+    for reply in Scatter(pool, holders, query, deadline):
+        if reply.error is None:
+            answered += 1
+            last = time.perf_counter() - start
+            first = first or last
+
+    pool.close()
+    return first, last, time.perf_counter() - start, answered
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sequential against scattered queries")
+    parser.add_argument("--peers", type=int, default=30)
+    parser.add_argument("--dead", type=int, default=2, help="peers that never answer")
+    parser.add_argument(
+        "--delay", type=float, default=0.02, help="median response delay, in seconds"
+    )
+    parser.add_argument("--deadline", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    holders = []
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        for i in range(args.peers):
+            peer_dir = pathlib.Path(directory, str(i))
+            peer_dir.mkdir()
+            rfc_index = make_index(peer_dir, 50, 1024)
+            address = ("127.0.0.1", START_PORT + i)
+            threading.Thread(
+                target=server, args=(*address, rfc_index), daemon=True
+            ).start()
+            # Lognormal delays: most peers quick, a few slow.
+            holders.append(slow_link(address, rng.lognormvariate(0, 1) * args.delay))
+
+        holders += [dead_peer() for _ in range(args.dead)]
+        rng.shuffle(holders)
+        time.sleep(0.5)
+
+        results = {
+            "sequential": sequential(holders, args.deadline),
+            "scatter": scattered(holders, args.deadline),
+        }
+
+    print(f"{len(holders)} peers, {args.dead} dead, deadline {args.deadline}s")
+    print(f"{'mode':>12}{'first ms':>10}{'last ms':>10}{'done ms':>10}{'answered':>10}")
+    for mode, (first, last, done, answered) in results.items():
+        times = "".join(f"{t * 1e3:>10.1f}" for t in (first, last, done))
+        print(f"{mode:>12}{times}{answered:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import contextlib
+import io
+import pathlib
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from typing import *
+
+from src.bench.common import connected_pair
+from src.peer.indexer import Indexer
+from src.peer.rfc import RFCIndex
+from src.peer.search import SearchIndex
+from src.peer.server import server_receiver
+from src.utils.http import SUCCESS_CODE, make_request, parse_response
+from src.utils.metrics import ServerMetrics
+from src.utils.utils import recv_message, send_message
+
+DATA_DIR = pathlib.Path("data/")
+
+
+def make_queries(search_index: SearchIndex, count: int, seed: int) -> list[str]:
+    """count queries of one to three terms, drawn from the vocabulary, weighted by
+    how many RFCs hold them, as real queries tend to be."""
+    rng = random.Random(seed)
+    terms = sorted(search_index.postings)
+    weights = [len(search_index.postings[term]) for term in terms]
+
+    return [
+        " ".join(t.decode() for t in rng.choices(terms, weights, k=rng.randint(1, 3)))
+        for _ in range(count)
+    ]
+
+
+def percentiles(samples: list[float]) -> tuple[float, float]:
+    cuts = statistics.quantiles(samples, n=100)
+    return cuts[49], cuts[98]
+
+
+def query_latency(search_index: SearchIndex, queries: list[str]) -> list[float]:
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        search_index.search(query)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def round_trips(
+    rfc_index: RFCIndex, search_index: SearchIndex, queries: list[str]
+) -> list[float]:
+    """Search requests, one at a time, to a peer server receiver."""
+    client, server = connected_pair()
+    receiver = threading.Thread(
+        target=server_receiver,
+        args=(rfc_index, search_index, server, ServerMetrics()),
+        daemon=True,
+    )
+    receiver.start()
+
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        send_message(make_request("search", "localhost", {"Query": query}), client)
+        assert parse_response(recv_message(client)).status == SUCCESS_CODE
+        samples.append(time.perf_counter() - start)
+
+    client.close()
+    receiver.join()
+
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Full-text search over data/")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # A copy, so that one file can be changed.
+        data_dir = pathlib.Path(tmp, "data")
+        shutil.copytree(DATA_DIR, data_dir)
+        with contextlib.redirect_stderr(io.StringIO()):
+            rfc_index = Indexer(data_dir, "localhost", pathlib.Path(tmp, "m")).index()
+
+        path = pathlib.Path(tmp, "search.idx")
+        corpus = sum(pathlib.Path(rfc.path).stat().st_size for rfc in rfc_index)
+
+        search_index = SearchIndex(path)
+        start = time.perf_counter()
+        search_index.sync(rfc_index)
+        build = time.perf_counter() - start
+        search_index.saving.join()
+
+        restored = SearchIndex(path)
+        start = time.perf_counter()
+        restored.sync(rfc_index)
+        load = time.perf_counter() - start
+
+        changed = max(rfc_index, key=lambda rfc: pathlib.Path(rfc.path).stat().st_size)
+        with open(changed.path, "a") as file:
+            file.write("\nAppended, to be reindexed.\n")
+        search_index.checked = float("-inf")
+        start = time.perf_counter()
+        search_index.sync(rfc_index)
+        update = time.perf_counter() - start
+
+        print(
+            f"{len(rfc_index)} RFCs, {corpus / 1e6:.1f} MB, "
+            f"{len(search_index.postings)} terms"
+        )
+        print(f"{'build s':>24}{build:>10.3f}")
+        print(f"{'load s':>24}{load:>10.3f}")
+        print(f"{'update 1 RFC s':>24}{update:>10.3f}")
+        print(f"{'index MB':>24}{path.stat().st_size / 1e6:>10.2f}")
+
+        queries = make_queries(search_index, args.queries, args.seed)
+        for name, samples in (
+            ("query", query_latency(search_index, queries)),
+            ("Search round trip", round_trips(rfc_index, search_index, queries)),
+        ):
+            p50, p99 = percentiles(samples)
+            print(f"{name + ' p50 ms':>24}{p50 * 1e3:>10.3f}")
+            print(f"{name + ' p99 ms':>24}{p99 * 1e3:>10.3f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import collections
+import multiprocessing
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import *
+
+from src.peer.client import register
+from src.server.server import PORT
+from src.server.shards import HashRing, Shard, make_shards
+from src.utils.http import SUCCESS_CODE, send_recv_http_request
+
+# Peers only register, so never serve on it.
+PEER_PORT = 1
+
+
+def start_rs(shards: list[Shard], replicate: bool) -> subprocess.Popen:
+    command = [sys.executable, "-m", "src.server.server", "--shards", str(len(shards))]
+    rs = subprocess.Popen(
+        command + (["--replicate"] if replicate else []), stdout=subprocess.DEVNULL
+    )
+    addresses = [shard.address for shard in shards]
+    addresses += [shard.follower for shard in shards if shard.follower is not None]
+
+    for address in addresses:
+        for _ in range(100):
+            if rs.poll() is not None:
+                raise RuntimeError("RS exited; is one already running?")
+            try:
+                socket.create_connection(address).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            rs.kill()
+            raise RuntimeError(f"Shard {address} did not start")
+
+    return rs
+
+
+def registrations(
+    shards: list[Shard],
+    name: str,
+    start: float,
+    deadline: float,
+    counts: collections.Counter,
+) -> None:
+    """Registers new peers, each with the shard its address hashes to, over one
+    connection per shard, from start until deadline."""
+    ring = HashRing(shards)
+    sockets = {shard.index: socket.create_connection(shard.address) for shard in shards}
+    time.sleep(max(0.0, start - time.time()))
+
+    i = 0
+    while time.time() < deadline:
+        hostname = f"{name}-{i}"
+        shard = ring.shard_for(hostname, PEER_PORT)
+        request = register(hostname, PEER_PORT)
+        if send_recv_http_request(request, sockets[shard.index]).status == SUCCESS_CODE:
+            counts[shard.index] += 1
+        i += 1
+
+    for shard_socket in sockets.values():
+        shard_socket.close()
+
+
+def generator(
+    shards: list[Shard],
+    index: int,
+    connections: int,
+    start: float,
+    deadline: float,
+    results: multiprocessing.Queue,
+) -> None:
+    """A load generating process, running connections registering threads."""
+    counts = [collections.Counter() for _ in range(connections)]
+    threads = [
+        threading.Thread(
+            target=registrations,
+            args=(shards, f"g{index}-c{i}", start, deadline, counts[i]),
+        )
+        for i in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results.put(sum(counts, collections.Counter()))
+
+
+def run(
+    count: int, replicate: bool, generators: int, connections: int, duration: float
+) -> tuple[float, list[int]]:
+    """Registrations per second across count shards, and how many each took."""
+    shards = make_shards(socket.gethostname(), PORT, count, replicate)
+    rs = start_rs(shards, replicate)
+
+    try:
+        results = multiprocessing.Queue()
+        # Generators connect, then start together.
+        start = time.time() + 0.5
+        deadline = start + duration
+        processes = [
+            multiprocessing.Process(
+                target=generator,
+                args=(shards, i, connections, start, deadline, results),
+            )
+            for i in range(generators)
+        ]
+        for process in processes:
+            process.start()
+
+        counts = collections.Counter()
+        for _ in processes:
+            counts += results.get()
+        for process in processes:
+            process.join()
+    finally:
+        rs.send_signal(signal.SIGINT)
+        rs.wait()
+
+    return sum(counts.values()) / duration, [counts[i] for i in range(count)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Registrations/s across RS shards")
+    parser.add_argument(
+        "--shards", default="1,2,4", help="comma separated shard counts to run"
+    )
+    parser.add_argument(
+        "--replicate", action="store_true", help="give each shard a follower"
+    )
+    parser.add_argument("--generators", type=int, default=4, help="processes")
+    parser.add_argument(
+        "--connections", type=int, default=4, help="per generator process"
+    )
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds")
+    args = parser.parse_args()
+
+    print(
+        f"{args.generators} generators x {args.connections} connections, "
+        f"{multiprocessing.cpu_count()} CPUs"
+        + (", replicated" if args.replicate else "")
+    )
+    print(f"{'shards':>8}{'regs/s':>10}{'speedup':>9}  per shard")
+
+    baseline = None
+    for count in map(int, args.shards.split(",")):
+        rate, per_shard = run(
+            count, args.replicate, args.generators, args.connections, args.duration
+        )
+        baseline = baseline or rate
+        print(
+            f"{count:>8}{rate:>10.0f}{rate / baseline:>9.2f}  {per_shard}", flush=True
+        )
+
+
+if __name__ == "__main__":
+    main()
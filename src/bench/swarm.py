@@ -0,0 +1,112 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import time
+from typing import *
+
+from src.bench.common import Link, StalledLink, proxy
+from src.peer.client import get_rfc
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, RFCIndex
+from src.peer.server import server
+from src.peer.swarm import swarm_get_rfc
+
+MB = 1 << 20
+RFC_NUMBER = 9000
+START_PORT = 42000
+OUT_DIR = pathlib.Path("out/")
+
+
+def start_peers(path: pathlib.Path, links: list[Link]) -> list[tuple[str, int]]:
+    """Starts a peer server holding the file per link, each behind a proxy over it,
+    returning the proxies' addresses."""
+    hostname = socket.gethostname()
+    holders = []
+
+    for i, link in enumerate(links):
+        rfc_index = RFCIndex([RFC(RFC_NUMBER, "bench", hostname, str(path))])
+        port = START_PORT + 2 * i
+        threading.Thread(
+            target=server, args=(hostname, port, rfc_index), daemon=True
+        ).start()
+
+        listener = socket.create_server((hostname, port + 1))
+        threading.Thread(
+            target=proxy, args=(listener, (hostname, port), link), daemon=True
+        ).start()
+
+        holders.append((hostname, port + 1))
+
+    time.sleep(0.5)
+    return holders
+
+
+def digest(path: pathlib.Path) -> str:
+    with path.open("rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Single-source vs swarm GetRFC")
+    parser.add_argument("--size", type=int, default=64, help="RFC size, in MB")
+    parser.add_argument(
+        "--rates",
+        default="20,20,20,5",
+        help="comma-separated per-peer upload rates in MB/s; 0 is unlimited",
+    )
+    parser.add_argument("--range-size", type=int, default=1, help="range size, in MB")
+    parser.add_argument(
+        "--stall",
+        type=int,
+        default=2,
+        help="MB after which an extra, otherwise unlimited, peer stops sending",
+    )
+    args = parser.parse_args()
+
+    rates = [float(rate) for rate in args.rates.split(",")]
+    links = [Link(rate * MB) for rate in rates]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp).joinpath(f"rfc{RFC_NUMBER}.txt")
+        path.write_bytes(os.urandom(args.size * MB))
+        expected = digest(path)
+
+        *holders, stalled = start_peers(path, links + [StalledLink(0, args.stall * MB)])
+        out_filepath = OUT_DIR.joinpath(path.name)
+        results = {}
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            hostname, port = holders[0]
+            with socket.create_connection((hostname, port)) as peer_socket:
+                start = time.perf_counter()
+                get_rfc(hostname, RFC_NUMBER, peer_socket)
+                results["single"] = time.perf_counter() - start
+            assert digest(out_filepath) == expected
+            out_filepath.unlink()
+
+            for name, peers in (("swarm", holders), ("stalled", holders + [stalled])):
+                pool = ConnectionPool()
+                start = time.perf_counter()
+                swarm_get_rfc(
+                    RFC_NUMBER, peers, pool, OUT_DIR, range_size=args.range_size * MB
+                )
+                results[name] = time.perf_counter() - start
+                pool.close()
+                assert digest(out_filepath) == expected
+                out_filepath.unlink()
+
+    print(f"{len(rates)} peers at {args.rates} MB/s, {args.size} MB RFC")
+    print(f"stalled: swarm with another peer, which stops after {args.stall} MB")
+    for name, elapsed in results.items():
+        print(f"{name:>8}: {elapsed:8.2f}s {args.size / elapsed:8.1f}MB/s")
+    print(f" speedup: {results['single'] / results['swarm']:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
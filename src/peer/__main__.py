@@ -1,3 +1,4 @@
+import logging
 import pathlib
 import random
 import socket
@@ -5,27 +6,50 @@ import threading
 import time
 
 from src.peer.client import client
-from src.peer.rfc import RFC
+from src.peer.dht import DHTNode
+from src.peer.gossip import GossipNode
+from src.peer.indexer import Indexer
+from src.peer.rfc import RFCIndex
 from src.peer.server import P2PCommands, server
-from src.server.server import P2ServerCommands
-from src.utils.utils import timethat
+from src.server.server import PORT, P2ServerCommands, ServerMode
+from src.server.shards import make_shards
 
-RFC_TOTAL = 500
 HOSTNAME = socket.gethostname()
 START_PORT = 1234
 BASE_DIR = pathlib.Path("data/")
+SERVER_MODE = ServerMode.threaded
+# Have every peer join a DHT, through which RFCs can be located without the RS.
+DHT_MODE = False
+# Have every peer gossip the global index, rather than RFCQuery every other peer.
+GOSSIP_MODE = False
+# Echo every request and response sent.
+VERBOSE = True
+# The RS's layout, as given by its --shards and --replicate, for peers to find it by
+# while shard 0 is down.
+RS_SHARDS = 1
+RS_REPLICATE = False
 
 
 def create_peer(
     hostname: str,
     port: int,
     commands: list[tuple[str, dict]] = None,
-    rfc_index: set[RFC] = None,
+    rfc_index: RFCIndex = None,
+    mode: ServerMode = SERVER_MODE,
 ) -> tuple[threading.Thread, ...]:
+    dht = DHTNode(hostname, port) if DHT_MODE else None
+    gossip = GossipNode(hostname, port) if GOSSIP_MODE else None
     server_thread = threading.Thread(
-        target=server, args=(hostname, port, rfc_index), daemon=True
+        target=server,
+        args=(hostname, port, rfc_index, mode),
+        kwargs={"dht": dht, "gossip": gossip},
+        daemon=True,
+    )
+    client_thread = threading.Thread(
+        target=client,
+        args=(hostname, port, commands, dht, gossip),
+        kwargs={"servers": make_shards(hostname, PORT, RS_SHARDS, RS_REPLICATE)},
     )
-    client_thread = threading.Thread(target=client, args=(hostname, port, commands))
 
     return server_thread, client_thread
 
@@ -37,18 +61,29 @@ def make_get_rfc(hostname: str, port: int, rfc_number: int):
     )
 
 
+def make_get_rfcs(
+    hostname: str, port: int, rfc_numbers: list[int], pipeline: bool = False
+):
+    return (
+        P2PCommands.getrfc,
+        {
+            "hostname": hostname,
+            "port": port,
+            "rfc_numbers": rfc_numbers,
+            "pipeline": pipeline,
+        },
+    )
+
+
 def make_rfc_index(
     hostname: str, base_dir: pathlib.Path, count: int, randomize: bool = True
 ):
-    numbers = (
-        list(range(1, count + 1))
-        if not randomize
-        else random.sample(range(1, RFC_TOTAL + 1), count)
-    )
+    """count of the RFCs found in base_dir: the lowest numbered, or a random
+    sample."""
+    rfcs = sorted(Indexer(base_dir, hostname).index(), key=lambda rfc: rfc.number)
+    rfcs = random.sample(rfcs, count) if randomize else rfcs[:count]
 
-    return set(
-        [RFC(i, f"rfc{i}", hostname, base_dir.joinpath(f"rfc{i}.txt")) for i in numbers]
-    )
+    return RFCIndex(rfcs)
 
 
 def task_1():
@@ -144,7 +179,10 @@ def simple_test():
     A_commands = [
         (P2ServerCommands.pquery, {}),
         make_get_rfc(HOSTNAME, B_port, 1),
+        (P2PCommands.search, {"hostname": HOSTNAME, "port": B_port, "query": "hey"}),
         (P2ServerCommands.pquery, {}),
+        (P2ServerCommands.stats, {}),
+        (P2PCommands.stats, {"hostname": HOSTNAME, "port": B_port, "prometheus": True}),
     ]
 
     B_commands = [(P2ServerCommands.leave, {})]
@@ -170,6 +208,10 @@ def simple_test():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG if VERBOSE else logging.INFO, format="%(message)s"
+    )
+
     simple_test()
     # task_1()
     # task_2()
@@ -0,0 +1,125 @@
+import os
+import pathlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import *
+
+from src.utils.http import FileResponse, FramedResponse, Response, frame
+
+# Bytes of responses held in memory, across every entry.
+CACHE_BUDGET = 64 << 20
+# Files larger than this share of the budget are streamed from disk instead, so that
+# one large RFC can't flush every hot small one.
+MAX_ENTRY_SHARE = 8
+# How long, in seconds, an entry is served before its file is checked for changes.
+REVALIDATE_AFTER = 1.0
+
+
+@dataclass
+class Entry:
+    response: FramedResponse
+    path: pathlib.Path
+    stamp: tuple[int, int]
+    checked: float
+
+
+def stamp(stat: os.stat_result) -> tuple[int, int]:
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ResponseCache:
+    """Ready to send responses, framed, in memory, least recently used evicted first
+    once their total size exceeds budget. Each entry is stamped with the mtime and
+    size of the file it was read from, and is dropped once they change; files are
+    checked at most every REVALIDATE_AFTER seconds, so a hit is usually just a dict
+    lookup."""
+
+    def __init__(self, budget: int = CACHE_BUDGET) -> None:
+        self.budget = budget
+        self.entries: OrderedDict[Hashable, Entry] = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[FramedResponse]:
+        with self.lock:
+            if (entry := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None and not self.fresh(entry):
+            self.discard(key, entry)
+            entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return entry.response
+
+    def fresh(self, entry: Entry) -> bool:
+        now = time.monotonic()
+        if now - entry.checked < REVALIDATE_AFTER:
+            return True
+
+        try:
+            current = stamp(entry.path.stat())
+        except OSError:
+            return False
+
+        entry.checked = now
+        return current == entry.stamp
+
+    def fill(
+        self,
+        key: Hashable,
+        path: pathlib.Path,
+        stat: os.stat_result,
+        responses: list[Response],
+    ) -> list[Response]:
+        """Caches responses, read from path, whose stat was taken before making them,
+        if they fit; returns what to send, either way."""
+        size = sum(
+            r.path.stat().st_size if isinstance(r, FileResponse) else len(r)
+            for r in responses
+        )
+        if size > self.budget // MAX_ENTRY_SHARE:
+            return responses
+
+        response = frame(responses)
+        entry = Entry(response, path, stamp(stat), time.monotonic())
+
+        with self.lock:
+            if (old := self.entries.pop(key, None)) is not None:
+                self.size -= len(old.response.data)
+            self.entries[key] = entry
+            self.size += len(response.data)
+            self.evict()
+
+        return [response]
+
+    def discard(self, key: Hashable, entry: Entry) -> None:
+        with self.lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+                self.size -= len(entry.response.data)
+
+    def evict(self) -> None:
+        while self.size > self.budget and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= len(entry.response.data)
+            self.evictions += 1
+
+    def resize(self, budget: int) -> None:
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
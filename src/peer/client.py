@@ -1,25 +1,62 @@
+import hashlib
+import itertools
+import os
 import pathlib
 import pprint
+import random
 import socket
 import sys
 import threading
+from contextvars import copy_context
 from typing import *
 import time
 
+from src.peer.dht import DHTNode
+from src.peer.gossip import GossipNode
+from src.peer.holders import HolderTable, Transfer
 from src.peer.peer import Peer, load_peer, load_peers
-from src.peer.rfc import RFC, load_rfc, load_rfc_index
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import (
+    RFC,
+    Holder,
+    RFCIndex,
+    load_digest,
+    load_rfc,
+    load_rfc_delta,
+    load_rfc_index,
+)
+from src.peer.scatter import DEADLINE, Match, Merger, Scatter
+from src.peer.search import SEARCH_LIMIT, load_hits
 from src.peer.server import P2PCommands
+from src.peer.swarm import swarm_get_rfc
 from src.server.server import PORT, TIMEOUT, P2ServerCommands
+from src.server.shards import Address, HashRing, Shard, load_shards, make_shards
 from src.utils.http import (
     FAIL_RESPONSE,
+    PROTOCOL,
     SUCCESS_CODE,
     SUCCESS_RESPONSE,
     HTTPResponse,
+    Protocol,
     http_request,
     make_request,
+    parse_response,
+    recv_file_response,
     send_recv_http_request,
+    use_protocol,
+)
+from src.utils.digest import (
+    DIGEST_CHUNK_SIZE,
+    Digest,
+    VerifyingWriter,
+    claim_part,
+    new_part,
+    release_part,
+    verify_prefix,
 )
-from src.utils.utils import recv_message, send_message, timethat
+from src.utils.encoding import ACCEPT_ENCODING, ACCEPTED
+from src.utils.metrics import METRICS, PROMETHEUS_TYPE
+from src.utils.utils import recv_message, send_message
 
 
 @http_request
@@ -33,8 +70,10 @@ def leave(hostname: str, peer: Peer):
 
 
 @http_request
-def p_query(hostname: str, peer: Peer):
-    return P2ServerCommands.pquery, hostname, {"Peer-Cookie": peer.cookie}
+def p_query(hostname: str, peer: Optional[Peer] = None):
+    # Peers registered with another shard leave out the cookie, which it wouldn't know.
+    headers = {} if peer is None else {"Peer-Cookie": peer.cookie}
+    return P2ServerCommands.pquery, hostname, headers
 
 
 @http_request
@@ -43,61 +82,384 @@ def keep_alive(hostname: str, peer: Peer):
 
 
 @http_request
-def rfc_query(hostname: str):
-    return P2PCommands.rfcquery, hostname
+def shard_map(hostname: str):
+    return P2ServerCommands.shards, hostname
+
+
+def stats_headers(prometheus: bool) -> dict[str, str]:
+    return {"Accept": PROMETHEUS_TYPE} if prometheus else {}
+
+
+@http_request
+def server_stats(hostname: str, prometheus: bool = False):
+    return P2ServerCommands.stats, hostname, stats_headers(prometheus)
 
 
-@timethat
-def get_rfc(hostname: str, rfc_number: int, peer_socket: socket.socket):
-    @http_request
-    def _get_rfc():
-        return P2PCommands.getrfc, hostname, {"RFC-Number": rfc_number}
+@http_request
+def peer_stats(hostname: str, prometheus: bool = False):
+    return P2PCommands.stats, hostname, stats_headers(prometheus)
+
+
+@http_request
+def rfc_query(hostname: str, version: Optional[str] = None):
+    headers = {ACCEPT_ENCODING: ACCEPTED}
+    if version is not None:
+        headers["Index-Version"] = version
+    return P2PCommands.rfcquery, hostname, headers
+
+
+def rfc_matches(
+    rfc: RFC, rfc_number: Optional[int] = None, title: Optional[str] = None
+) -> bool:
+    """Whether rfc is numbered rfc_number, and has title within its own, ignoring
+    case; either left out matches anything."""
+    return (rfc_number is None or rfc.number == rfc_number) and (
+        title is None or title.lower() in rfc.title.lower()
+    )
+
+
+@http_request
+def search(hostname: str, query: str, limit: int = SEARCH_LIMIT):
+    # Queries travel in a header, so are reduced to a single line.
+    headers = {
+        ACCEPT_ENCODING: ACCEPTED,
+        "Query": " ".join(query.split()),
+        "Limit": limit,
+    }
+    return P2PCommands.search, hostname, headers
 
-    request = _get_rfc()
-    response = send_recv_http_request(request, peer_socket)
 
-    if response.status == SUCCESS_CODE:
-        rfc: RFC = load_rfc(response)
-        filepath = pathlib.Path(rfc.path)
-        out_filepath = pathlib.Path("out/").joinpath(pathlib.Path(filepath.name))
+OUT_DIR = pathlib.Path("out/")
+PIPELINE_DEPTH = 16
+MAX_ATTEMPTS = 3
+
+T = TypeVar("T")
+
+request_ids = itertools.count()
+
+
+@http_request
+def get_rfc_request(
+    hostname: str,
+    rfc_numbers: Iterable[int],
+    request_id: Optional[int] = None,
+    offset: int = 0,
+):
+    headers = {
+        "RFC-Number": ", ".join(map(str, rfc_numbers)),
+        ACCEPT_ENCODING: ACCEPTED,
+    }
+    if request_id is not None:
+        headers["Request-ID"] = request_id
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+    return P2PCommands.getrfc, hostname, headers
+
+
+def resume_offset(part: pathlib.Path, chunk_size: int = DIGEST_CHUNK_SIZE) -> int:
+    """Where to resume a partial download from: the end of the last whole chunk in its
+    .part file, which holds only verified chunks."""
+    try:
+        size = part.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+    return size // chunk_size * chunk_size
+
+
+def recv_rfc(
+    peer_socket: socket.socket,
+    out_dir: pathlib.Path = OUT_DIR,
+    offset: int = 0,
+    transfer: Optional[Transfer] = None,
+    part: Optional[pathlib.Path] = None,
+) -> tuple[HTTPResponse, Optional[RFC]]:
+    """Receives one GetRFC result: the RFC's metadata, then its body, which is
+    written into out_dir; or a lone failure response. The body goes into a .part file
+    first, checked chunk by chunk against the digest sent with the metadata, and is
+    moved into place once whole. If offset is given, the body is the rest of the file
+    from offset on, following the start of part, which is verified first; otherwise,
+    the download gets a part of its own. A download that fails leaves its verified
+    chunks behind, to resume from. The times the metadata and the body arrived are
+    noted in transfer, if given."""
+    response = parse_response(recv_message(peer_socket))
+    if transfer is not None:
+        transfer.first_byte = time.perf_counter()
+
+    if response.status != SUCCESS_CODE:
+        return response, None
+
+    rfc: RFC = load_rfc(response)
+    digest = load_digest(response)
+    out_filepath = out_dir.joinpath(pathlib.Path(rfc.path).name)
+
+    if own := part is None:
+        part = new_part(out_dir, rfc.number)
+
+    try:
+        size = recv_part(peer_socket, rfc, digest, part, offset)
+    except BaseException:
+        if own:
+            release_part(part, out_dir, rfc.number)
+        raise
+
+    part.replace(out_filepath)
+
+    if transfer is not None:
+        transfer.finished = time.perf_counter()
+        transfer.size = size - offset
+
+    return response, rfc
+
+
+def recv_part(
+    peer_socket: socket.socket,
+    rfc: RFC,
+    digest: Optional[Digest],
+    part: pathlib.Path,
+    offset: int,
+) -> int:
+    """Receives an RFC's body into part, from offset on; returns the part's size."""
+    # Peers that send no digest are trusted, as they were before digests.
+    whole = hashlib.new(digest.algorithm) if digest is not None else None
+    verified = offset
+    if digest is not None and offset > 0:
+        verified = verify_prefix(part, digest, offset, whole)
+
+    with part.open("r+b") as file:
+        file.truncate(verified)
+        file.seek(verified)
+
+        if verified < offset:
+            with open(os.devnull, "wb") as sink:
+                recv_file_response(peer_socket, sink)
+            raise ValueError(f"Partial download of RFC {rfc.number} is stale")
+
+        if digest is None:
+            recv_file_response(peer_socket, file)
+            return file.tell()
+
+        writer = VerifyingWriter(file, digest, offset, whole)
+        try:
+            recv_file_response(peer_socket, writer)
+            writer.finish()
+        finally:
+            file.truncate(writer.offset)
+
+    if writer.offset != digest.size or whole.hexdigest() != digest.value:
+        part.unlink()
+        raise ValueError(f"RFC {rfc.number} failed verification")
+
+    return writer.offset
+
+
+@METRICS.timed("p2pdi_client_getrfc_seconds", "Time taken to fetch RFCs", mode="single")
+def get_rfc(
+    hostname: str,
+    rfc_number: int,
+    peer_socket: socket.socket,
+    out_dir: pathlib.Path = OUT_DIR,
+    transfer: Optional[Transfer] = None,
+):
+    """Fetches an RFC, picking up from where an earlier, failed, download of it left
+    off, if any."""
+    part = claim_part(out_dir, rfc_number)
+    offset = resume_offset(part)
+
+    try:
+        if transfer is not None:
+            transfer.started = time.perf_counter()
+        send_message(
+            get_rfc_request(hostname, [rfc_number], offset=offset), peer_socket
+        )
+        _, rfc = recv_rfc(peer_socket, out_dir, offset, transfer, part)
+    except BaseException:
+        release_part(part, out_dir, rfc_number)
+        raise
+
+    if rfc is None:
+        part.unlink(missing_ok=True)
+        if offset > 0:
+            # The RFC may have shrunk since; start over.
+            raise ValueError(f"Could not resume RFC {rfc_number}")
+
+    return SUCCESS_RESPONSE() if rfc is not None else FAIL_RESPONSE()
+
+
+def with_retries(attempt: Callable[[], T], attempts: int = MAX_ATTEMPTS) -> T:
+    """Returns the result of the first of up to attempts calls to attempt that doesn't
+    fail with a connection or verification error."""
+    for i in range(attempts):
+        try:
+            return attempt()
+        except (OSError, ValueError) as e:
+            if i == attempts - 1:
+                raise
+            print("Peer: ", e, file=sys.stderr)
+
+
+@METRICS.timed("p2pdi_client_getrfc_seconds", mode="batch")
+def get_rfcs(
+    hostname: str, rfc_numbers: list[int], peer_socket: socket.socket
+) -> list[Optional[RFC]]:
+    """Fetches several RFCs with a single batched request."""
+    send_message(get_rfc_request(hostname, rfc_numbers), peer_socket)
+    return [recv_rfc(peer_socket)[1] for _ in rfc_numbers]
+
+
+@METRICS.timed("p2pdi_client_getrfc_seconds", mode="pipeline")
+def pipeline_get_rfcs(
+    hostname: str,
+    rfc_numbers: list[int],
+    peer_socket: socket.socket,
+    depth: int = PIPELINE_DEPTH,
+) -> dict[int, Optional[RFC]]:
+    """Fetches several RFCs over one connection, with up to depth requests in flight
+    at once. Responses are matched to their requests by Request-ID."""
+    pending: dict[int, int] = {}
+    in_flight = threading.Semaphore(depth)
+    results: dict[int, Optional[RFC]] = {}
+
+    def send_requests():
+        try:
+            for rfc_number in rfc_numbers:
+                in_flight.acquire()
+                request_id = next(request_ids)
+                pending[request_id] = rfc_number
+                send_message(
+                    get_rfc_request(hostname, [rfc_number], request_id), peer_socket
+                )
+        except OSError:
+            peer_socket.shutdown(socket.SHUT_RDWR)
+
+    # The sender speaks whatever protocol this thread does.
+    sender = threading.Thread(
+        target=copy_context().run, args=(send_requests,), daemon=True
+    )
+    sender.start()
 
-        response = HTTPResponse(recv_message(peer_socket))
+    for _ in rfc_numbers:
+        response, rfc = recv_rfc(peer_socket)
+        request_id = int(response.getheader("Request-ID"))
+        results[pending.pop(request_id)] = rfc
+        in_flight.release()
 
-        with out_filepath.open("wb") as file:
-            file.write(response.content)
+    sender.join()
 
-        return SUCCESS_RESPONSE()
-    else:
-        return FAIL_RESPONSE()
+    return results
 
 
 Command = P2PCommands | P2ServerCommands
 
 
+def connect_shard(shard: Shard) -> socket.socket:
+    """A connection to shard, or, if it's down, to its follower."""
+    try:
+        return socket.create_connection(shard.address, TIMEOUT)
+    except OSError:
+        if shard.follower is None:
+            raise
+        return socket.create_connection(shard.follower, TIMEOUT)
+
+
 def client_handler(
     hostname: str,
     port: int,
     commands: list[tuple[Command, dict]],
     server_socket: socket.socket,
+    shards: Optional[list[Shard]] = None,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
 ) -> None:
-    rfc_index: set[RFC] = set()
+    """Runs commands, as the peer at hostname and port. server_socket is connected to
+    the peer's home shard, the one of shards its address hashes to; with no shards
+    given, the RS is taken to be unsharded. Given the peer's DHT node, joins the DHT
+    through peers the RS knows of, and locates RFCs through it. Given its gossip
+    node, gossips with those peers, and answers RFCQueries from the gossiped index.
+    GetRFCs naming no holder download from whichever holder_table expects to be
+    quickest."""
+    rfc_index = RFCIndex() if gossip is None else gossip.view
+    pool = ConnectionPool()
+    holder_table = HolderTable()
     me: Peer = None
+    server_protocol = Protocol.negotiating
+    active_peers: list[Peer] = []
+
+    shards = make_shards(hostname, PORT, 1) if shards is None else shards
+    home = HashRing(shards).shard_for(hostname, port)
+    failed_over = False
+    # The keep-alive timer talks to the RS from a thread of its own.
+    server_lock = threading.Lock()
+
+    def fail_over() -> bool:
+        """Switches to the home shard's follower, if it has one, and hasn't already;
+        registrations are replicated, so this peer's cookie holds there too."""
+        nonlocal server_socket, server_protocol, failed_over
+
+        if failed_over or home.follower is None:
+            return False
+
+        failed_over = True
+        server_socket.close()
+        server_socket = socket.create_connection(home.follower, TIMEOUT)
+        server_socket.settimeout(TIMEOUT)
+        server_protocol = Protocol.negotiating
+        print(f"Failed over to follower: {home.follower}")
+        return True
+
+    def query_shard(address: Holder, shard_socket: socket.socket) -> list[Peer]:
+        response = send_recv_http_request(p_query(hostname), shard_socket)
+        if response.status != SUCCESS_CODE:
+            raise ValueError(f"PQuery failed with {response.status}")
+        return load_peers(response)
+
+    def other_shards_peers() -> list[Peer]:
+        """The active peers registered with every shard but the home one, asked all
+        at once; a shard that's down is asked through its follower."""
+        others = {shard.address: shard for shard in shards if shard is not home}
+        peers, retries = [], []
+
+        for reply in Scatter(pool, others, query_shard):
+            if reply.error is None:
+                peers += reply.value
+            elif (follower := others[reply.holder].follower) is not None:
+                retries.append(follower)
+            else:
+                print("PQuery: ", reply.holder, reply.error, file=sys.stderr)
+
+        for reply in Scatter(pool, retries, query_shard):
+            if reply.error is None:
+                peers += reply.value
+            else:
+                print("PQuery: ", reply.holder, reply.error, file=sys.stderr)
+
+        return peers
 
     def peer_to_server(command: P2ServerCommands, args: dict):
-        nonlocal me
+        nonlocal me, server_protocol, active_peers
 
-        request = None
-        match command:
-            case P2ServerCommands.register:
-                request = register(hostname, port)
-            case P2ServerCommands.leave:
-                request = leave(hostname, me)
-            case P2ServerCommands.pquery:
-                request = p_query(hostname, me)
-            case P2ServerCommands.keepalive:
-                request = keep_alive(hostname, me)
-
-        response = send_recv_http_request(request, server_socket)
+        with use_protocol(server_protocol):
+            request = None
+            match command:
+                case P2ServerCommands.register:
+                    request = register(hostname, port)
+                case P2ServerCommands.leave:
+                    request = leave(hostname, me)
+                case P2ServerCommands.pquery:
+                    request = p_query(hostname, me)
+                case P2ServerCommands.keepalive:
+                    request = keep_alive(hostname, me)
+                case P2ServerCommands.stats:
+                    request = server_stats(hostname, args.get("prometheus", False))
+
+            with server_lock:
+                try:
+                    response = send_recv_http_request(request, server_socket)
+                except OSError:
+                    if not fail_over():
+                        raise
+                    response = send_recv_http_request(request, server_socket)
+                server_protocol = PROTOCOL.get()
 
         if response.status != 200:
             return None
@@ -107,50 +469,284 @@ def client_handler(
                 me = load_peer(response)
                 pprint.pprint(me)
             case P2ServerCommands.pquery:
-                active_peers = load_peers(response)
+                # Cookies are unique across shards, each handing out its own.
+                peers = load_peers(response)
+                if len(shards) > 1:
+                    peers += other_shards_peers()
+                active_peers = list({peer.cookie: peer for peer in peers}.values())
                 pprint.pprint(active_peers)
+            case P2ServerCommands.stats:
+                print(response.content.decode())
 
         return response
 
+    def fetch(holder: Holder, rfc_number: int, peer_socket: socket.socket) -> bool:
+        """Fetches an RFC from holder, feeding how it went into holder_table; returns
+        whether holder had it."""
+        transfer = Transfer()
+        try:
+            get_rfc(holder[0], rfc_number, peer_socket, transfer=transfer)
+        except (OSError, ValueError):
+            holder_table.fail(holder)
+            raise
+
+        if transfer.finished is None:
+            holder_table.fail(holder)
+            return False
+
+        holder_table.record(holder, transfer)
+        return True
+
+    def sync_index(holder: Holder, response: HTTPResponse) -> None:
+        version = response.getheader("Index-Version")
+
+        if response.getheader("Index-Sync") == "delta":
+            rfcs, removed = load_rfc_delta(response)
+            rfc_index.sync(holder, version, rfcs, removed, full=False)
+        else:
+            rfcs = load_rfc_index(response)
+            rfc_index.sync(holder, version, rfcs)
+
     def peer_to_peer(command: P2PCommands, args: dict):
         peer_hostname, peer_port = args["hostname"], args["port"]
+        holder = (peer_hostname, peer_port)
 
-        with socket.create_connection((peer_hostname, peer_port)) as peer_socket:
+        def exchange(peer_socket: socket.socket):
             request = None
             match command:
                 case P2PCommands.rfcquery:
-                    request = rfc_query(peer_hostname)
+                    request = rfc_query(peer_hostname, rfc_index.versions.get(holder))
+                case P2PCommands.stats:
+                    request = peer_stats(peer_hostname, args.get("prometheus", False))
+                case P2PCommands.search:
+                    request = search(
+                        peer_hostname, args["query"], args.get("limit", SEARCH_LIMIT)
+                    )
+                case P2PCommands.getrfc if args.get("pipeline", False):
+                    return pipeline_get_rfcs(
+                        peer_hostname, args["rfc_numbers"], peer_socket
+                    )
+                case P2PCommands.getrfc if "rfc_numbers" in args:
+                    return get_rfcs(peer_hostname, args["rfc_numbers"], peer_socket)
                 case P2PCommands.getrfc:
-                    request = get_rfc(peer_hostname, args["rfc_number"], peer_socket)
-                    return
+                    return fetch(holder, args["rfc_number"], peer_socket)
 
-            response = send_recv_http_request(request, peer_socket)
+            return send_recv_http_request(request, peer_socket)
 
-            if response.status != 200:
-                return None
+        if command is P2PCommands.getrfc and "rfc_number" in args:
+            # Each attempt resumes from what the last one verified.
+            response = with_retries(lambda: pool.request(holder, exchange))
+        else:
+            response = pool.request(holder, exchange)
 
-            match command:
-                case P2PCommands.rfcquery:
-                    rfcs = load_rfc_index(response)
-                    rfc_index.update(rfcs)
-                    pprint.pprint(rfc_index)
-            return response
+        if command is P2PCommands.getrfc or response.status != 200:
+            return None
+
+        match command:
+            case P2PCommands.rfcquery:
+                sync_index(holder, response)
+                pprint.pprint(rfc_index)
+            case P2PCommands.stats:
+                print(response.content.decode())
+            case P2PCommands.search:
+                pprint.pprint(load_hits(response))
+        return response
+
+    def query_peer(holder: Holder, peer_socket: socket.socket, args: dict):
+        request = rfc_query(holder[0], rfc_index.versions.get(holder))
+        response = send_recv_http_request(request, peer_socket)
+        if response.status != SUCCESS_CODE:
+            raise ValueError(f"RFCQuery failed with {response.status}")
+
+        sync_index(holder, response)
+
+        with rfc_index.lock:
+            rfcs = [
+                rfc_index.remote[n][holder] for n in rfc_index.holdings.get(holder, ())
+            ]
+        return [
+            Match(rfc.number, rfc.title, {holder})
+            for rfc in rfcs
+            if rfc_matches(rfc, args.get("rfc_number"), args.get("title"))
+        ]
+
+    def search_peer(holder: Holder, peer_socket: socket.socket, args: dict):
+        request = search(holder[0], args["query"], args.get("limit", SEARCH_LIMIT))
+        response = send_recv_http_request(request, peer_socket)
+        if response.status != SUCCESS_CODE:
+            raise ValueError(f"Search failed with {response.status}")
+
+        return [
+            Match(hit.number, hit.title, {holder}, hit.score, hit.snippet)
+            for hit in load_hits(response)
+        ]
+
+    def scatter(command: P2PCommands, args: dict) -> list[Match]:
+        """Asks every other active peer at once: with a Search for args' query, or an
+        RFCQuery, filtered to args' RFC number or title substring, if any. Each peer's
+        matches are printed as they arrive, then all of them, merged. With "first"
+        set, stops at the first peer with a match."""
+        response = peer_to_server(P2ServerCommands.pquery, {})
+        holders = [
+            (p.hostname, p.port)
+            for p in ([] if response is None else active_peers)
+            if (p.hostname, p.port) != (hostname, port)
+        ]
+
+        match command:
+            case P2PCommands.search:
+                exchange = lambda holder, s: search_peer(holder, s, args)
+            case _:
+                exchange = lambda holder, s: query_peer(holder, s, args)
+
+        merger = Merger()
+        for reply in Scatter(pool, holders, exchange, args.get("deadline", DEADLINE)):
+            if reply.error is not None:
+                print("Scatter: ", reply.holder, reply.error, file=sys.stderr)
+                continue
+
+            print(f"{reply.holder} answered in {reply.elapsed * 1000:.1f} ms")
+            pprint.pprint(reply.value)
+            merger.add(reply.value)
+
+            if args.get("first", False) and merger.matches:
+                break
+
+        matches = merger.ranked(args.get("limit"))
+        pprint.pprint(matches)
+        return matches
+
+    def join_dht() -> None:
+        response = peer_to_server(P2ServerCommands.pquery, {})
+        peers = [] if response is None else active_peers
+        bootstraps = [(p.hostname, p.port) for p in peers]
+        random.shuffle(bootstraps)
+
+        if dht.join(bootstraps):
+            print(f"Joined DHT with {len(dht.table)} contacts")
+        else:
+            print("Started a new DHT")
+
+    def join_gossip() -> None:
+        response = peer_to_server(P2ServerCommands.pquery, {})
+        peers = [] if response is None else active_peers
+        gossip.join((p.hostname, p.port) for p in peers)
+
+    def gossiped(args: dict) -> list[Match]:
+        """RFCQuery's matches, as scatter's, from the gossiped index, without asking
+        any peer; until this peer has gossiped with any, they're scattered."""
+        if not rfc_index.versions.keys() - {(hostname, port)}:
+            return scatter(P2PCommands.rfcquery, args)
+
+        merger = Merger()
+        with rfc_index.lock:
+            for number, holders in rfc_index.remote.items():
+                holders = {
+                    h: rfc for h, rfc in holders.items() if h != (hostname, port)
+                }
+                if not holders:
+                    continue
+
+                rfc = next(iter(holders.values()))
+                if rfc_matches(rfc, args.get("rfc_number"), args.get("title")):
+                    merger.add([Match(number, rfc.title, set(holders))])
+
+        matches = merger.ranked(args.get("limit"))
+        pprint.pprint(matches)
+        return matches
+
+    def locate(args: dict) -> set[Holder]:
+        """The holders of an RFC, found through the DHT, in O(log N) messages."""
+        lookup = dht.locate(args["rfc_number"])
+        print(
+            f"Located RFC {args['rfc_number']} in {lookup.rounds} rounds, "
+            f"{lookup.messages} messages"
+        )
+        pprint.pprint(lookup.holders)
+        return lookup.holders
+
+    def best_get(args: dict) -> bool:
+        """Downloads an RFC from whichever holder of it, known to the index, or found
+        through the DHT, holder_table expects to be quickest, now and then exploring
+        another instead; on failure, tries the next best."""
+        rfc_number = args["rfc_number"]
+        holders = rfc_index.holders(rfc_number)
+        if dht is not None:
+            holders |= dht.locate(rfc_number).holders
+        holders.discard((hostname, port))
+
+        ranked, exploring = holder_table.ranked(holders)
+        for holder in ranked[:MAX_ATTEMPTS]:
+            choice = "explore" if exploring else "best"
+            METRICS.counter(
+                "p2pdi_client_holder_choices_total", "Holders chosen", choice=choice
+            ).inc()
+            print(f"Getting RFC {rfc_number} from {holder} ({choice})")
+
+            try:
+                if pool.request(holder, lambda s: fetch(holder, rfc_number, s)):
+                    return True
+            except (OSError, ValueError) as e:
+                print("Peer: ", holder, e, file=sys.stderr)
+            exploring = False
+
+        print(f"No holder of RFC {rfc_number} to get it from", file=sys.stderr)
+        return False
+
+    def swarm_get(args: dict):
+        """Downloads an RFC from every holder of it known to the index, or found
+        through the DHT, at once."""
+        rfc_number = args["rfc_number"]
+        holders = rfc_index.holders(rfc_number)
+
+        if dht is not None:
+            holders |= dht.locate(rfc_number).holders
+
+        if "hostname" in args:
+            holders.add((args["hostname"], args["port"]))
+
+        return swarm_get_rfc(rfc_number, holders, pool)
 
     def execute_command(command: P2ServerCommands | P2PCommands, args: dict = None):
+        args = {} if args is None else args
         match command:
             case (
                 P2ServerCommands.register
                 | P2ServerCommands.leave
                 | P2ServerCommands.pquery
                 | P2ServerCommands.keepalive
+                | P2ServerCommands.stats
             ):
                 return peer_to_server(command, args)
-            case P2PCommands.rfcquery | P2PCommands.getrfc:
+            case P2PCommands.getrfc if args.get("swarm", False):
+                return swarm_get(args)
+            case P2PCommands.getrfc if "rfc_number" in args and "hostname" not in args:
+                return best_get(args)
+            case P2PCommands.rfcquery if (
+                dht is not None and "rfc_number" in args and "hostname" not in args
+            ):
+                return locate(args)
+            case P2PCommands.rfcquery if gossip is not None and "hostname" not in args:
+                return gossiped(args)
+            case P2PCommands.rfcquery | P2PCommands.search if "hostname" not in args:
+                return scatter(command, args)
+            case (
+                P2PCommands.rfcquery
+                | P2PCommands.getrfc
+                | P2PCommands.stats
+                | P2PCommands.search
+            ):
                 return peer_to_peer(command, args)
 
     execute_command(P2ServerCommands.register)
     execute_command(P2PCommands.rfcquery, {"hostname": hostname, "port": port})
 
+    if dht is not None and not dht.joined.is_set():
+        join_dht()
+
+    if gossip is not None:
+        join_gossip()
+
     keep_alive_thread = threading.Timer(
         TIMEOUT, execute_command, (P2ServerCommands.keepalive,)
     )
@@ -162,22 +758,78 @@ def client_handler(
             execute_command(command, args)
 
     keep_alive_thread.cancel()
-
-
-def client(hostname: str, port: int, commands: list[tuple[str, dict]] = None):
-    server_address = (hostname, PORT)
+    pool.close()
+    server_socket.close()
+
+
+def bootstrap_shards(
+    hostname: str, servers: list[Shard]
+) -> tuple[list[Shard], Address, socket.socket]:
+    """The shard map, from the first of servers, or their followers, to answer, with
+    that server's address, and a connection to it. Every shard and follower knows the
+    map, so the RS can be bootstrapped from while shard 0 is down."""
+    addresses = [
+        address
+        for server in servers
+        for address in (server.address, server.follower)
+        if address is not None
+    ]
+
+    for address in addresses:
+        try:
+            server_socket = socket.create_connection(address, TIMEOUT)
+        except OSError as e:
+            print("Client: ", address, e, file=sys.stderr)
+            continue
+
+        try:
+            response = send_recv_http_request(shard_map(hostname), server_socket)
+            return load_shards(response), address, server_socket
+        except OSError as e:
+            server_socket.close()
+            print("Client: ", address, e, file=sys.stderr)
+
+    raise ConnectionError(f"No server of {addresses} answered")
+
+
+def client(
+    hostname: str,
+    port: int,
+    commands: list[tuple[str, dict]] = None,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+    servers: Optional[list[Shard]] = None,
+):
+    """Learns the shard map from the RS at hostname, then runs commands against the
+    shard this peer's address hashes to. The map is asked of shard 0, or, if that's
+    down, of the rest of servers, the RS's shards as configured, and their followers,
+    in turn."""
+    servers = make_shards(hostname, PORT, 1) if servers is None else servers
 
     try:
-        with socket.create_connection(server_address) as server_socket:
-            server_socket.settimeout(TIMEOUT)
+        shards, address, server_socket = bootstrap_shards(hostname, servers)
+        home = HashRing(shards).shard_for(hostname, port)
+
+        # The bootstrap server may be another shard, or a follower.
+        if address != home.address:
+            server_socket.close()
+            server_socket = connect_shard(home)
+        server_socket.settimeout(TIMEOUT)
 
-            print(f"Connected to server: {server_address}")
+        print(
+            f"Connected to server: {server_socket.getpeername()}, "
+            f"shard {home.index + 1} of {len(shards)}"
+        )
 
+        with server_socket:
             client_handler(
                 hostname=hostname,
                 port=port,
                 commands=commands,
                 server_socket=server_socket,
+                shards=shards,
+                dht=dht,
+                gossip=gossip,
             )
     except Exception as e:
         print("Client: ", e, file=sys.stderr)
@@ -0,0 +1,521 @@
+import hashlib
+import heapq
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import *
+
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import Holder, RFCIndex
+from src.peer.scatter import Scatter
+from src.utils.http import (
+    SUCCESS_CODE,
+    HTTPRequest,
+    HTTPResponse,
+    http_request,
+    send_recv_http_request,
+)
+
+# Bits in a node ID, and in a key: SHA-1's.
+ID_BITS = 160
+# Contacts per bucket, contacts returned by FindNode, and nodes each record is
+# stored at.
+K = 20
+# FindNode or FindValue requests in flight at once during a lookup.
+ALPHA = 3
+# Seconds each round of a lookup waits for its answers.
+ROUND_DEADLINE = 2.0
+# Seconds a record lives, unless republished; records cached by lookups live less.
+RECORD_TTL = 3600.0
+CACHE_TTL = 600.0
+# Seconds between republishes of a peer's own RFCs, and between refreshes of buckets
+# no lookup has gone through.
+REPUBLISH_AFTER = 1800.0
+REFRESH_AFTER = 3600.0
+# Seconds between checks for RFCs to publish, and for records to hand off.
+CHECK_INTERVAL = 1.0
+
+
+def node_id(hostname: str, port: int) -> int:
+    return int.from_bytes(hashlib.sha1(f"{hostname}:{port}".encode()).digest(), "big")
+
+
+def rfc_key(number: int) -> int:
+    return int.from_bytes(hashlib.sha1(f"rfc{number}".encode()).digest(), "big")
+
+
+@dataclass(frozen=True)
+class Contact:
+    id: int
+    hostname: str
+    port: int
+
+    @property
+    def address(self) -> Holder:
+        return self.hostname, self.port
+
+
+@dataclass
+class Lookup:
+    """The outcome of a lookup: the k closest nodes found to key, nearest first, and,
+    for FindValue lookups, the holders found. rounds counts the rounds of requests,
+    and messages the requests sent."""
+
+    key: int
+    contacts: list[Contact] = field(default_factory=list)
+    holders: set[Holder] = field(default_factory=set)
+    rounds: int = 0
+    messages: int = 0
+    # The closest node asked that had no holders, where they're cached.
+    missed: Optional[Contact] = None
+
+
+class RoutingTable:
+    """Kademlia's k-buckets: bucket i holds up to k contacts whose XOR distance from
+    this node has its highest bit at i, least recently seen first. A contact seen
+    when its bucket's full waits in the bucket's replacement cache, taking the place
+    of the first contact found unresponsive; so contacts which have long stayed up,
+    and are likeliest to stay up, are kept."""
+
+    def __init__(self, own_id: int, k: int = K) -> None:
+        self.id = own_id
+        self.k = k
+        self.buckets: list[dict[int, Contact]] = [{} for _ in range(ID_BITS)]
+        self.replacements: list[dict[int, Contact]] = [{} for _ in range(ID_BITS)]
+        # When a lookup last went through each bucket.
+        self.touched = [time.monotonic()] * ID_BITS
+        self.lock = threading.Lock()
+
+    def bucket_index(self, other_id: int) -> int:
+        return (self.id ^ other_id).bit_length() - 1
+
+    def update(self, contact: Contact) -> bool:
+        """Moves contact to the end of its bucket, if there's room; returns whether
+        it's new to the table."""
+        if contact.id == self.id:
+            return False
+
+        i = self.bucket_index(contact.id)
+        with self.lock:
+            bucket = self.buckets[i]
+            if (new := contact.id not in bucket) and len(bucket) >= self.k:
+                replacements = self.replacements[i]
+                replacements.pop(contact.id, None)
+                replacements[contact.id] = contact
+                if len(replacements) > self.k:
+                    del replacements[next(iter(replacements))]
+                return False
+
+            bucket.pop(contact.id, None)
+            bucket[contact.id] = contact
+            return new
+
+    def remove(self, contact: Contact) -> None:
+        """Drops an unresponsive contact, promoting the most recently seen of its
+        bucket's replacements."""
+        i = self.bucket_index(contact.id)
+        with self.lock:
+            self.replacements[i].pop(contact.id, None)
+            if self.buckets[i].pop(contact.id, None) is not None and (
+                replacements := self.replacements[i]
+            ):
+                replacement = replacements.pop(next(reversed(replacements)))
+                self.buckets[i][replacement.id] = replacement
+
+    def closest(self, target: int, count: Optional[int] = None) -> list[Contact]:
+        with self.lock:
+            contacts = [c for bucket in self.buckets for c in bucket.values()]
+        return heapq.nsmallest(count or self.k, contacts, key=lambda c: c.id ^ target)
+
+    def touch(self, target: int) -> None:
+        if target != self.id:
+            self.touched[self.bucket_index(target)] = time.monotonic()
+
+    def stale(self, now: float) -> list[int]:
+        """The buckets, up to the farthest holding any contact, that no lookup has
+        gone through in REFRESH_AFTER seconds."""
+        with self.lock:
+            farthest = max((i for i, b in enumerate(self.buckets) if b), default=-1)
+        return [
+            i for i in range(farthest + 1) if now - self.touched[i] >= REFRESH_AFTER
+        ]
+
+    def random_id(self, i: int) -> int:
+        """A random ID falling in bucket i."""
+        return self.id ^ ((1 << i) | random.getrandbits(i))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(map(len, self.buckets))
+
+
+def sender_headers(sender: Contact) -> dict[str, str]:
+    return {
+        "Node-ID": f"{sender.id:040x}",
+        "Node-Host": sender.hostname,
+        "Port": sender.port,
+    }
+
+
+def load_sender(request: HTTPRequest) -> Optional[Contact]:
+    """The node a DHT request came from; or None, if it came from outside the DHT."""
+    if "Node-ID" not in request.headers:
+        return None
+
+    return Contact(
+        int(request.headers["Node-ID"], 16),
+        request.headers["Node-Host"],
+        int(request.headers["Port"]),
+    )
+
+
+def dump_contacts(contacts: Iterable[Contact], holders: Iterable[Holder] = ()) -> str:
+    return json.dumps(
+        {
+            "contacts": [[f"{c.id:040x}", c.hostname, c.port] for c in contacts],
+            "holders": list(holders),
+        }
+    )
+
+
+def load_contacts(response: HTTPResponse) -> tuple[list[Contact], set[Holder]]:
+    data = json.loads(response.content.decode())
+    contacts = [Contact(int(i, 16), host, port) for i, host, port in data["contacts"]]
+    return contacts, {tuple(holder) for holder in data["holders"]}
+
+
+# The methods name P2PCommands, which src.peer.server defines, importing this module.
+@http_request
+def find_node_request(hostname: str, sender: Contact, key: int):
+    return "findnode", hostname, sender_headers(sender) | {"Key": f"{key:040x}"}
+
+
+@http_request
+def find_value_request(hostname: str, sender: Contact, key: int):
+    return "findvalue", hostname, sender_headers(sender) | {"Key": f"{key:040x}"}
+
+
+@http_request
+def store_request(
+    hostname: str,
+    sender: Contact,
+    number: int,
+    holders: Iterable[Holder],
+    ttl: float,
+):
+    headers = sender_headers(sender) | {"RFC-Number": number, "TTL": int(ttl)}
+    return "store", hostname, headers, json.dumps(list(holders))
+
+
+class DHTNode:
+    """A peer's node in a Kademlia overlay, locating RFCs without the RS. Each RFC's
+    holders are stored, as records, at the k nodes whose IDs are closest, by XOR, to
+    the hash of its number. Lookups close in on a key a round at a time, asking the
+    alpha closest nodes not yet asked, at once, for any closer; a round that finds
+    none closer asks every one of the k closest left. Each takes O(log N) rounds.
+
+    Every node heard from, by request or reply, is kept in the routing table. A
+    value found is cached at the closest node asked that didn't have it, so popular
+    RFCs are found sooner; and records are handed off to each new node among the k
+    closest to their key, so they stay findable as nodes join."""
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        pool: Optional[ConnectionPool] = None,
+        k: int = K,
+        alpha: int = ALPHA,
+    ) -> None:
+        self.id = node_id(hostname, port)
+        self.contact = Contact(self.id, hostname, port)
+        self.pool = ConnectionPool() if pool is None else pool
+        self.k = k
+        self.alpha = alpha
+        self.table = RoutingTable(self.id, k)
+
+        # key -> holder -> (RFC number, expiry time)
+        self.records: dict[int, dict[Holder, tuple[int, float]]] = {}
+        # Contacts new to the routing table, for records to be handed off to.
+        self.newcomers: list[Contact] = []
+        self.lock = threading.Lock()
+        self.joined = threading.Event()
+        # When each of this peer's RFCs was last published.
+        self.published: dict[int, float] = {}
+        self.messages = 0
+
+    @property
+    def address(self) -> Holder:
+        return self.contact.address
+
+    def headers(self) -> dict[str, str]:
+        return {"Node-ID": f"{self.id:040x}"}
+
+    def seen(self, contact: Optional[Contact]) -> None:
+        if contact is not None and self.table.update(contact):
+            with self.lock:
+                self.newcomers.append(contact)
+
+    # Answering requests.
+
+    def find_node(self, sender: Optional[Contact], key: int) -> list[Contact]:
+        self.seen(sender)
+        return [c for c in self.table.closest(key) if c != sender]
+
+    def find_value(
+        self, sender: Optional[Contact], key: int
+    ) -> tuple[list[Contact], set[Holder]]:
+        return self.find_node(sender, key), self.holders(key)
+
+    def store(
+        self, sender: Optional[Contact], number: int, holders: list[Holder], ttl: float
+    ) -> None:
+        self.seen(sender)
+        self.put(rfc_key(number), number, holders, ttl)
+
+    def put(self, key: int, number: int, holders: Iterable[Holder], ttl: float) -> None:
+        expires = time.time() + ttl
+        with self.lock:
+            records = self.records.setdefault(key, {})
+            for holder in holders:
+                # A cached record mustn't cut short one stored for longer.
+                if records.get(holder, (number, 0.0))[1] < expires:
+                    records[holder] = number, expires
+
+    def holders(self, key: int) -> set[Holder]:
+        now = time.time()
+        with self.lock:
+            records = self.records.get(key, {})
+            return {holder for holder, (_, t) in records.items() if t > now}
+
+    def expire(self) -> None:
+        now = time.time()
+        with self.lock:
+            for key, records in list(self.records.items()):
+                for holder in [h for h, (_, t) in records.items() if t <= now]:
+                    del records[holder]
+                if not records:
+                    del self.records[key]
+
+    # Making requests.
+
+    def ask(
+        self, address: Holder, node_socket: socket.socket, key: int, value: bool
+    ) -> tuple[list[Contact], set[Holder]]:
+        request = (find_value_request if value else find_node_request)(
+            address[0], self.contact, key
+        )
+        response = send_recv_http_request(request, node_socket)
+        if response.status != SUCCESS_CODE:
+            raise ValueError(f"Not a DHT node ({response.status})")
+
+        self.seen(Contact(int(response.getheader("Node-ID"), 16), *address))
+        return load_contacts(response)
+
+    def lookup(self, key: int, value: bool = False) -> Lookup:
+        """Closes in on key, as FindNode; or, if value is set, as FindValue, stopping
+        at the first round to find any holders."""
+        lookup = Lookup(key)
+        shortlist = {c.id: c for c in self.table.closest(key)}
+        asked: set[int] = set()
+        closest = None
+        self.table.touch(key)
+
+        while True:
+            nearest = heapq.nsmallest(
+                self.k, shortlist.values(), key=lambda c: c.id ^ key
+            )
+            unasked = [c for c in nearest if c.id not in asked]
+            if not unasked:
+                break
+
+            # A round that found nobody closer is followed by one asking all the rest.
+            best = nearest[0].id ^ key
+            stalled = closest is not None and best >= closest
+            batch = unasked if stalled else unasked[: self.alpha]
+            closest = best
+
+            by_address = {c.address: c for c in batch}
+            asked.update(c.id for c in batch)
+            lookup.rounds += 1
+            lookup.messages += len(batch)
+
+            exchange = lambda address, s: self.ask(address, s, key, value)
+            for reply in Scatter(self.pool, by_address, exchange, ROUND_DEADLINE):
+                contact = by_address[reply.holder]
+                if reply.error is not None:
+                    self.table.remove(contact)
+                    shortlist.pop(contact.id, None)
+                    continue
+
+                contacts, holders = reply.value
+                if holders:
+                    lookup.holders |= holders
+                elif value and (
+                    lookup.missed is None or contact.id ^ key < lookup.missed.id ^ key
+                ):
+                    lookup.missed = contact
+                for found in contacts:
+                    if found.id != self.id:
+                        shortlist.setdefault(found.id, found)
+
+            if value and lookup.holders:
+                break
+
+        with self.lock:
+            self.messages += lookup.messages
+        lookup.contacts = heapq.nsmallest(
+            self.k,
+            (shortlist[i] for i in asked if i in shortlist),
+            key=lambda c: c.id ^ key,
+        )
+        return lookup
+
+    def send_store(
+        self,
+        targets: Iterable[Contact],
+        number: int,
+        holders: Iterable[Holder],
+        ttl: float,
+    ) -> None:
+        targets = {c.address: c for c in targets}
+        holders = list(holders)
+
+        def exchange(address: Holder, node_socket: socket.socket) -> None:
+            request = store_request(address[0], self.contact, number, holders, ttl)
+            if send_recv_http_request(request, node_socket).status != SUCCESS_CODE:
+                raise ValueError("Store refused")
+
+        with self.lock:
+            self.messages += len(targets)
+        for reply in Scatter(self.pool, targets, exchange, ROUND_DEADLINE):
+            if reply.error is not None:
+                self.table.remove(targets[reply.holder])
+
+    def locate(self, number: int) -> Lookup:
+        """The holders of an RFC, found in O(log N) rounds."""
+        key = rfc_key(number)
+        if holders := self.holders(key):
+            return Lookup(key, holders=holders)
+
+        lookup = self.lookup(key, value=True)
+        if lookup.holders:
+            self.put(key, number, lookup.holders, CACHE_TTL)
+            if lookup.missed is not None:
+                self.send_store([lookup.missed], number, lookup.holders, CACHE_TTL)
+        return lookup
+
+    def publish(self, number: int) -> None:
+        """Stores this peer as a holder of number at the k nodes closest to its key,
+        itself included, if it's one of them."""
+        key = rfc_key(number)
+        closest = heapq.nsmallest(
+            self.k,
+            self.lookup(key).contacts + [self.contact],
+            key=lambda c: c.id ^ key,
+        )
+        if self.contact in closest:
+            self.put(key, number, [self.address], RECORD_TTL)
+
+        self.send_store(
+            [c for c in closest if c != self.contact],
+            number,
+            [self.address],
+            RECORD_TTL,
+        )
+        self.published[number] = time.monotonic()
+
+    def hand_off(self) -> None:
+        """Stores, at each node new to the routing table, the records it's among the
+        k closest to."""
+        with self.lock:
+            newcomers, self.newcomers = self.newcomers, []
+            records = {
+                key: [(h, n, t) for h, (n, t) in holders.items()]
+                for key, holders in self.records.items()
+            }
+
+        now = time.time()
+        for newcomer in newcomers:
+            for key, entries in records.items():
+                if newcomer not in self.table.closest(key):
+                    continue
+                for holder, number, expires in entries:
+                    if expires > now:
+                        self.send_store([newcomer], number, [holder], expires - now)
+
+    def refresh(self) -> None:
+        for i in self.table.stale(time.monotonic()):
+            self.lookup(self.table.random_id(i))
+
+    def join(self, bootstraps: Iterable[Holder]) -> bool:
+        """Joins the overlay through the first of bootstraps to answer, looking up
+        this node's own ID to fill the routing table, and to make itself known to
+        its neighbours. With no bootstraps, or none answering, this node starts an
+        overlay of its own; returns whether it joined an existing one."""
+        try:
+            for address in bootstraps:
+                if address == self.address:
+                    continue
+                try:
+                    contacts, _ = self.pool.request(
+                        address, lambda s: self.ask(address, s, self.id, False)
+                    )
+                except (OSError, ValueError) as e:
+                    print("DHT: ", address, e, file=sys.stderr)
+                    continue
+
+                for contact in contacts:
+                    self.table.update(contact)
+                self.lookup(self.id)
+                return True
+
+            return False
+        finally:
+            self.joined.set()
+
+
+class Republisher(threading.Thread):
+    """Dedicated thread keeping a node's records up to date, once it's joined: it
+    publishes each local RFC of rfc_index as it appears, and every REPUBLISH_AFTER
+    seconds after; hands records off to nodes new to the routing table; refreshes
+    stale buckets; and drops expired records."""
+
+    def __init__(self, node: DHTNode, rfc_index: RFCIndex) -> None:
+        super().__init__(daemon=True)
+        self.node = node
+        self.rfc_index = rfc_index
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.node.joined.wait(CHECK_INTERVAL):
+            if self.stopped.is_set():
+                return
+
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            with self.rfc_index.lock:
+                numbers = set(self.rfc_index.local)
+
+            published = self.node.published
+            for number in set(published) - numbers:
+                del published[number]
+
+            try:
+                for number in numbers:
+                    if now - published.get(number, -REPUBLISH_AFTER) >= REPUBLISH_AFTER:
+                        self.node.publish(number)
+                self.node.hand_off()
+                self.node.refresh()
+            except (OSError, ValueError) as e:
+                print("DHT: ", e, file=sys.stderr)
+            self.node.expire()
+
+            self.stopped.wait(CHECK_INTERVAL)
+
+    def cancel(self) -> None:
+        self.stopped.set()
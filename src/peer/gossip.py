@@ -0,0 +1,344 @@
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import *
+
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, Holder, RFCIndex
+from src.peer.scatter import Scatter
+from src.utils.encoding import ACCEPT_ENCODING, ACCEPTED
+from src.utils.http import (
+    SUCCESS_CODE,
+    HTTPRequest,
+    HTTPResponse,
+    http_request,
+    send_recv_http_request,
+)
+from src.utils.metrics import Counter, Histogram
+
+# Peers pulled from each round, and seconds between rounds.
+FANOUT = 3
+GOSSIP_INTERVAL = 1.0
+# Seconds each round waits for its answers.
+ROUND_DEADLINE = 2.0
+# Most peers' entries sent in answer to one digest, bounding every exchange.
+MAX_ENTRIES = 32
+# Failed exchanges in a row after which a peer is taken to have left; its entry is
+# then refused for TOMBSTONE_TTL seconds, unless it's heard from again.
+MAX_FAILURES = 3
+TOMBSTONE_TTL = 300.0
+# Seconds for an update to arrive, 50ms doubling up to ~100s; bytes exchanged in a
+# round, 256 B doubling up to 8 MB.
+LAG_BUCKETS = tuple(0.05 * 2**i for i in range(12))
+ROUND_BYTES_BUCKETS = tuple(256 * 2**i for i in range(16))
+
+Version = tuple[int, int]
+
+
+def parse_version(tag: Optional[str]) -> Version:
+    """Orders version tags, "epoch:version", by epoch, then version; a missing or
+    malformed tag orders first."""
+    try:
+        epoch, version = map(int, tag.split(":"))
+    except (AttributeError, ValueError):
+        return -1, -1
+    return epoch, version
+
+
+@dataclass
+class Entry:
+    """The RFCs a peer holds, as of a version of its index; updated is when that
+    version was made, by the peer's own clock."""
+
+    holder: Holder
+    version: str
+    updated: Optional[float]
+    rfcs: list[RFC]
+
+
+def digest_versions(versions: dict[Holder, str]) -> str:
+    """A hash of versions, equal between peers whose views are in step."""
+    return hashlib.sha1(json.dumps(sorted(versions.items())).encode()).hexdigest()
+
+
+def dump_versions(versions: dict[Holder, Optional[str]]) -> str:
+    return json.dumps([[hostname, port, v] for (hostname, port), v in versions.items()])
+
+
+def load_versions(message: HTTPRequest | HTTPResponse) -> dict[Holder, Optional[str]]:
+    data = json.loads(message.content.decode())
+    return {(hostname, port): version for hostname, port, version in data}
+
+
+def dump_entries(entries: Iterable[Entry]) -> str:
+    return json.dumps([asdict(entry) for entry in entries], default=str)
+
+
+def load_entries(response: HTTPResponse) -> list[Entry]:
+    data = json.loads(response.content.decode())
+    return [
+        Entry(
+            tuple(entry["holder"]),
+            entry["version"],
+            entry["updated"],
+            [RFC(**rfc) for rfc in entry["rfcs"]],
+        )
+        for entry in data
+    ]
+
+
+# The method names a P2PCommand, which src.peer.server defines, importing this module.
+@http_request
+def gossip_request(
+    hostname: str,
+    sender: Holder,
+    digest: str,
+    wanted: Optional[dict[Holder, Optional[str]]] = None,
+):
+    headers = {
+        "Node-Host": sender[0],
+        "Port": sender[1],
+        "Index-Digest": digest,
+        ACCEPT_ENCODING: ACCEPTED,
+    }
+    return "gossip", hostname, headers, "" if wanted is None else dump_versions(wanted)
+
+
+class GossipNode:
+    """A peer's part in spreading the global RFC index by gossip, rather than having
+    every peer RFCQuery every other. Each round, a peer sends fanout peers, chosen at
+    random, the hash of its view's digest: the index version it has of every peer,
+    its own included. A peer whose view differs answers with its digest, and the
+    entries of those peers whose versions are newer there are then pulled, up to
+    MAX_ENTRIES. An update reaches every peer in O(log N) rounds; once views are in
+    step, each exchange costs a hash.
+
+    view is the global index: every other peer's RFCs, as of the version last
+    gossiped, or RFCQueried, from any peer. Peers to gossip with are found through
+    join, from every peer heard from, and from the entries gossiped; a peer failing
+    MAX_FAILURES exchanges in a row is dropped, entry and all."""
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        pool: Optional[ConnectionPool] = None,
+        fanout: int = FANOUT,
+        interval: float = GOSSIP_INTERVAL,
+    ) -> None:
+        self.address = (hostname, port)
+        self.pool = ConnectionPool() if pool is None else pool
+        self.fanout = fanout
+        self.interval = interval
+
+        self.view = RFCIndex()
+        # When each peer's version in view was made.
+        self.stamps: dict[Holder, float] = {}
+        # Peer -> failed exchanges in a row.
+        self.members: dict[Holder, int] = {}
+        # Peer -> (newest version refused, until when).
+        self.tombstones: dict[Holder, tuple[Version, float]] = {}
+        self.lock = threading.Lock()
+
+        self.rounds = Counter()
+        self.exchanged = Counter()
+        self.round_bytes = Histogram(ROUND_BYTES_BUCKETS)
+        self.lag = Histogram(LAG_BUCKETS)
+
+    def join(self, peers: Iterable[Holder]) -> None:
+        with self.lock:
+            for peer in peers:
+                if peer != self.address:
+                    self.members.setdefault(peer, 0)
+
+    def heard_from(self, peer: Holder) -> None:
+        if peer == self.address:
+            return
+        with self.lock:
+            self.members[peer] = 0
+            self.tombstones.pop(peer, None)
+
+    def failed(self, peer: Holder) -> None:
+        with self.lock:
+            if (failures := self.members.get(peer, 0) + 1) < MAX_FAILURES:
+                self.members[peer] = failures
+                return
+            self.members.pop(peer, None)
+
+        with self.view.lock:
+            version = parse_version(self.view.versions.get(peer))
+            self.view.remove_holder(peer)
+            self.stamps.pop(peer, None)
+
+        with self.lock:
+            self.tombstones[peer] = version, time.time() + TOMBSTONE_TTL
+
+    def expire(self) -> None:
+        now = time.time()
+        with self.lock:
+            for peer in [p for p, (_, t) in self.tombstones.items() if t <= now]:
+                del self.tombstones[peer]
+
+    def versions(self, local: RFCIndex) -> dict[Holder, str]:
+        """The digest of this peer's view, with local, its own index."""
+        with self.view.lock:
+            versions = dict(self.view.versions)
+        versions[self.address] = local.version_tag
+        return versions
+
+    def entries(
+        self, local: RFCIndex, wanted: dict[Holder, Optional[str]]
+    ) -> list[Entry]:
+        """The entries of the peers wanted, local's for this peer, that are newer
+        than the versions given; if there are more than MAX_ENTRIES, a random
+        sample, so that each partner passes on different ones."""
+        entries = []
+
+        if self.address in wanted and parse_version(
+            wanted[self.address]
+        ) < parse_version(local.version_tag):
+            with local.lock:
+                rfcs = list(local.local.values())
+                entries.append(
+                    Entry(self.address, local.version_tag, local.updated, rfcs)
+                )
+
+        with self.view.lock:
+            newer = [
+                holder
+                for holder, version in wanted.items()
+                if holder != self.address
+                and parse_version(version)
+                < parse_version(self.view.versions.get(holder))
+            ]
+            newer = random.sample(newer, min(len(newer), MAX_ENTRIES - len(entries)))
+
+            for holder in newer:
+                remote = self.view.remote
+                rfcs = [remote[n][holder] for n in self.view.holdings.get(holder, ())]
+                version = self.view.versions[holder]
+                entries.append(Entry(holder, version, self.stamps.get(holder), rfcs))
+
+        return entries
+
+    def behind(
+        self, versions: dict[Holder, str], theirs: dict[Holder, str]
+    ) -> dict[Holder, Optional[str]]:
+        """The peers whose versions in theirs are newer than in versions, and not
+        refused, with the versions this peer has of them."""
+        with self.lock:
+            tombstones = dict(self.tombstones)
+
+        return {
+            holder: versions.get(holder)
+            for holder, version in theirs.items()
+            if holder != self.address
+            and parse_version(versions.get(holder)) < parse_version(version)
+            and parse_version(version) > tombstones.get(holder, ((-1, -1), 0.0))[0]
+        }
+
+    def apply(self, entries: Iterable[Entry]) -> int:
+        """Merges in the entries newer than view's; returns how many were."""
+        applied = 0
+        now = time.time()
+
+        for entry in entries:
+            if entry.holder == self.address:
+                continue
+
+            version = parse_version(entry.version)
+            with self.lock:
+                tombstone = self.tombstones.get(entry.holder)
+                if tombstone is not None and version <= tombstone[0]:
+                    continue
+                self.members.setdefault(entry.holder, 0)
+
+            with self.view.lock:
+                if version <= parse_version(self.view.versions.get(entry.holder)):
+                    continue
+                self.view.sync(entry.holder, entry.version, entry.rfcs)
+                if entry.updated is not None:
+                    self.stamps[entry.holder] = entry.updated
+                else:
+                    self.stamps.pop(entry.holder, None)
+
+            if entry.updated is not None:
+                self.lag.observe(max(0.0, now - entry.updated))
+            applied += 1
+
+        return applied
+
+    def gossip(self, local: RFCIndex) -> int:
+        """One round: pulls from fanout peers at random; returns how many entries
+        were new."""
+        with self.lock:
+            peers = random.sample(
+                list(self.members), min(self.fanout, len(self.members))
+            )
+        if not peers:
+            return 0
+
+        versions = self.versions(local)
+        digest = digest_versions(versions)
+
+        def exchange(peer: Holder, peer_socket: socket.socket) -> tuple[int, list]:
+            request = gossip_request(peer[0], self.address, digest)
+            response = send_recv_http_request(request, peer_socket)
+            if response.status != SUCCESS_CODE:
+                raise ValueError(f"Gossip refused ({response.status})")
+
+            size = len(request) + len(response.body)
+            if response.getheader("Index-Sync") != "digest":
+                return size, []
+            if not (wanted := self.behind(versions, load_versions(response))):
+                return size, []
+
+            request = gossip_request(peer[0], self.address, digest, wanted)
+            response = send_recv_http_request(request, peer_socket)
+            if response.status != SUCCESS_CODE:
+                raise ValueError(f"Gossip refused ({response.status})")
+
+            return size + len(request) + len(response.body), load_entries(response)
+
+        applied, exchanged = 0, 0
+        for reply in Scatter(self.pool, peers, exchange, ROUND_DEADLINE):
+            if reply.error is not None:
+                self.failed(reply.holder)
+                continue
+
+            self.heard_from(reply.holder)
+            size, entries = reply.value
+            exchanged += size
+            applied += self.apply(entries)
+
+        self.rounds.inc()
+        self.exchanged.inc(exchanged)
+        self.round_bytes.observe(exchanged)
+        return applied
+
+
+class Gossiper(threading.Thread):
+    """Dedicated thread running a round of gossip about every interval seconds,
+    jittered, so peers started together don't gossip in lockstep."""
+
+    def __init__(self, node: GossipNode, rfc_index: RFCIndex) -> None:
+        super().__init__(daemon=True)
+        self.node = node
+        self.rfc_index = rfc_index
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.node.interval * random.uniform(0.5, 1.5)):
+            try:
+                self.node.gossip(self.rfc_index)
+            except (OSError, ValueError) as e:
+                print("Gossip: ", e, file=sys.stderr)
+            self.node.expire()
+
+    def cancel(self) -> None:
+        self.stopped.set()
@@ -0,0 +1,112 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import *
+
+from src.peer.rfc import Holder
+
+# Weight of each new sample in a holder's moving averages.
+EWMA_WEIGHT = 0.25
+# Chance of picking a holder at random, so every holder's estimates stay fresh.
+EXPLORE = 0.1
+# Seconds each recent failure adds to a holder's expected download time; failures
+# count for half as much every FAILURE_HALF_LIFE seconds.
+FAILURE_PENALTY = 10.0
+FAILURE_HALF_LIFE = 60.0
+# Bytes expected of an RFC, until any have been downloaded.
+EXPECTED_SIZE = 64 * 1024
+
+
+@dataclass
+class Transfer:
+    """The timings of a download: when it was requested, when the RFC's metadata
+    arrived, and when its body had, and how many body bytes came."""
+
+    started: float = 0.0
+    first_byte: Optional[float] = None
+    finished: Optional[float] = None
+    size: int = 0
+
+
+@dataclass
+class HolderStats:
+    """Moving averages of a holder's round trip time, in seconds, and transfer rate,
+    in bytes per second; and its recent failures, as of failed_at."""
+
+    rtt: Optional[float] = None
+    rate: Optional[float] = None
+    failures: float = 0.0
+    failed_at: float = 0.0
+    transfers: int = 0
+
+    def recent_failures(self, now: float) -> float:
+        return self.failures * 0.5 ** ((now - self.failed_at) / FAILURE_HALF_LIFE)
+
+
+def ewma(average: Optional[float], sample: float) -> float:
+    return sample if average is None else average + EWMA_WEIGHT * (sample - average)
+
+
+class HolderTable:
+    """How well each peer has served this client's downloads, from which the holder
+    to download an RFC from is chosen. A holder's expected download time is its round
+    trip time, plus an RFC's size over its transfer rate, plus a FAILURE_PENALTY per
+    recent failure. Holders not yet downloaded from are expected to be instant, so
+    each is tried; and, with chance explore, a holder is picked at random."""
+
+    def __init__(
+        self, explore: float = EXPLORE, rng: Optional[random.Random] = None
+    ) -> None:
+        self.explore = explore
+        self.rng = random.Random() if rng is None else rng
+        self.stats: dict[Holder, HolderStats] = {}
+        self.size: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def record(self, holder: Holder, transfer: Transfer) -> None:
+        """Feeds in a completed download from holder."""
+        if transfer.first_byte is None or transfer.finished is None:
+            return
+
+        with self.lock:
+            stats = self.stats.setdefault(holder, HolderStats())
+            stats.rtt = ewma(stats.rtt, transfer.first_byte - transfer.started)
+            if (elapsed := transfer.finished - transfer.first_byte) > 0:
+                stats.rate = ewma(stats.rate, transfer.size / elapsed)
+            stats.transfers += 1
+            self.size = ewma(self.size, transfer.size)
+
+    def fail(self, holder: Holder) -> None:
+        now = time.monotonic()
+        with self.lock:
+            stats = self.stats.setdefault(holder, HolderStats())
+            stats.failures = stats.recent_failures(now) + 1
+            stats.failed_at = now
+
+    def expected(self, holder: Holder, now: Optional[float] = None) -> float:
+        """Seconds a download of a typical RFC from holder is expected to take."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            stats = self.stats.get(holder, HolderStats())
+            size = EXPECTED_SIZE if self.size is None else self.size
+
+        seconds = stats.rtt or 0.0
+        if stats.rate:
+            seconds += size / stats.rate
+        return seconds + FAILURE_PENALTY * stats.recent_failures(now)
+
+    def ranked(self, holders: Iterable[Holder]) -> tuple[list[Holder], bool]:
+        """holders, in the order to try them: best expected first, or, if exploring,
+        one at random first; and whether it's exploring. Ties are broken at random."""
+        now = time.monotonic()
+        holders = list(holders)
+        self.rng.shuffle(holders)
+        holders.sort(key=lambda holder: self.expected(holder, now))
+
+        if exploring := len(holders) > 1 and self.rng.random() < self.explore:
+            holders.insert(0, holders.pop(self.rng.randrange(len(holders))))
+        return holders, exploring
+
+    def choose(self, holders: Iterable[Holder]) -> Holder:
+        return self.ranked(holders)[0][0]
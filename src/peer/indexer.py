@@ -0,0 +1,301 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import astuple, dataclass
+from typing import *
+
+from src.peer.rfc import RFC, RFCIndex
+
+MANIFEST_DIR = pathlib.Path(tempfile.gettempdir(), "p2pdi", "manifests")
+MANIFEST_VERSION = 2
+# How much of each file is read to find its number and title.
+HEAD_SIZE = 1 << 12
+# Fewer changed files than this are examined in-process; starting a pool costs more.
+POOL_THRESHOLD = 256
+WATCH_INTERVAL = 2.0
+
+# The line of a header giving the RFC's number: "Request for Comments: 2", or, in the
+# earliest, "RFC-3" or "NWG/RFC 49".
+RFC_LINE = re.compile(
+    r"Request for Comments?\s*(?:No\.|#|:)?\s*(\S+)|^\s*(?:NWG/)?RFC[-\s#]*(\d+)",
+    re.IGNORECASE,
+)
+FILENAME = re.compile(r"rfc(\d+)\.txt", re.IGNORECASE)
+# Header blocks searched for the RFC's number.
+HEADER_BLOCKS = 3
+# Lines of the header given after the number, which aren't the title: NIC numbers,
+# and dates, which may end a block of authors.
+HEADER_FIELD = re.compile(r"^\s*NIC\b", re.IGNORECASE)
+DATE = re.compile(
+    r"\s*(?:\d{1,2}[-\s]+)?[a-z]+\.?[-\s]+(?:\d{1,2},?\s+)?(?:19|20)\d\d", re.IGNORECASE
+)
+RULE = re.compile(r"[-_=\s]+")
+# The width RFCs are set to, which titles are centred within.
+PAGE_WIDTH = 72
+
+
+@dataclass
+class Entry:
+    """A file as last examined: its size and mtime, and what was found in it."""
+
+    size: int
+    mtime_ns: int
+    number: Optional[int]
+    title: str
+
+
+def blocks(lines: Iterable[str]) -> Iterator[list[str]]:
+    """Runs of non-blank lines."""
+    block = []
+    for line in lines:
+        if line.strip():
+            block.append(line.rstrip())
+        elif block:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def centred(line: str) -> bool:
+    indent = len(line) - len(line.lstrip())
+    return indent >= 4 and abs(indent - (PAGE_WIDTH - len(line))) <= 12
+
+
+def lone_title(block: list[str]) -> bool:
+    """Whether block is a single line, short of a sentence, that could be a title."""
+    return len(block) == 1 and len(block[0]) <= PAGE_WIDTH and block[0][-1] not in ".:,"
+
+
+def parse_header(head: str) -> tuple[Optional[int], Optional[str]]:
+    """The RFC number and title given in a file's header, if any. The number is on
+    the line within the first few blocks holding "Request for Comments", or "RFC-N";
+    the title is the block of centred lines after it, past any NIC numbers, and
+    authors and dates, or, failing that, a lone line there. Anything else, such as
+    the body's first paragraph, isn't taken for a title."""
+    found = blocks(head.splitlines())
+
+    for _, block in zip(range(HEADER_BLOCKS), found):
+        if (match := next(filter(None, map(RFC_LINE.search, block)), None)) is not None:
+            break
+    else:
+        return None, None
+
+    number = match[1] or match[2]
+    number = int(number) if number.isdigit() else None
+
+    for block in found:
+        if DATE.fullmatch(block[-1]) or all(map(HEADER_FIELD.search, block)):
+            continue
+        if not all(map(centred, block)) and not lone_title(block):
+            return number, None
+
+        title = " ".join(line.strip() for line in block if not RULE.fullmatch(line))
+        # Some early RFCs, known only by number, hold "[unknown title]".
+        return number, title if not title.startswith("[") else None
+
+    return number, None
+
+
+def examine(path: str) -> tuple[Optional[int], str]:
+    """A file's RFC number and title: from its header where it has them, else from
+    its name; an RFC without a title is known as rfcN. Files named other than
+    rfcN.txt, without a number in their header, have no number."""
+    with open(path, "rb") as file:
+        head = file.read(HEAD_SIZE).decode(errors="replace")
+
+    number, title = parse_header(head)
+    name = pathlib.Path(path)
+
+    if number is None and (match := FILENAME.fullmatch(name.name)) is not None:
+        number = int(match[1])
+
+    if not title:
+        title = f"rfc{number}" if number is not None else name.stem
+
+    return number, title
+
+
+def manifest_path(directory: pathlib.Path) -> pathlib.Path:
+    key = hashlib.sha1(str(directory.resolve()).encode()).hexdigest()
+    return MANIFEST_DIR.joinpath(key + ".json")
+
+
+class Indexer:
+    """Indexes the RFCs within a directory tree, keeping a manifest of every file
+    examined, keyed by path, alongside its size and mtime, so that later scans, and
+    later starts, only examine files that changed. At startup, large batches of
+    changed files are examined in parallel, by a pool of workers processes; with one,
+    in-process. Rescans, made while serving, are always in-process."""
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        hostname: str,
+        manifest: Optional[pathlib.Path] = None,
+        workers: Optional[int] = None,
+    ) -> None:
+        self.directory = pathlib.Path(directory)
+        self.hostname = hostname
+        self.manifest = manifest_path(self.directory) if manifest is None else manifest
+        self.workers = workers
+        self.entries: dict[str, Entry] = self.load()
+
+    def load(self) -> dict[str, Entry]:
+        try:
+            data = json.loads(self.manifest.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+        if data.get("version") != MANIFEST_VERSION:
+            return {}
+
+        return {path: Entry(*entry) for path, entry in data["entries"].items()}
+
+    def save(self) -> None:
+        """Writes the manifest to a temporary file, then moves it into place, so a
+        crash never leaves a partial one."""
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "version": MANIFEST_VERSION,
+            "entries": {path: astuple(entry) for path, entry in self.entries.items()},
+        }
+
+        fd, temp = tempfile.mkstemp(dir=self.manifest.parent)
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(data, file)
+            os.replace(temp, self.manifest)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def walk(self) -> dict[str, os.stat_result]:
+        found = {}
+
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".txt"):
+                    path = os.path.join(root, name)
+                    found[path] = os.stat(path)
+
+        return found
+
+    def scan(self, parallel: bool = False) -> tuple[list[str], list[str]]:
+        """Brings the manifest up to date with the directory, returning the paths
+        added or changed, and those removed, since the last scan. If parallel, and
+        there are enough changed files, they're examined in a pool of processes."""
+        found = self.walk()
+        changed = [
+            path
+            for path, stat in found.items()
+            if (entry := self.entries.get(path)) is None
+            or (entry.size, entry.mtime_ns) != (stat.st_size, stat.st_mtime_ns)
+        ]
+        removed = [path for path in self.entries if path not in found]
+
+        if parallel and len(changed) >= POOL_THRESHOLD and self.workers != 1:
+            with ProcessPoolExecutor(self.workers) as executor:
+                results = list(executor.map(examine, changed, chunksize=64))
+        else:
+            results = [examine(path) for path in changed]
+
+        for path, (number, title) in zip(changed, results):
+            stat = found[path]
+            self.entries[path] = Entry(stat.st_size, stat.st_mtime_ns, number, title)
+        for path in removed:
+            del self.entries[path]
+
+        if changed or removed:
+            self.save()
+
+        return changed, removed
+
+    def rfc(self, path: str) -> Optional[RFC]:
+        entry = self.entries[path]
+        if entry.number is None:
+            return None
+        return RFC(entry.number, entry.title, self.hostname, path)
+
+    def claims(self) -> tuple[dict[int, RFC], list[str]]:
+        """Every RFC found, in path order; where two files claim the same number, the
+        first is kept, and the rest are returned as duplicates."""
+        rfcs: dict[int, RFC] = {}
+        duplicates = []
+
+        for path in sorted(self.entries):
+            if (rfc := self.rfc(path)) is None:
+                continue
+            if rfcs.setdefault(rfc.number, rfc) is not rfc:
+                duplicates.append(path)
+
+        return rfcs, duplicates
+
+    def rfcs(self) -> list[RFC]:
+        rfcs, duplicates = self.claims()
+
+        if duplicates:
+            print(
+                f"Indexer: skipped {len(duplicates)} files repeating RFCs found before,"
+                f" such as {duplicates[0]}",
+                file=sys.stderr,
+            )
+
+        return list(rfcs.values())
+
+    def index(self) -> RFCIndex:
+        self.scan(parallel=True)
+        return RFCIndex(self.rfcs())
+
+    def update(self, rfc_index: RFCIndex) -> int:
+        """Rescans, applying whatever changed to rfc_index; returns how many files
+        did. Every number a changed or removed file held, or now holds, is given to
+        the file that claims it first, as in rfcs, so that removing one of two files
+        claiming a number leaves the other indexed."""
+        changed, removed = self.scan()
+        if not changed and not removed:
+            return 0
+
+        numbers = {rfc.path: rfc.number for rfc in rfc_index}
+        affected = {numbers[path] for path in removed + changed if path in numbers}
+        affected |= {rfc.number for path in changed if (rfc := self.rfc(path))}
+        claims, _ = self.claims()
+
+        for number in affected:
+            if (rfc := claims.get(number)) == rfc_index.get(number):
+                continue
+            rfc_index.remove(number)
+            if rfc is not None:
+                rfc_index.add(rfc)
+
+        return len(changed) + len(removed)
+
+
+class DirectoryWatcher(threading.Thread):
+    """Dedicated thread rescanning an indexer's directory every interval seconds,
+    keeping a live RFCIndex up to date with it."""
+
+    def __init__(
+        self, indexer: Indexer, rfc_index: RFCIndex, interval: float = WATCH_INTERVAL
+    ) -> None:
+        super().__init__(daemon=True)
+        self.indexer = indexer
+        self.rfc_index = rfc_index
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.indexer.update(self.rfc_index)
+            except Exception as e:
+                print("Indexer: ", e, file=sys.stderr)
+
+    def cancel(self) -> None:
+        self.stopped.set()
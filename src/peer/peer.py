@@ -1,5 +1,8 @@
+import heapq
 import json
+import threading
 import time
+from collections import OrderedDict
 from dataclasses import asdict, dataclass, field
 from typing import *
 
@@ -7,9 +10,10 @@ from src.utils.http import HTTPRequest, HTTPResponse
 
 TTL = 7200
 TTL_INTERVAL = 5.0
+PURGE_AFTER = 24 * 60 * 60.0
 
 
-@dataclass
+@dataclass(slots=True)
 class Peer:
     hostname: str
     cookie: int
@@ -23,44 +27,195 @@ class Peer:
     def refresh(self) -> None:
         self.active = True
         self.ttl = TTL
+        self.last_active_time = time.time()
 
     def leave(self) -> None:
         self.active = False
         self.ttl = 0
 
+    @property
+    def deadline(self) -> float:
+        """When the peer's TTL runs out: one tick per TTL_INTERVAL seconds of
+        inactivity."""
+        return self.last_active_time + self.ttl * TTL_INTERVAL
+
+    def remaining_ttl(self, now: Optional[float] = None) -> int:
+        if not self.active:
+            return 0
+
+        now = time.time() if now is None else now
+        elapsed = int((now - self.last_active_time) // TTL_INTERVAL)
+
+        return max(0, self.ttl - elapsed)
+
 
 class PeerIndex:
-    def __init__(self) -> None:
+    """Every peer ever registered, keyed by cookie. Secondary indexes by address, and
+    of the active peers, are kept up to date as peers come and go, so that no operation
+    has to scan the full registration history. Peers that have been inactive for
+    longer than purge_after seconds are forgotten entirely; re-registering afterwards
+    yields a new cookie. Cookies start at first_cookie, and go up by cookie_step, so
+    that several indexes can hand them out without overlapping."""
+
+    def __init__(
+        self,
+        purge_after: float = PURGE_AFTER,
+        first_cookie: int = 0,
+        cookie_step: int = 1,
+    ) -> None:
         self.peers: dict[int, Peer] = {}
-        self.id = 0
+        self.id = first_cookie
+        self.cookie_step = cookie_step
+
+        self.addresses: dict[tuple[str, int], int] = {}
+        self.active: dict[int, Peer] = {}
+        # Cookie to the time the peer went inactive; oldest first.
+        self.inactive: OrderedDict[int, float] = OrderedDict()
+
+        self.purge_after = purge_after
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+
+        # Min-heap of (deadline, cookie), holding at most one entry per peer. Entries
+        # go stale when a peer is refreshed, and are rescheduled lazily once popped.
+        self.deadlines: list[tuple[float, int]] = []
+        self.scheduled: set[int] = set()
+
+        # How many peers have ever been deactivated by their TTL running out.
+        self.expired = 0
 
     def register(self, hostname: str, port: int) -> Peer:
-        peer = None
+        with self.lock:
+            self.purge()
 
-        for p in self.peers.values():
-            if p.hostname == hostname and p.port == port:
-                peer = p
-                peer.refresh()
-                break
-        else:
-            peer = Peer(hostname=hostname, cookie=self.id, port=port)
-            self.peers[self.id] = peer
-            self.id += 1
+            if (cookie := self.addresses.get((hostname, port))) is not None:
+                peer = self.peers[cookie]
+                self.refresh(peer)
+            else:
+                peer = Peer(hostname=hostname, cookie=self.id, port=port)
+                self.peers[self.id] = peer
+                self.addresses[(hostname, port)] = self.id
+                self.active[self.id] = peer
+                self.schedule(peer)
+                self.id += self.cookie_step
 
-        return peer
+            return peer
 
     def get(self, key: int, default: Any = None) -> Peer | Any:
         return self.peers.get(key, default)
 
+    def refresh(self, peer: Peer) -> None:
+        with self.lock:
+            peer.refresh()
+            self.inactive.pop(peer.cookie, None)
+            self.active[peer.cookie] = peer
+            self.schedule(peer)
+
+    def schedule(self, peer: Peer) -> None:
+        with self.lock:
+            if peer.cookie in self.scheduled:
+                return
+
+            heapq.heappush(self.deadlines, (peer.deadline, peer.cookie))
+            self.scheduled.add(peer.cookie)
+
+            if self.deadlines[0][1] == peer.cookie:
+                self.wakeup.notify()
+
+    def expire(self, now: Optional[float] = None) -> list[Peer]:
+        """Deactivates every peer whose deadline has passed, touching no others."""
+        now = time.time() if now is None else now
+        expired = []
+
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, cookie = heapq.heappop(self.deadlines)
+                self.scheduled.discard(cookie)
+
+                if (peer := self.peers.get(cookie)) is None or not peer.active:
+                    continue
+                elif peer.deadline <= now:
+                    peer.ttl = 0
+                    self.deactivate(peer)
+                    expired.append(peer)
+                    self.expired += 1
+                else:
+                    self.schedule(peer)
+
+        return expired
+
+    def next_wakeup(self) -> Optional[float]:
+        """The next time a peer is due to expire, or to be purged."""
+        with self.lock:
+            times = []
+            if self.deadlines:
+                times.append(self.deadlines[0][0])
+            if self.inactive:
+                times.append(next(iter(self.inactive.values())) + self.purge_after)
+
+            return min(times, default=None)
+
+    def leave(self, peer: Peer) -> None:
+        with self.lock:
+            peer.leave()
+            self.deactivate(peer)
+
+    def deactivate(self, peer: Peer) -> None:
+        with self.lock:
+            peer.active = False
+            self.active.pop(peer.cookie, None)
+            self.inactive[peer.cookie] = time.time()
+            self.inactive.move_to_end(peer.cookie)
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Forgets peers inactive for longer than purge_after; returns how many."""
+        now = time.time() if now is None else now
+        purged = 0
+
+        with self.lock:
+            while self.inactive:
+                cookie, since = next(iter(self.inactive.items()))
+                if now - since < self.purge_after:
+                    break
+
+                self.inactive.popitem(last=False)
+                peer = self.peers.pop(cookie)
+                if self.addresses.get((peer.hostname, peer.port)) == cookie:
+                    del self.addresses[(peer.hostname, peer.port)]
+                purged += 1
+
+        return purged
+
     def get_active_peers(self) -> dict[int, Peer]:
-        return {peer_id: peer for peer_id, peer in self.peers.items() if peer.active}
+        with self.lock:
+            return dict(self.active)
 
-    def decrement_peer_ttls(self) -> None:
-        for peer in self.get_active_peers().values():
-            if peer.ttl == 0:
-                peer.active = False
-            else:
-                peer.ttl -= 1
+
+class ExpiryScheduler(threading.Thread):
+    """Dedicated thread expiring peers as their deadlines pass. It sleeps until the
+    earliest deadline in the index, rather than ticking over every peer."""
+
+    def __init__(self, peer_index: PeerIndex) -> None:
+        super().__init__(daemon=True)
+        self.peer_index = peer_index
+        self.stopped = False
+
+    def run(self) -> None:
+        with self.peer_index.wakeup:
+            while not self.stopped:
+                self.peer_index.expire()
+                self.peer_index.purge()
+
+                timeout = None
+                if (wakeup := self.peer_index.next_wakeup()) is not None:
+                    timeout = min(max(0.0, wakeup - time.time()), threading.TIMEOUT_MAX)
+
+                self.peer_index.wakeup.wait(timeout)
+
+    def cancel(self) -> None:
+        with self.peer_index.wakeup:
+            self.stopped = True
+            self.peer_index.wakeup.notify()
 
 
 def load_peer(response: HTTPResponse | HTTPRequest) -> Peer:
@@ -74,4 +229,4 @@ def load_peers(response: HTTPResponse | HTTPRequest) -> list[Peer]:
 
 
 def dump_peer(peer: Peer) -> str:
-    return json.dumps(asdict(peer))
+    return json.dumps(asdict(peer) | {"ttl": peer.remaining_ttl()})
@@ -0,0 +1,152 @@
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import *
+
+from src.peer.rfc import Holder
+from src.utils.http import PROTOCOL, Protocol, use_protocol
+
+POOL_SIZE = 4
+IDLE_TIMEOUT = 30.0
+
+T = TypeVar("T")
+
+
+def is_reusable(peer_socket: socket.socket) -> bool:
+    """An idle connection should have nothing to read; if it's readable, the peer has
+    either closed it, or left a stray response on it."""
+    try:
+        readable, _, _ = select.select([peer_socket], [], [], 0)
+        return len(readable) == 0
+    except (OSError, ValueError):
+        return False
+
+
+class ConnectionPool:
+    """Persistent peer-to-peer connections, keyed by (hostname, port). Released
+    connections are kept for reuse, most recently used first, until they've sat idle
+    for idle_timeout seconds. At most max_per_peer connections, idle or in use, are
+    open to any one peer; beyond that, callers wait for one to be released. The
+    protocol negotiated with each peer is remembered, and spoken on every connection
+    to it."""
+
+    def __init__(
+        self,
+        max_per_peer: int = POOL_SIZE,
+        idle_timeout: float = IDLE_TIMEOUT,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.idle: dict[Holder, list[tuple[socket.socket, float]]] = {}
+        self.counts: dict[Holder, int] = {}
+        self.protocols: dict[Holder, Protocol] = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, address: Holder) -> tuple[socket.socket, bool]:
+        """Returns a connection to address, and whether it was reused."""
+        with self.condition:
+            while True:
+                self.evict()
+
+                while idle := self.idle.get(address):
+                    peer_socket, _ = idle.pop()
+                    if is_reusable(peer_socket):
+                        return peer_socket, True
+                    self.discard(address, peer_socket)
+
+                if self.counts.get(address, 0) < self.max_per_peer:
+                    self.counts[address] = self.counts.get(address, 0) + 1
+                    break
+
+                self.condition.wait()
+
+        try:
+            peer_socket = socket.create_connection(address, self.timeout)
+            # Pipelined requests are many small writes; don't hold them back.
+            peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return peer_socket, False
+        except OSError:
+            with self.condition:
+                self.counts[address] -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, address: Holder, peer_socket: socket.socket) -> None:
+        with self.condition:
+            self.idle.setdefault(address, []).append((peer_socket, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, address: Holder, peer_socket: socket.socket) -> None:
+        with self.condition:
+            peer_socket.close()
+            self.counts[address] -= 1
+            self.condition.notify()
+
+    def evict(self, now: Optional[float] = None) -> None:
+        """Closes every connection that's been idle for longer than idle_timeout."""
+        now = time.monotonic() if now is None else now
+
+        with self.condition:
+            for address, idle in list(self.idle.items()):
+                # Idle lists are ordered by release time, oldest first.
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    peer_socket, _ = idle.pop(0)
+                    self.discard(address, peer_socket)
+
+                if len(idle) == 0:
+                    del self.idle[address]
+
+    @contextmanager
+    def protocol(self, address: Holder) -> Iterator[None]:
+        """Speaks the protocol negotiated with address, negotiating one if that's not
+        yet known."""
+        with use_protocol(self.protocols.get(address, Protocol.negotiating)):
+            yield
+            self.protocols[address] = PROTOCOL.get()
+
+    @contextmanager
+    def connection(self, address: Holder) -> Iterator[socket.socket]:
+        peer_socket, _ = self.acquire(address)
+
+        try:
+            with self.protocol(address):
+                yield peer_socket
+        except BaseException:
+            self.discard(address, peer_socket)
+            raise
+        else:
+            self.release(address, peer_socket)
+
+    def request(self, address: Holder, exchange: Callable[[socket.socket], T]) -> T:
+        """Runs exchange over a pooled connection. If a reused connection turns out to
+        be dead, the exchange is retried once over a fresh one."""
+        peer_socket, reused = self.acquire(address)
+
+        try:
+            with self.protocol(address):
+                result = exchange(peer_socket)
+        except OSError:
+            self.discard(address, peer_socket)
+            if not reused:
+                raise
+
+            with self.connection(address) as peer_socket:
+                return exchange(peer_socket)
+        except BaseException:
+            self.discard(address, peer_socket)
+            raise
+
+        self.release(address, peer_socket)
+        return result
+
+    def close(self) -> None:
+        with self.condition:
+            for address, idle in self.idle.items():
+                for peer_socket, _ in idle:
+                    self.discard(address, peer_socket)
+            self.idle.clear()
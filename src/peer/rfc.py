@@ -1,11 +1,20 @@
 import json
+import os
 import pathlib
+import threading
+import time
+from collections import deque
 from dataclasses import asdict, dataclass
 from typing import *
 
 from src.peer.peer import Peer
+from src.utils.digest import Digest, compute_digest
 from src.utils.http import HTTPRequest, HTTPResponse
 
+Holder = tuple[str, int]
+
+CHANGE_LOG_SIZE = 1024
+
 
 @dataclass(frozen=True)
 class RFC:
@@ -15,13 +24,195 @@ class RFC:
     path: str
 
 
+class RFCIndex:
+    """A peer's view of where RFCs live, keyed by RFC number. Local RFCs map to the
+    file on disk; remote RFCs map to the set of holders, (hostname, port), known to
+    have them. Every lookup, merge and removal is a handful of dictionary operations.
+    Iterating over the index yields the local RFCs.
+
+    The local RFCs are versioned: every addition or removal bumps the version and is
+    recorded in a bounded change log, from which deltas between versions are served.
+    Versions are tagged with an epoch, the time the index was made, in milliseconds,
+    so that a restarted peer's versions are never mistaken for, and order after, those
+    of its previous incarnation. For each remote holder, the last version synced from
+    it is kept in versions.
+
+    The digests of local RFCs are computed the first time they're asked for, and kept
+    until the file's mtime or size changes."""
+
+    def __init__(
+        self, rfcs: Iterable[RFC] = (), change_log_size: int = CHANGE_LOG_SIZE
+    ) -> None:
+        self.local: dict[int, RFC] = {}
+        self.remote: dict[int, dict[Holder, RFC]] = {}
+        self.holdings: dict[Holder, set[int]] = {}
+        self.versions: dict[Holder, str] = {}
+        self.digests: dict[int, tuple[tuple[int, int], Digest]] = {}
+
+        self.epoch = time.time_ns() // 1_000_000
+        self.version = 0
+        # When the local RFCs last changed.
+        self.updated = time.time()
+        # (version, rfc, added), oldest first.
+        self.changes: deque[tuple[int, RFC, bool]] = deque(maxlen=change_log_size)
+        self.lock = threading.RLock()
+
+        for rfc in rfcs:
+            self.add(rfc)
+
+    @property
+    def version_tag(self) -> str:
+        return f"{self.epoch}:{self.version}"
+
+    def add(self, rfc: RFC) -> None:
+        with self.lock:
+            self.local[rfc.number] = rfc
+            self.version += 1
+            self.updated = time.time()
+            self.changes.append((self.version, rfc, True))
+
+    def remove(self, number: int) -> Optional[RFC]:
+        with self.lock:
+            if (rfc := self.local.pop(number, None)) is not None:
+                self.digests.pop(number, None)
+                self.version += 1
+                self.updated = time.time()
+                self.changes.append((self.version, rfc, False))
+            return rfc
+
+    def get(self, number: int, default: Any = None) -> RFC | Any:
+        return self.local.get(number, default)
+
+    def digest(self, rfc: RFC, stat: Optional[os.stat_result] = None) -> Digest:
+        """The digest of a local RFC's file, given its current stat, if known."""
+        path = pathlib.Path(rfc.path)
+        stat = path.stat() if stat is None else stat
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        if (cached := self.digests.get(rfc.number)) is not None and cached[0] == stamp:
+            return cached[1]
+
+        # Hashed outside the lock; at worst, two requests hash the same file.
+        digest = compute_digest(path)
+        self.digests[rfc.number] = (stamp, digest)
+        return digest
+
+    def snapshot(self) -> tuple[str, list[RFC]]:
+        with self.lock:
+            return self.version_tag, list(self.local.values())
+
+    def delta(self, since: str) -> Optional[tuple[str, list[RFC], list[int]]]:
+        """The RFCs added and the numbers removed since the tagged version, or None if
+        that version can't be reached from the change log."""
+        try:
+            epoch, version = map(int, since.split(":"))
+        except ValueError:
+            return None
+
+        with self.lock:
+            if epoch != self.epoch or version > self.version:
+                return None
+            if version < self.version and (
+                len(self.changes) == 0 or self.changes[0][0] > version + 1
+            ):
+                return None
+
+            latest: dict[int, tuple[RFC, bool]] = {}
+            for v, rfc, added in reversed(self.changes):
+                if v <= version:
+                    break
+                latest.setdefault(rfc.number, (rfc, added))
+
+            added = [rfc for rfc, was_added in latest.values() if was_added]
+            removed = [n for n, (_, was_added) in latest.items() if not was_added]
+
+            return self.version_tag, added, removed
+
+    def merge(self, rfcs: Iterable[RFC], holder: Holder) -> None:
+        numbers = self.holdings.setdefault(holder, set())
+
+        for rfc in rfcs:
+            self.remote.setdefault(rfc.number, {})[holder] = rfc
+            numbers.add(rfc.number)
+
+    def sync(
+        self,
+        holder: Holder,
+        version: Optional[str],
+        rfcs: Iterable[RFC],
+        removed: Iterable[int] = (),
+        full: bool = True,
+    ) -> None:
+        """Applies a holder's RFCQuery result: either a full snapshot, replacing
+        everything known about the holder, or a delta on top of it. Holders may be
+        synced from several threads at once."""
+        with self.lock:
+            if full:
+                self.remove_holder(holder)
+            for number in removed:
+                self.remove_holder(holder, number)
+
+            self.merge(rfcs, holder)
+
+            if version is not None:
+                self.versions[holder] = version
+            else:
+                self.versions.pop(holder, None)
+
+    def holders(self, number: int) -> set[Holder]:
+        return set(self.remote.get(number, ()))
+
+    def remove_holder(self, holder: Holder, number: Optional[int] = None) -> None:
+        """Forgets that holder has RFC number, or, if no number is given, forgets the
+        holder entirely."""
+        numbers = self.holdings.get(holder, set())
+        for n in [number] if number is not None else list(numbers):
+            numbers.discard(n)
+
+            if (holders := self.remote.get(n)) is not None:
+                holders.pop(holder, None)
+                if len(holders) == 0:
+                    del self.remote[n]
+
+        if len(numbers) == 0:
+            self.holdings.pop(holder, None)
+            self.versions.pop(holder, None)
+
+    def __contains__(self, number: int) -> bool:
+        return number in self.local
+
+    def __iter__(self) -> Iterator[RFC]:
+        return iter(self.snapshot()[1])
+
+    def __len__(self) -> int:
+        return len(self.local)
+
+    def __repr__(self) -> str:
+        remote = {n: sorted(holders) for n, holders in sorted(self.remote.items())}
+        return f"RFCIndex(local={sorted(self.local)}, remote={remote})"
+
+
 def load_rfc(response: HTTPResponse | HTTPRequest) -> RFC:
     data = json.loads(response.content.decode())
+    data.pop("digest", None)
     return RFC(**data)
 
 
-def dump_rfc(rfc: RFC) -> str:
-    return json.dumps(asdict(rfc), default=str)
+def load_digest(response: HTTPResponse | HTTPRequest) -> Optional[Digest]:
+    """The digest sent with an RFC's metadata, if any."""
+    data = json.loads(response.content.decode())
+
+    if (digest := data.get("digest")) is None:
+        return None
+
+    return Digest(**(digest | {"chunks": tuple(digest["chunks"])}))
+
+
+def dump_rfc(rfc: RFC, digest: Optional[Digest] = None) -> str:
+    data = asdict(rfc)
+    if digest is not None:
+        data["digest"] = asdict(digest)
+    return json.dumps(data, default=str)
 
 
 def load_rfc_index(response: HTTPResponse | HTTPRequest) -> set[RFC]:
@@ -29,5 +220,16 @@ def load_rfc_index(response: HTTPResponse | HTTPRequest) -> set[RFC]:
     return set([RFC(**i) for i in data])
 
 
-def dump_rfc_index(rfc_index: list[RFC]) -> str:
+def dump_rfc_index(rfc_index: Iterable[RFC]) -> str:
     return json.dumps([asdict(i) for i in rfc_index], default=str)
+
+
+def load_rfc_delta(response: HTTPResponse | HTTPRequest) -> tuple[set[RFC], list[int]]:
+    data = json.loads(response.content.decode())
+    return set([RFC(**i) for i in data["added"]]), data["removed"]
+
+
+def dump_rfc_delta(added: Iterable[RFC], removed: Iterable[int]) -> str:
+    return json.dumps(
+        {"added": [asdict(i) for i in added], "removed": list(removed)}, default=str
+    )
@@ -0,0 +1,172 @@
+import contextlib
+import queue
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import *
+
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import Holder
+from src.utils.workers import spawn
+
+# Seconds every peer has to answer, from when the query's sent out.
+DEADLINE = 2.0
+# Most peers queried at once.
+MAX_FANOUT = 64
+
+T = TypeVar("T")
+
+
+@dataclass
+class Match:
+    """An RFC found by a distributed query, and every peer found holding it."""
+
+    number: int
+    title: str
+    holders: set[Holder] = field(default_factory=set)
+    score: float = 0.0
+    snippet: str = ""
+
+
+@dataclass
+class Reply(Generic[T]):
+    """A peer's answer to a scattered query; or, if it failed or missed the deadline,
+    the error."""
+
+    holder: Holder
+    value: Optional[T]
+    error: Optional[BaseException]
+    elapsed: float
+
+
+class Merger:
+    """Merges the matches streaming in from peers, one per RFC: holders are pooled,
+    and the best score, with its snippet, kept. Scores from different peers are
+    each relative to that peer's RFCs, so rankings across peers are approximate."""
+
+    def __init__(self) -> None:
+        self.matches: dict[int, Match] = {}
+
+    def add(self, matches: Iterable[Match]) -> None:
+        for match in matches:
+            if (merged := self.matches.get(match.number)) is None:
+                self.matches[match.number] = Match(
+                    match.number,
+                    match.title,
+                    set(match.holders),
+                    match.score,
+                    match.snippet,
+                )
+                continue
+
+            merged.holders |= match.holders
+            if match.score > merged.score:
+                merged.score, merged.snippet = match.score, match.snippet
+
+    def ranked(self, limit: Optional[int] = None) -> list[Match]:
+        matches = sorted(self.matches.values(), key=lambda m: (-m.score, m.number))
+        return matches[:limit]
+
+
+class Scatter(Generic[T]):
+    """Sends a query to every holder at once, over pooled connections, and yields
+    each reply as it arrives, fastest first. Every peer must answer by deadline
+    seconds after iteration starts; its socket's timeout is set to whatever time
+    is left. Once the deadline passes, or the caller stops iterating, stragglers are
+    cancelled: their connections shut down, so any blocked on them give up at once,
+    and those not yet started never are. Stragglers are yielded last, as timed out.
+
+    exchange is given a holder and a connection to it, and returns its answer."""
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        holders: Iterable[Holder],
+        exchange: Callable[[Holder, socket.socket], T],
+        deadline: float = DEADLINE,
+        max_fanout: int = MAX_FANOUT,
+    ) -> None:
+        self.pool = pool
+        self.holders = list(dict.fromkeys(holders))
+        self.exchange = exchange
+        self.timeout = deadline
+        self.max_fanout = max_fanout
+
+        self.start = self.deadline = 0.0
+        self.cancelled = threading.Event()
+        self.in_flight: set[socket.socket] = set()
+        self.lock = threading.Lock()
+
+    def ask(self, holder: Holder) -> Reply[T]:
+        def timed(peer_socket: socket.socket) -> T:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0 or self.cancelled.is_set():
+                raise TimeoutError("No time left to ask")
+
+            timeout = peer_socket.gettimeout()
+            peer_socket.settimeout(remaining)
+            with self.lock:
+                self.in_flight.add(peer_socket)
+
+            try:
+                return self.exchange(holder, peer_socket)
+            finally:
+                with self.lock:
+                    self.in_flight.discard(peer_socket)
+                peer_socket.settimeout(timeout)
+
+        start = time.monotonic()
+        try:
+            value = self.pool.request(holder, timed)
+        except Exception as e:
+            return Reply(holder, None, e, time.monotonic() - start)
+
+        return Reply(holder, value, None, time.monotonic() - start)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+        with self.lock:
+            for peer_socket in self.in_flight:
+                with contextlib.suppress(OSError):
+                    peer_socket.shutdown(socket.SHUT_RDWR)
+
+    def work(self, holders: queue.SimpleQueue, replies: queue.SimpleQueue) -> None:
+        while not self.cancelled.is_set():
+            try:
+                holder = holders.get_nowait()
+            except queue.Empty:
+                return
+            replies.put(self.ask(holder))
+
+    def __iter__(self) -> Iterator[Reply[T]]:
+        if not self.holders:
+            return
+
+        self.start = time.monotonic()
+        self.deadline = self.start + self.timeout
+        holders, replies = queue.SimpleQueue(), queue.SimpleQueue()
+        for holder in self.holders:
+            holders.put(holder)
+
+        for _ in range(min(len(self.holders), self.max_fanout)):
+            spawn(self.work, holders, replies)
+
+        unanswered = dict.fromkeys(self.holders)
+        try:
+            for _ in range(len(self.holders)):
+                try:
+                    remaining = max(0.0, self.deadline - time.monotonic())
+                    reply = replies.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                del unanswered[reply.holder]
+                yield reply
+
+            self.cancel()
+            for holder in unanswered:
+                error = TimeoutError("Missed the deadline")
+                yield Reply(holder, None, error, time.monotonic() - self.start)
+        finally:
+            self.cancel()
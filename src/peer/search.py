@@ -0,0 +1,384 @@
+import heapq
+import itertools
+import json
+import math
+import operator
+import os
+import pathlib
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from typing import *
+
+from src.peer.rfc import RFC, RFCIndex
+from src.utils.http import HTTPRequest, HTTPResponse
+
+SEARCH_DIR = pathlib.Path(tempfile.gettempdir(), "p2pdi", "search")
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+# Bytes of the RFC shown around a match.
+SNIPPET_SIZE = 160
+# Seconds before the files behind an unchanged RFCIndex are checked for changes.
+RESYNC_AFTER = 1.0
+
+# BM25 parameters: term frequency saturation, and document length normalisation.
+K1 = 1.2
+B = 0.75
+
+# Postings compress to a third; higher levels save little more, at several times
+# the cost.
+COMPRESS_LEVEL = 1
+
+TOKEN = re.compile(rb"[a-z0-9]+")
+
+INDEX_MAGIC = b"P2PF"
+INDEX_VERSION = 1
+# magic, version, documents, terms, strings length, vocabulary length, postings,
+# positions
+INDEX_HEADER = struct.Struct("!4sBIIIIII")
+# number, size, mtime_ns, length in tokens
+INDEX_DOCUMENT = struct.Struct("!IQQI")
+
+
+@dataclass
+class Document:
+    number: int
+    path: str
+    title: str
+    size: int
+    mtime_ns: int
+    length: int
+
+
+@dataclass(frozen=True)
+class Hit:
+    number: int
+    title: str
+    score: float
+    snippet: str
+
+
+def tokenize(text: bytes) -> Iterator[re.Match]:
+    return TOKEN.finditer(text.lower())
+
+
+def query_terms(query: str) -> set[bytes]:
+    return {match[0] for match in tokenize(query.encode(errors="ignore"))}
+
+
+def snippet(path: str, offset: int, size: int = SNIPPET_SIZE) -> str:
+    """The text around offset in path, on one line, without partial words at
+    either end."""
+    start = max(0, offset - size // 2)
+
+    try:
+        with open(path, "rb") as file:
+            file.seek(start)
+            data = file.read(size)
+    except OSError:
+        return ""
+
+    words = data.decode(errors="replace").split()
+    if start > 0 and data[:1].strip():
+        words = words[1:]
+    if len(data) == size and data[-1:].strip():
+        words = words[:-1]
+
+    return " ".join(words)
+
+
+def deltas(positions: array) -> Iterator[int]:
+    return map(operator.sub, positions, itertools.chain((0,), positions))
+
+
+class SearchIndex:
+    """An inverted index over the contents of a peer's local RFCs: each term maps
+    to the RFCs it appears in, and the byte offsets it appears at, from which
+    matches are ranked by BM25 and snippets cut. The index follows its RFCIndex,
+    indexing only RFCs added, or whose files changed, since it last looked, and is
+    saved to path after each change, compressed, so a restart needn't reread every
+    file. Nothing's read until the first search."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        self.documents: dict[int, Document] = {}
+        self.postings: dict[bytes, dict[int, array]] = {}
+        self.total_length = 0
+
+        self.loaded = False
+        self.version: Optional[int] = None
+        self.checked = -math.inf
+        self.lock = threading.Lock()
+        self.saving: Optional[threading.Thread] = None
+
+    def add(self, rfc: RFC, stat: os.stat_result) -> None:
+        path = str(rfc.path)
+        with open(path, "rb") as file:
+            text = file.read()
+
+        positions: dict[bytes, array] = defaultdict(lambda: array("I"))
+        length = 0
+        for length, match in enumerate(tokenize(text), 1):
+            positions[match[0]].append(match.start())
+
+        for term, offsets in positions.items():
+            self.postings.setdefault(term, {})[rfc.number] = offsets
+
+        self.documents[rfc.number] = Document(
+            rfc.number, path, rfc.title, stat.st_size, stat.st_mtime_ns, length
+        )
+        self.total_length += length
+
+    def remove(self, numbers: set[int]) -> None:
+        """Drops every RFC in numbers, in a single pass over the vocabulary."""
+        if not numbers:
+            return
+
+        for number in numbers:
+            self.total_length -= self.documents.pop(number).length
+
+        for term, posting in list(self.postings.items()):
+            for number in numbers & posting.keys():
+                del posting[number]
+            if not posting:
+                del self.postings[term]
+
+    def sync(self, rfc_index: RFCIndex) -> None:
+        """Brings the index up to date with rfc_index's local RFCs, and their files;
+        a no-op if neither has changed since the last time."""
+        with self.lock:
+            now = time.monotonic()
+            if rfc_index.version == self.version and now - self.checked < RESYNC_AFTER:
+                return
+
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+
+            self.version, self.checked = rfc_index.version, now
+
+            current: dict[int, tuple[RFC, os.stat_result]] = {}
+            for rfc in rfc_index:
+                try:
+                    current[rfc.number] = rfc, os.stat(rfc.path)
+                except OSError:
+                    pass
+
+            stale = {
+                number
+                for number, document in self.documents.items()
+                if number not in current
+                or (document.path, document.title, document.size, document.mtime_ns)
+                != (
+                    str(current[number][0].path),
+                    current[number][0].title,
+                    current[number][1].st_size,
+                    current[number][1].st_mtime_ns,
+                )
+            }
+            self.remove(stale)
+
+            added = 0
+            for number, (rfc, stat) in current.items():
+                if number in self.documents:
+                    continue
+                try:
+                    self.add(rfc, stat)
+                    added += 1
+                except OSError as e:
+                    print("Search: ", e, file=sys.stderr)
+
+            if stale or added:
+                self.save()
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list[Hit]:
+        """The limit best matches for query, by BM25, best first. Each hit's snippet
+        surrounds the first occurrence of its rarest matching term."""
+        terms = query_terms(query)
+
+        with self.lock:
+            if not self.documents:
+                return []
+
+            count = len(self.documents)
+            average = self.total_length / count
+            scores: dict[int, float] = defaultdict(float)
+            # For each RFC, the weight of its rarest matching term, and its offset.
+            rarest: dict[int, tuple[float, int]] = {}
+
+            for term in terms:
+                if (posting := self.postings.get(term)) is None:
+                    continue
+
+                idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+                for number, offsets in posting.items():
+                    tf = len(offsets)
+                    norm = K1 * (1 - B + B * self.documents[number].length / average)
+                    scores[number] += idf * tf * (K1 + 1) / (tf + norm)
+
+                    if idf > rarest.get(number, (-1.0, 0))[0]:
+                        rarest[number] = idf, offsets[0]
+
+            best = heapq.nlargest(limit, scores.items(), key=operator.itemgetter(1))
+            matches = [(self.documents[n], score, rarest[n][1]) for n, score in best]
+
+        # Snippets are read from the files outside the lock.
+        return [
+            Hit(d.number, d.title, round(score, 4), snippet(d.path, offset))
+            for d, score, offset in matches
+        ]
+
+    def save(self, wait: bool = False) -> None:
+        """Packs the index, with the lock held, then compresses and writes it out in
+        the background, unless wait is set."""
+        body = self.encode()
+
+        if self.saving is not None:
+            self.saving.join()
+        self.saving = threading.Thread(target=self.write, args=(body,), daemon=True)
+        self.saving.start()
+
+        if wait:
+            self.saving.join()
+
+    def encode(self) -> bytes:
+        """A table of RFCs, the vocabulary, then every posting's RFC numbers, term
+        frequencies, and delta encoded offsets. Arrays are in native byte order; the
+        file is a cache of this machine's."""
+        documents = list(self.documents.values())
+        terms = list(self.postings)
+
+        strings = "\0".join(f"{d.path}\0{d.title}" for d in documents).encode()
+        vocabulary = b"\0".join(terms)
+        counts = array("I", (len(self.postings[term]) for term in terms))
+        numbers, frequencies, offsets = array("I"), array("I"), array("I")
+
+        for term in terms:
+            posting = self.postings[term]
+            numbers.extend(posting)
+            frequencies.extend(map(len, posting.values()))
+            for positions in posting.values():
+                offsets.extend(deltas(positions))
+
+        header = INDEX_HEADER.pack(
+            INDEX_MAGIC,
+            INDEX_VERSION,
+            len(documents),
+            len(terms),
+            len(strings),
+            len(vocabulary),
+            len(numbers),
+            len(offsets),
+        )
+        table = b"".join(
+            INDEX_DOCUMENT.pack(d.number, d.size, d.mtime_ns, d.length)
+            for d in documents
+        )
+        return b"".join(
+            [
+                header,
+                table,
+                strings,
+                vocabulary,
+                counts.tobytes(),
+                numbers.tobytes(),
+                frequencies.tobytes(),
+                offsets.tobytes(),
+            ]
+        )
+
+    def write(self, body: bytes) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.path.parent)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(zlib.compress(body, COMPRESS_LEVEL))
+            os.replace(temp, self.path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def load(self) -> None:
+        try:
+            body = zlib.decompress(self.path.read_bytes())
+        except FileNotFoundError:
+            return
+        except zlib.error as e:
+            print(f"Search: ignoring {self.path}: {e}", file=sys.stderr)
+            return
+
+        (
+            magic,
+            version,
+            document_count,
+            term_count,
+            strings_length,
+            vocabulary_length,
+            posting_count,
+            offset_count,
+        ) = INDEX_HEADER.unpack_from(body)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            print(f"Search: ignoring {self.path}: unknown format", file=sys.stderr)
+            return
+
+        start = INDEX_HEADER.size
+        end = start + INDEX_DOCUMENT.size * document_count
+        table = INDEX_DOCUMENT.iter_unpack(body[start:end])
+        strings = body[end : end + strings_length].decode().split("\0")
+        start = end + strings_length
+        vocabulary = body[start : start + vocabulary_length].split(b"\0")
+        start += vocabulary_length
+
+        def take(count: int) -> array:
+            nonlocal start
+            values = array("I")
+            values.frombytes(body[start : start + count * values.itemsize])
+            start += count * values.itemsize
+            return values
+
+        counts = take(term_count)
+        numbers = take(posting_count)
+        frequencies = take(posting_count)
+        offsets = take(offset_count)
+
+        for (number, size, mtime_ns, length), path, title in zip(
+            table, strings[::2], strings[1::2]
+        ):
+            self.documents[number] = Document(
+                number, path, title, size, mtime_ns, length
+            )
+            self.total_length += length
+
+        posting, position = 0, 0
+        for term, count in zip(vocabulary, counts):
+            entries = {}
+            for number, frequency in zip(
+                numbers[posting : posting + count],
+                frequencies[posting : posting + count],
+            ):
+                entries[number] = array(
+                    "I", itertools.accumulate(offsets[position : position + frequency])
+                )
+                position += frequency
+            self.postings[term] = entries
+            posting += count
+
+
+def search_path(hostname: str, port: int) -> pathlib.Path:
+    return SEARCH_DIR.joinpath(f"{hostname}-{port}.idx")
+
+
+def load_hits(response: HTTPResponse | HTTPRequest) -> list[Hit]:
+    data = json.loads(response.content.decode())
+    return [Hit(**hit) for hit in data]
+
+
+def dump_hits(hits: Iterable[Hit]) -> str:
+    return json.dumps([asdict(hit) for hit in hits])
@@ -1,107 +1,568 @@
+import asyncio
+import json
 import pathlib
 import socket
 import sys
 import threading
+import time
+from contextvars import copy_context
 from enum import Enum, auto
 from typing import *
 
-from src.peer.rfc import RFC, dump_rfc, dump_rfc_index
-from src.server.server import TIMEOUT
+from src.peer.cache import ResponseCache
+from src.peer.dht import (
+    RECORD_TTL,
+    DHTNode,
+    Republisher,
+    dump_contacts,
+    load_sender,
+)
+from src.peer.gossip import (
+    GossipNode,
+    Gossiper,
+    digest_versions,
+    dump_entries,
+    dump_versions,
+    load_versions,
+)
+from src.peer.indexer import DirectoryWatcher, Indexer
+from src.peer.rfc import RFC, RFCIndex, dump_rfc, dump_rfc_delta, dump_rfc_index
+from src.peer.search import (
+    MAX_SEARCH_LIMIT,
+    SEARCH_LIMIT,
+    SearchIndex,
+    dump_hits,
+    search_path,
+)
+from src.server.server import BACKLOG, TIMEOUT, ServerMode
 from src.utils.http import (
+    FAIL_CODE,
     FAIL_RESPONSE,
+    PROTOCOL,
     SUCCESS_CODE,
+    FileResponse,
     HTTPRequest,
+    Response,
+    async_send_response,
     http_response,
     make_response,
+    negotiate,
+    parse_range,
+    parse_request,
+    send_response,
+    with_headers,
 )
-from src.utils.utils import recv_message, send_message, timethat
+from src.utils.encoding import (
+    ACCEPT_ENCODING,
+    CONTENT_ENCODING,
+    MIN_ENCODE_SIZE,
+    EncodedCache,
+    Encoding,
+    choose_encoding,
+    encode,
+)
+from src.utils.metrics import Counter, Histogram, ServerMetrics
+from src.utils.utils import async_recv_message, recv_message
+from src.utils.workers import WorkerPool
+
+# Compressed RFC bodies, shared by every peer server in the process.
+ENCODED_CACHE = EncodedCache()
+# Whole GetRFC responses for hot RFCs, likewise shared.
+RESPONSE_CACHE = ResponseCache()
+# Threads handling requests for each asyncio peer server.
+HANDLER_WORKERS = 16
 
 
 class P2PCommands(Enum):
     rfcquery = auto()
     getrfc = auto()
     leave = auto()
+    stats = auto()
+    search = auto()
+    findnode = auto()
+    findvalue = auto()
+    store = auto()
+    gossip = auto()
+
+
+def encoded(
+    request: HTTPRequest, headers: dict[str, str], body: str
+) -> tuple[int, dict[str, str], bytes]:
+    """A success response carrying body, compressed if the request accepts it and it
+    is large enough to be worth it."""
+    body = body.encode()
+    encoding = choose_encoding(request.headers.get(ACCEPT_ENCODING))
+
+    if encoding is not Encoding.identity and len(body) >= MIN_ENCODE_SIZE:
+        headers[CONTENT_ENCODING] = encoding.name
+        body = encode(body, encoding)
+
+    return SUCCESS_CODE, headers, body
 
 
 @http_response
-def rfc_query(request: HTTPRequest, rfc_index: set[RFC]):
-    return SUCCESS_CODE, {}, dump_rfc_index(rfc_index)
+def rfc_query(request: HTTPRequest, rfc_index: RFCIndex):
+    if (since := request.headers.get("Index-Version")) is not None and (
+        delta := rfc_index.delta(since)
+    ) is not None:
+        version, added, removed = delta
+        headers = {"Index-Version": version, "Index-Sync": "delta"}
+
+        return encoded(request, headers, dump_rfc_delta(added, removed))
+
+    version, rfcs = rfc_index.snapshot()
+    headers = {"Index-Version": version, "Index-Sync": "full"}
+
+    return encoded(request, headers, dump_rfc_index(rfcs))
 
 
-@timethat
-def get_rfc(
-    request: HTTPRequest, rfc_index: set[RFC], peer_socket: socket.socket
-) -> Optional[bytes]:
-    rfc_number = int(request.headers["RFC-Number"])
-    rfcs = [i for i in rfc_index if i.number == rfc_number]
+def get_one_rfc(
+    rfc_number: int,
+    rfc_index: RFCIndex,
+    byte_range: Optional[str] = None,
+    encoding: Encoding = Encoding.identity,
+) -> list[Response]:
+    headers = {"RFC-Number": str(rfc_number)}
 
-    if len(rfcs) == 0:
-        return FAIL_RESPONSE()
+    if (rfc := rfc_index.get(rfc_number)) is None:
+        return [make_response(FAIL_CODE, headers)]
+
+    # Whole RFCs are answered from RESPONSE_CACHE, where they're hot enough to be.
+    key = (rfc, encoding, PROTOCOL.get())
+    if byte_range is None and (cached := RESPONSE_CACHE.get(key)) is not None:
+        return [cached]
 
-    rfc = rfcs[0]
     filepath = pathlib.Path(rfc.path)
 
     if not filepath.is_file():
-        return FAIL_RESPONSE()
+        return [make_response(FAIL_CODE, headers)]
 
-    response = make_response(SUCCESS_CODE, body=dump_rfc(rfc))
-    send_message(response, peer_socket)
+    stat = filepath.stat()
+    size = stat.st_size
 
-    with filepath.open("rb") as file:
-        return make_response(SUCCESS_CODE, body=file.read())
+    if byte_range is not None:
+        if (byte_range := parse_range(byte_range, size)) is None:
+            return [make_response(FAIL_CODE, headers)]
 
+    headers["RFC-Size"] = str(size)
+    digest = rfc_index.digest(rfc, stat)
+    response = make_response(SUCCESS_CODE, headers, dump_rfc(rfc, digest))
 
-def server_receiver(rfc_index: set[RFC], peer_socket: socket.socket) -> None:
-    def handle(request: HTTPRequest) -> bytes:
-        match (command := P2PCommands[request.command.lower()]):
-            case P2PCommands.rfcquery:
-                return rfc_query(request, rfc_index)
-            case P2PCommands.getrfc:
-                return get_rfc(
-                    request,
-                    rfc_index,
-                    peer_socket,
-                )
-            case P2PCommands.leave:
-                raise Exception("Peer leaving")
-            case _:
-                return FAIL_RESPONSE()
+    # Ranges are of the file itself, so are always served unencoded.
+    if byte_range is not None:
+        return [response, FileResponse(filepath, byte_range=byte_range)]
+
+    body = FileResponse(filepath)
+    if encoding is not Encoding.identity:
+        # Until its variant is built, the RFC goes out unencoded, and uncached.
+        if not ENCODED_CACHE.ready(filepath, encoding):
+            return [response, body]
+        if (variant := ENCODED_CACHE.get(filepath, encoding)) is not None:
+            body = FileResponse(variant, headers={CONTENT_ENCODING: encoding.name})
+
+    return RESPONSE_CACHE.fill(key, filepath, stat, [response, body])
+
+
+def get_rfc(request: HTTPRequest, rfc_index: RFCIndex) -> list[Response]:
+    """Serves one or more RFCs; a batch names several comma-separated RFC-Numbers.
+    Each RFC is answered in turn, in request order, with its metadata (including its
+    digest) then its body, or with a single failure response. Bodies are sent
+    compressed, from ENCODED_CACHE, if the request's Accept-Encoding allows and the
+    variant has been built; whole RFCs small enough are kept in RESPONSE_CACHE, ready
+    to send."""
+    rfc_numbers = [int(n) for n in request.headers["RFC-Number"].split(",")]
+    byte_range = request.headers.get("Range")
+    encoding = choose_encoding(request.headers.get(ACCEPT_ENCODING))
+
+    if len(rfc_numbers) > 1 and byte_range is not None:
+        return [FAIL_RESPONSE()]
+
+    return [
+        response
+        for rfc_number in rfc_numbers
+        for response in get_one_rfc(rfc_number, rfc_index, byte_range, encoding)
+    ]
+
+
+@http_response
+def search_rfcs(request: HTTPRequest, rfc_index: RFCIndex, search_index: SearchIndex):
+    """Ranks the local RFCs against the Query header's terms, answering with up to
+    Limit hits, best first."""
+    query = request.headers.get("Query", "")
+    limit = min(int(request.headers.get("Limit", SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+
+    search_index.sync(rfc_index)
+    hits = search_index.search(query, limit)
+
+    return encoded(request, {}, dump_hits(hits))
+
+
+@http_response
+def stats(request: HTTPRequest, metrics: ServerMetrics):
+    content_type, body = metrics.render(request.headers.get("Accept"))
+    return SUCCESS_CODE, {"Content-Type": content_type}, body
+
+
+@http_response
+def find_node(request: HTTPRequest, dht: Optional[DHTNode]):
+    """The nodes this peer knows of closest to the Key header's ID."""
+    if dht is None:
+        return (FAIL_CODE,)
+
+    key = int(request.headers["Key"], 16)
+    contacts = dht.find_node(load_sender(request), key)
+
+    return SUCCESS_CODE, dht.headers(), dump_contacts(contacts)
+
+
+@http_response
+def find_value(request: HTTPRequest, dht: Optional[DHTNode]):
+    """As find_node, with any holders of the RFC whose key the Key header is."""
+    if dht is None:
+        return (FAIL_CODE,)
+
+    key = int(request.headers["Key"], 16)
+    contacts, holders = dht.find_value(load_sender(request), key)
+
+    return SUCCESS_CODE, dht.headers(), dump_contacts(contacts, holders)
+
+
+@http_response
+def store(request: HTTPRequest, dht: Optional[DHTNode]):
+    """Records the holders in the body as holding the RFC-Number header's RFC, for
+    TTL seconds, up to RECORD_TTL."""
+    if dht is None:
+        return (FAIL_CODE,)
+
+    holders = [tuple(holder) for holder in json.loads(request.content.decode())]
+    ttl = min(float(request.headers.get("TTL", RECORD_TTL)), RECORD_TTL)
+    dht.store(load_sender(request), int(request.headers["RFC-Number"]), holders, ttl)
+
+    return SUCCESS_CODE, dht.headers()
+
+
+@http_response
+def exchange_digest(
+    request: HTTPRequest, rfc_index: RFCIndex, gossip: Optional[GossipNode]
+):
+    """Given the peers whose entries are wanted, in the body, the entries newer than
+    the versions given. Otherwise, this peer's digest, unless its hash is the
+    Index-Digest header's, marked Index-Sync: same."""
+    if gossip is None:
+        return (FAIL_CODE,)
+
+    if "Node-Host" in request.headers:
+        gossip.heard_from((request.headers["Node-Host"], int(request.headers["Port"])))
+
+    if request.content:
+        entries = gossip.entries(rfc_index, load_versions(request))
+        return encoded(request, {}, dump_entries(entries))
+
+    versions = gossip.versions(rfc_index)
+    if request.headers.get("Index-Digest") == digest_versions(versions):
+        return SUCCESS_CODE, {"Index-Sync": "same"}
+
+    return encoded(request, {"Index-Sync": "digest"}, dump_versions(versions))
+
+
+def handle(
+    request: HTTPRequest,
+    rfc_index: RFCIndex,
+    search_index: SearchIndex,
+    metrics: ServerMetrics,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+) -> list[Response]:
+    """Dispatches a request, returning the responses to send back, in order."""
+    match (command := P2PCommands[request.command.lower()]):
+        case P2PCommands.rfcquery:
+            return [rfc_query(request, rfc_index)]
+        case P2PCommands.getrfc:
+            return get_rfc(request, rfc_index)
+        case P2PCommands.leave:
+            raise Exception("Peer leaving")
+        case P2PCommands.stats:
+            return [stats(request, metrics)]
+        case P2PCommands.search:
+            return [search_rfcs(request, rfc_index, search_index)]
+        case P2PCommands.findnode:
+            return [find_node(request, dht)]
+        case P2PCommands.findvalue:
+            return [find_value(request, dht)]
+        case P2PCommands.store:
+            return [store(request, dht)]
+        case P2PCommands.gossip:
+            return [exchange_digest(request, rfc_index, gossip)]
+        case _:
+            return [FAIL_RESPONSE()]
+
+
+def respond(
+    request: HTTPRequest,
+    rfc_index: RFCIndex,
+    search_index: SearchIndex,
+    metrics: ServerMetrics,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+) -> Iterator[Response]:
+    """Handles a request, answering in its protocol, and tagging each response with
+    the request's Request-ID, if it has one, so that pipelined responses can be
+    matched to their requests."""
+    tags = negotiate(request)
+
+    if (request_id := request.headers.get("Request-ID")) is not None:
+        tags["Request-ID"] = request_id
+
+    for response in handle(request, rfc_index, search_index, metrics, dht, gossip):
+        if tags:
+            response = with_headers(response, tags)
+        yield response
+
+
+def server_receiver(
+    rfc_index: RFCIndex,
+    search_index: SearchIndex,
+    peer_socket: socket.socket,
+    metrics: ServerMetrics,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+) -> None:
+    metrics.connections.inc()
 
     try:
         while message := recv_message(peer_socket):
-            request = HTTPRequest(message)
-            if (response := handle(request)) is not None:
-                send_message(response, peer_socket)
+            start = time.perf_counter()
+            request = parse_request(message)
+            sent = 0
+            for response in respond(
+                request, rfc_index, search_index, metrics, dht, gossip
+            ):
+                sent += send_response(response, peer_socket)
+            metrics.observe_request(
+                request.command.lower(),
+                time.perf_counter() - start,
+                len(message),
+                sent,
+            )
 
     except Exception as e:
         print("Peer: ", e, file=sys.stderr)
     finally:
+        metrics.connections.dec()
         peer_socket.close()
         sys.exit(0)
 
 
+async def async_server_receiver(
+    rfc_index: RFCIndex,
+    search_index: SearchIndex,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    metrics: ServerMetrics,
+    workers: WorkerPool,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+) -> None:
+    """As server_receiver, from the event loop. Requests are handled by workers, as
+    hashing, compressing, and indexing would otherwise hold up every other
+    connection; the protocol negotiated there is carried back, to send in."""
+    metrics.connections.inc()
+
+    try:
+        while message := await async_recv_message(reader):
+            start = time.perf_counter()
+            request = parse_request(message)
+            context = copy_context()
+            responses = await workers.call(
+                lambda: context.run(
+                    list,
+                    respond(request, rfc_index, search_index, metrics, dht, gossip),
+                )
+            )
+            PROTOCOL.set(context[PROTOCOL])
+
+            sent = 0
+            for response in responses:
+                sent += await async_send_response(response, writer)
+            metrics.observe_request(
+                request.command.lower(),
+                time.perf_counter() - start,
+                len(message),
+                sent,
+            )
+
+    except Exception as e:
+        print("Peer: ", e, file=sys.stderr)
+    finally:
+        metrics.connections.dec()
+        writer.close()
+
+
+def threaded_server(
+    server_socket: socket.socket,
+    rfc_index: RFCIndex,
+    search_index: SearchIndex,
+    metrics: ServerMetrics,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+) -> None:
+    while True:
+        conn, _ = server_socket.accept()
+        # Responses go out as several writes (e.g. GetRFC's metadata, then its body);
+        # Nagle's algorithm would hold each back until the last is acknowledged.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        t = threading.Thread(
+            target=server_receiver,
+            args=(rfc_index, search_index, conn, metrics, dht, gossip),
+        )
+        t.start()
+
+
+async def async_server(
+    server_socket: socket.socket,
+    rfc_index: RFCIndex,
+    search_index: SearchIndex,
+    metrics: ServerMetrics,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
+) -> None:
+    workers = WorkerPool(HANDLER_WORKERS)
+
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer_socket = writer.get_extra_info("socket")
+        peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await async_server_receiver(
+            rfc_index, search_index, reader, writer, metrics, workers, dht, gossip
+        )
+
+    server = await asyncio.start_server(on_connect, sock=server_socket, backlog=BACKLOG)
+
+    async with server:
+        await server.serve_forever()
+
+
+def collect_cache_metrics(metrics: ServerMetrics, cache: ResponseCache) -> None:
+    metrics.collect(
+        "p2pdi_response_cache_hits_total", lambda: cache.hits, "Cache hits", Counter
+    )
+    metrics.collect(
+        "p2pdi_response_cache_misses_total",
+        lambda: cache.misses,
+        "Cache misses",
+        Counter,
+    )
+    metrics.collect(
+        "p2pdi_response_cache_evictions_total",
+        lambda: cache.evictions,
+        "Entries evicted to stay within budget",
+        Counter,
+    )
+    metrics.collect(
+        "p2pdi_response_cache_bytes", lambda: cache.size, "Bytes of responses cached"
+    )
+
+
+def collect_gossip_metrics(metrics: ServerMetrics, gossip: GossipNode) -> None:
+    metrics.collect(
+        "p2pdi_gossip_rounds_total", lambda: gossip.rounds.value, "Rounds", Counter
+    )
+    metrics.collect(
+        "p2pdi_gossip_bytes_total",
+        lambda: gossip.exchanged.value,
+        "Bytes of digests sent and entries received",
+        Counter,
+    )
+    metrics.collect(
+        "p2pdi_gossip_round_bytes",
+        lambda: gossip.round_bytes,
+        "Bytes exchanged per round",
+        Histogram,
+    )
+    metrics.collect(
+        "p2pdi_gossip_lag_seconds",
+        lambda: gossip.lag,
+        "Time from a peer's index changing to its entry arriving",
+        Histogram,
+    )
+    metrics.collect(
+        "p2pdi_gossip_peers", lambda: len(gossip.view.versions), "Peers' indexes known"
+    )
+
+
 def server(
     hostname: str,
     port: str,
-    rfc_index: set[RFC] = None,
+    rfc_index: RFCIndex = None,
+    mode: ServerMode = ServerMode.threaded,
+    data_dir: Optional[pathlib.Path] = None,
+    watch: bool = False,
+    dht: Optional[DHTNode] = None,
+    gossip: Optional[GossipNode] = None,
 ) -> None:
+    """Serves rfc_index; or, if only data_dir is given, the RFCs found within it,
+    rescanning it as it changes if watch is set. Given a DHT node, answers its
+    requests, and publishes the local RFCs to it once it's joined; given a gossip
+    node, answers its digests, and gossips the global index through it."""
     address = (hostname, port)
-    print(f"Started peer server on {address}")
+    print(f"Started peer server on {address} ({mode.name})")
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(address)
-    server_socket.listen(32)
+    server_socket.listen(BACKLOG)
+
+    watcher = None
+    if rfc_index is None and data_dir is not None:
+        indexer = Indexer(data_dir, hostname)
+        rfc_index = indexer.index()
+        if watch:
+            watcher = DirectoryWatcher(indexer, rfc_index)
+            watcher.start()
+    elif rfc_index is None:
+        rfc_index = RFCIndex()
+
+    search_index = SearchIndex(search_path(hostname, port))
+
+    metrics = ServerMetrics()
+    metrics.collect("p2pdi_local_rfcs", lambda: len(rfc_index.local), "RFCs held")
+    metrics.collect(
+        "p2pdi_search_rfcs", lambda: len(search_index.documents), "RFCs searchable"
+    )
+    collect_cache_metrics(metrics, RESPONSE_CACHE)
 
-    if rfc_index is None:
-        rfc_index: set[RFC] = set()
+    republisher = None
+    if dht is not None:
+        republisher = Republisher(dht, rfc_index)
+        republisher.start()
+        metrics.collect("p2pdi_dht_contacts", lambda: len(dht.table), "Known nodes")
+        metrics.collect(
+            "p2pdi_dht_records", lambda: len(dht.records), "RFC keys stored"
+        )
+
+    gossiper = None
+    if gossip is not None:
+        gossiper = Gossiper(gossip, rfc_index)
+        gossiper.start()
+        collect_gossip_metrics(metrics, gossip)
 
     try:
-        while True:
-            conn, _ = server_socket.accept()
-            t = threading.Thread(
-                target=server_receiver,
-                args=(rfc_index, conn),
-            )
-            t.start()
+        match mode:
+            case ServerMode.threaded:
+                threaded_server(
+                    server_socket, rfc_index, search_index, metrics, dht, gossip
+                )
+            case ServerMode.asyncio:
+                asyncio.run(
+                    async_server(
+                        server_socket, rfc_index, search_index, metrics, dht, gossip
+                    )
+                )
     except KeyboardInterrupt:
         pass
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if republisher is not None:
+            republisher.cancel()
+        if gossiper is not None:
+            gossiper.cancel()
@@ -0,0 +1,278 @@
+import contextlib
+import pathlib
+import socket
+import sys
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import *
+
+from src.peer.pool import ConnectionPool
+from src.peer.rfc import RFC, Holder, load_digest, load_rfc
+from src.peer.server import P2PCommands
+from src.utils.http import (
+    PARTIAL_CODE,
+    SUCCESS_CODE,
+    http_request,
+    recv_file_response,
+    send_recv_http_request,
+)
+from src.utils.digest import Digest, VerifyingWriter, compute_digest, new_part
+from src.utils.workers import spawn
+
+OUT_DIR = pathlib.Path("out/")
+RANGE_SIZE = 1 << 20
+WORKERS_PER_HOLDER = 2
+MAX_FAILURES = 3
+# How many workers may fetch the same range at once, once there's nothing left to
+# hand out; the first to finish wins, so one slow holder can't hold up the download.
+MAX_DUPLICATES = 2
+# How long a range fetch may wait on its holder for each read or write, before giving
+# the range up to another.
+RANGE_TIMEOUT = 10.0
+
+
+@http_request
+def get_rfc_range(hostname: str, rfc_number: int, start: int, end: int):
+    headers = {"RFC-Number": rfc_number, "Range": f"bytes={start}-{end}"}
+    return P2PCommands.getrfc, hostname, headers
+
+
+@dataclass(eq=False)
+class Span:
+    start: int
+    end: int
+    done: bool = False
+    fetching: int = 0
+
+
+class SpanScheduler:
+    """Hands out byte ranges to workers as they ask for them, so faster holders
+    naturally take on more of the file. Once every range has been handed out, idle
+    workers duplicate ranges still in flight."""
+
+    def __init__(self, size: int, range_size: int, start: int = 0) -> None:
+        self.spans = [
+            Span(i, min(i + range_size, size) - 1)
+            for i in range(start, size, range_size)
+        ]
+        self.queue = deque(self.spans)
+        self.remaining = len(self.spans)
+        self.condition = threading.Condition()
+
+    def next(self) -> Optional[Span]:
+        with self.condition:
+            while self.remaining > 0:
+                if self.queue:
+                    span = self.queue.popleft()
+                else:
+                    in_flight = [
+                        span
+                        for span in self.spans
+                        if not span.done and 0 < span.fetching < MAX_DUPLICATES
+                    ]
+                    if len(in_flight) == 0:
+                        self.condition.wait()
+                        continue
+                    span = min(in_flight, key=lambda span: span.fetching)
+
+                span.fetching += 1
+                return span
+
+            return None
+
+    def complete(self, span: Span) -> None:
+        with self.condition:
+            span.fetching -= 1
+            if not span.done:
+                span.done = True
+                self.remaining -= 1
+            self.condition.notify_all()
+
+    def fail(self, span: Span) -> None:
+        with self.condition:
+            span.fetching -= 1
+            if not span.done and span.fetching == 0:
+                self.queue.appendleft(span)
+            self.condition.notify_all()
+
+
+def whole_chunks(digest: Digest, start: int, end: int, size: int) -> bool:
+    """Whether bytes [start, end] of a file size bytes long are whole chunks."""
+    return start % digest.chunk_size == 0 and (
+        (end + 1) % digest.chunk_size == 0 or end + 1 >= size
+    )
+
+
+def verify(path: pathlib.Path, size: int, digest: Optional[Digest]) -> bool:
+    """Whether the file at path is size bytes long and, given a digest, matches it."""
+    if path.stat().st_size != size:
+        return False
+    if digest is None:
+        return True
+    whole = compute_digest(path, digest.chunk_size, digest.algorithm)
+    return (whole.size, whole.value) == (digest.size, digest.value)
+
+
+def fetch_range(
+    hostname: str,
+    rfc_number: int,
+    start: int,
+    end: int,
+    peer_socket: socket.socket,
+    open_file: Callable[[RFC, int, Optional[Digest]], BinaryIO],
+) -> bool:
+    """Requests bytes [start, end] of an RFC, writing them at the same offset of the
+    file returned by open_file, given the RFC, its full size, and its digest. Ranges
+    of whole chunks are checked against the digest, if there is one; a chunk that
+    fails verification raises ValueError."""
+    request = get_rfc_range(hostname, rfc_number, start, end)
+    response = send_recv_http_request(request, peer_socket)
+
+    if response.status != SUCCESS_CODE:
+        return False
+
+    rfc, size = load_rfc(response), int(response.getheader("RFC-Size"))
+    digest = load_digest(response)
+
+    with open_file(rfc, size, digest) as file:
+        file.seek(start)
+
+        if digest is None or not whole_chunks(digest, start, end, size):
+            response = recv_file_response(peer_socket, file)
+        else:
+            writer = VerifyingWriter(file, digest, start)
+            response = recv_file_response(peer_socket, writer)
+            writer.finish()
+
+    return response.status == PARTIAL_CODE
+
+
+def swarm_get_rfc(
+    rfc_number: int,
+    holders: Iterable[Holder],
+    pool: ConnectionPool,
+    out_dir: pathlib.Path = OUT_DIR,
+    range_size: int = RANGE_SIZE,
+    workers_per_holder: int = WORKERS_PER_HOLDER,
+) -> Optional[pathlib.Path]:
+    """Downloads an RFC from every holder at once, range_size bytes at a time, into
+    out_dir. The first range is fetched up front, to learn the file's name, size and
+    digest. Ranges go into a .part file of the download's own, which is moved into
+    place once every range has arrived, and the whole file matches its digest; any
+    fetches still in flight then, duplicates at slower holders, are cut off. Returns
+    the downloaded file's path, or None if the download couldn't finish."""
+    holders = list(holders)
+    out_filepath: Optional[pathlib.Path] = None
+    part: Optional[pathlib.Path] = None
+    total_size, digest = 0, None
+
+    cancelled = threading.Event()
+    in_flight: set[socket.socket] = set()
+    lock = threading.Lock()
+
+    def timed(
+        hostname: str,
+        start: int,
+        end: int,
+        open_file: Callable[[RFC, int, Optional[Digest]], BinaryIO],
+    ) -> Callable[[socket.socket], bool]:
+        def fetch(peer_socket: socket.socket) -> bool:
+            if cancelled.is_set():
+                return False
+
+            timeout = peer_socket.gettimeout()
+            peer_socket.settimeout(RANGE_TIMEOUT)
+            with lock:
+                in_flight.add(peer_socket)
+
+            try:
+                return fetch_range(
+                    hostname, rfc_number, start, end, peer_socket, open_file
+                )
+            finally:
+                with lock:
+                    in_flight.discard(peer_socket)
+                peer_socket.settimeout(timeout)
+
+        return fetch
+
+    def cancel() -> None:
+        cancelled.set()
+
+        with lock:
+            for peer_socket in in_flight:
+                with contextlib.suppress(OSError):
+                    peer_socket.shutdown(socket.SHUT_RDWR)
+
+    def create_file(rfc: RFC, size: int, rfc_digest: Optional[Digest]) -> BinaryIO:
+        nonlocal out_filepath, part, total_size, digest
+        out_filepath = out_dir.joinpath(pathlib.Path(rfc.path).name)
+        if part is None:
+            part = new_part(out_dir, rfc_number)
+        total_size, digest = size, rfc_digest
+
+        file = part.open("r+b")
+        file.truncate(size)
+        return file
+
+    def open_file(rfc: RFC, size: int, rfc_digest: Optional[Digest]) -> BinaryIO:
+        if size != total_size or rfc_digest != digest:
+            raise ValueError(f"RFC {rfc_number} differs between holders")
+        return part.open("r+b")
+
+    try:
+        for holder in holders:
+            try:
+                hostname, _ = holder
+                fetch = timed(hostname, 0, range_size - 1, create_file)
+                if pool.request(holder, fetch):
+                    break
+            except Exception as e:
+                print("Swarm: ", holder, e, file=sys.stderr)
+        else:
+            return None
+
+        scheduler = SpanScheduler(total_size, range_size, start=range_size)
+
+        def worker(holder: Holder) -> None:
+            hostname, _ = holder
+            failures = 0
+
+            while failures < MAX_FAILURES and (span := scheduler.next()) is not None:
+                fetch = timed(hostname, span.start, span.end, open_file)
+                try:
+                    ok = pool.request(holder, fetch)
+                except Exception as e:
+                    if not cancelled.is_set():
+                        print("Swarm: ", holder, e, file=sys.stderr)
+                    ok = False
+
+                if ok:
+                    scheduler.complete(span)
+                    # The last range is in; duplicates of it elsewhere needn't finish.
+                    if scheduler.remaining == 0:
+                        cancel()
+                else:
+                    scheduler.fail(span)
+                    failures += 1
+
+        workers = [
+            spawn(worker, holder)
+            for holder in holders
+            for _ in range(workers_per_holder)
+        ]
+        for thread in workers:
+            thread.join()
+
+        if scheduler.remaining > 0:
+            return None
+        if not verify(part, total_size, digest):
+            print("Swarm: ", f"RFC {rfc_number} failed verification", file=sys.stderr)
+            return None
+
+        part.replace(out_filepath)
+        return out_filepath
+    finally:
+        if part is not None:
+            part.unlink(missing_ok=True)
@@ -0,0 +1,441 @@
+import collections
+import gc
+import heapq
+import os
+import pathlib
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from enum import IntEnum
+from typing import *
+
+from src.peer.peer import PURGE_AFTER, TTL, Peer, PeerIndex
+from src.utils.workers import spawn
+
+SNAPSHOT_NAME = "peers.snapshot"
+WAL_NAME = "peers.wal"
+# The log being folded into a snapshot, while a new one takes writes.
+OLD_WAL_NAME = "peers.wal.old"
+
+# Seconds between fsyncs of the log, made in the background; 0 syncs every record, as
+# it's made. Records are written through to the OS as they're made either way, so only
+# an OS crash can lose any, and then only the last interval's.
+FSYNC_INTERVAL = 1.0
+# The log is compacted into a snapshot once it holds this many records, or as many
+# records as there are peers, whichever is more, so compaction is amortised O(1).
+COMPACT_AFTER = 100_000
+
+SNAPSHOT_MAGIC = b"P2PS"
+SNAPSHOT_VERSION = 1
+# magic, version, next cookie, peers expired, hostnames length, peer count
+SNAPSHOT_HEADER = struct.Struct("!4sBQQII")
+# cookie, hostname index, port, last active time, TTL, registration count, active,
+# inactive since
+SNAPSHOT_PEER = struct.Struct("!QIHdiI?d")
+SNAPSHOT_TRAILER = struct.Struct("!I")
+
+# body length, CRC32 of body; the body's first byte is its kind.
+RECORD_HEADER = struct.Struct("!HI")
+# kind, cookie, time, port; followed by the hostname
+REGISTER_RECORD = struct.Struct("!BQdH")
+# kind, cookie, time
+REFRESH_RECORD = struct.Struct("!BQd")
+# kind, cookie, time, TTL
+DEACTIVATE_RECORD = struct.Struct("!BQdi")
+
+
+class RecordKind(IntEnum):
+    register = 1
+    refresh = 2
+    deactivate = 3
+
+
+def encode_record(body: bytes) -> bytes:
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_records(data: bytes) -> tuple[list[tuple], int]:
+    """Every whole, intact record in data, decoded, and the length they take up; a
+    torn or corrupt record ends the log."""
+    records, offset, view = [], 0, memoryview(data)
+
+    while offset + RECORD_HEADER.size <= len(view):
+        length, crc = RECORD_HEADER.unpack_from(view, offset)
+        start, end = offset + RECORD_HEADER.size, offset + RECORD_HEADER.size + length
+
+        if end > len(view) or zlib.crc32(view[start:end]) != crc:
+            break
+
+        match view[start]:
+            case RecordKind.register:
+                fields = REGISTER_RECORD.unpack_from(view, start)
+                hostname = bytes(view[start + REGISTER_RECORD.size : end]).decode()
+                records.append((*fields, hostname))
+            case RecordKind.refresh:
+                records.append(REFRESH_RECORD.unpack_from(view, start))
+            case RecordKind.deactivate:
+                records.append(DEACTIVATE_RECORD.unpack_from(view, start))
+            case _:
+                break
+
+        offset = end
+
+    return records, offset
+
+
+def fsync_directory(directory: pathlib.Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LoggedPeerIndex(PeerIndex):
+    """A PeerIndex that records every registration, refresh and deactivation, as
+    encoded by the record structs above, and passes each to its sinks, in order,
+    with the lock held. Records may be replayed by apply, as the write-ahead log and
+    replication do."""
+
+    def __init__(
+        self,
+        purge_after: float = PURGE_AFTER,
+        first_cookie: int = 0,
+        cookie_step: int = 1,
+    ) -> None:
+        super().__init__(purge_after, first_cookie, cookie_step)
+        self.sinks: list[Callable[[bytes], None]] = []
+
+    def register(self, hostname: str, port: int) -> Peer:
+        with self.lock:
+            cookie = self.id
+            peer = super().register(hostname, port)
+
+            # Re-registrations are refreshes, and recorded as such.
+            if peer.cookie == cookie:
+                record = REGISTER_RECORD.pack(
+                    RecordKind.register, cookie, peer.last_active_time, port
+                )
+                self.record(record + hostname.encode())
+
+            return peer
+
+    def refresh(self, peer: Peer) -> None:
+        with self.lock:
+            super().refresh(peer)
+            self.record(
+                REFRESH_RECORD.pack(
+                    RecordKind.refresh, peer.cookie, peer.last_active_time
+                )
+            )
+
+    def deactivate(self, peer: Peer) -> None:
+        with self.lock:
+            super().deactivate(peer)
+            since = self.inactive[peer.cookie]
+            self.record(
+                DEACTIVATE_RECORD.pack(
+                    RecordKind.deactivate, peer.cookie, since, peer.ttl
+                )
+            )
+
+    def reset(self) -> None:
+        """Forgets every peer, but carries on handing out cookies from where it
+        was."""
+        with self.lock:
+            self.peers, self.addresses, self.active = {}, {}, {}
+            self.inactive = collections.OrderedDict()
+            self.deadlines, self.scheduled = [], set()
+
+    def record(self, body: bytes) -> None:
+        for sink in self.sinks:
+            sink(body)
+
+    def apply(self, record: tuple) -> None:
+        """Replays a recorded change. Replaying is idempotent, so a log already folded
+        into the snapshot can safely be replayed over it."""
+        match record:
+            case (RecordKind.register, cookie, when, port, hostname):
+                peer = Peer(hostname, cookie, port, last_active_time=when)
+                self.peers[cookie] = peer
+                self.addresses[(hostname, port)] = cookie
+                self.active[cookie] = peer
+                self.inactive.pop(cookie, None)
+                self.id = max(self.id, cookie + self.cookie_step)
+            case (RecordKind.refresh, cookie, when) if (
+                peer := self.peers.get(cookie)
+            ) is not None:
+                peer.active, peer.ttl, peer.last_active_time = True, TTL, when
+                self.active[cookie] = peer
+                self.inactive.pop(cookie, None)
+            case (RecordKind.deactivate, cookie, since, ttl) if (
+                peer := self.peers.get(cookie)
+            ) is not None:
+                peer.active, peer.ttl = False, ttl
+                self.active.pop(cookie, None)
+                self.inactive[cookie] = since
+                self.inactive.move_to_end(cookie)
+
+    def state_records(self) -> list[bytes]:
+        """Records which, applied to an empty index, rebuild this one; called with
+        the lock held."""
+        records = [
+            REGISTER_RECORD.pack(
+                RecordKind.register, cookie, peer.last_active_time, peer.port
+            )
+            + peer.hostname.encode()
+            for cookie, peer in self.peers.items()
+        ]
+        records += [
+            DEACTIVATE_RECORD.pack(
+                RecordKind.deactivate, cookie, since, self.peers[cookie].ttl
+            )
+            for cookie, since in self.inactive.items()
+        ]
+        return records
+
+
+class PersistentPeerIndex(LoggedPeerIndex):
+    """A PeerIndex that survives restarts. Every registration, refresh and
+    deactivation is appended to a write-ahead log in directory; once the log
+    outgrows the index, the whole index is written out as a compact binary snapshot,
+    and the log started afresh. On start, the snapshot is loaded and the log
+    replayed over it, so cookies carry on where they left off; a torn last record,
+    from a crash mid-write, is dropped. Purges aren't logged, but redone on load. The
+    log is synced every fsync_interval seconds by a thread of its own, if anything's
+    been written since, so that neither a record's writer waits on the disk, nor a
+    quiet spell leaves records unsynced."""
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        purge_after: float = PURGE_AFTER,
+        fsync_interval: float = FSYNC_INTERVAL,
+        compact_after: int = COMPACT_AFTER,
+        first_cookie: int = 0,
+        cookie_step: int = 1,
+    ) -> None:
+        super().__init__(purge_after, first_cookie, cookie_step)
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+
+        self.wal: Optional[BinaryIO] = None
+        self.records = 0
+        self.dirty = False
+        self.closed = threading.Event()
+        self.compaction: Optional[threading.Thread] = None
+
+        self.load()
+        self.wal = self.open_wal()
+        self.sinks.append(self.append)
+        if self.fsync_interval > 0:
+            spawn(self.flush)
+
+    def path(self, name: str) -> pathlib.Path:
+        return self.directory.joinpath(name)
+
+    def open_wal(self) -> BinaryIO:
+        return self.path(WAL_NAME).open("ab", buffering=0)
+
+    def append(self, body: bytes) -> None:
+        """Writes a record through to the log; called with the lock held."""
+        if self.wal is None:
+            return
+
+        self.wal.write(encode_record(body))
+        self.records += 1
+
+        if self.fsync_interval > 0:
+            self.dirty = True
+        else:
+            os.fsync(self.wal.fileno())
+
+        if self.records >= max(self.compact_after, len(self.peers)):
+            self.compact(wait=False)
+
+    def flush(self) -> None:
+        """Syncs the log every fsync_interval seconds while it's been written to, until
+        the index is closed. The sync is of a duplicate of the log's descriptor, made
+        with the lock held, so that writes carry on meanwhile, and a compaction can
+        switch logs."""
+        while not self.closed.wait(self.fsync_interval):
+            with self.lock:
+                if not self.dirty or self.wal is None or self.wal.closed:
+                    continue
+                fd = os.dup(self.wal.fileno())
+                self.dirty = False
+
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                print("Persistence: ", e, file=sys.stderr)
+            finally:
+                os.close(fd)
+
+    def load(self) -> None:
+        # Loading allocates an object or two per peer, none of them garbage; left on,
+        # the collector would scan the growing heap over and over.
+        gc.disable()
+        try:
+            self.restore()
+        finally:
+            gc.enable()
+
+    def restore(self) -> None:
+        with self.lock:
+            if (snapshot := self.path(SNAPSHOT_NAME)).exists():
+                self.decode_snapshot(snapshot.read_bytes())
+
+            for name in (OLD_WAL_NAME, WAL_NAME):
+                if not (path := self.path(name)).exists():
+                    continue
+
+                data = path.read_bytes()
+                records, length = decode_records(data)
+                for record in records:
+                    self.apply(record)
+
+                if length < len(data):
+                    print(
+                        f"Dropped {len(data) - length} bytes from the end of {path}",
+                        file=sys.stderr,
+                    )
+                    os.truncate(path, length)
+
+                self.records += len(records)
+
+            self.deadlines = [(peer.deadline, c) for c, peer in self.active.items()]
+            heapq.heapify(self.deadlines)
+            self.scheduled = set(self.active)
+            self.purge()
+
+    def encode_snapshot(self) -> bytes:
+        """The index, packed; called with the lock held."""
+        hostnames: dict[str, int] = {}
+        pack, nan = SNAPSHOT_PEER.pack, float("nan")
+
+        # Active peers first, then inactive ones, oldest first, as inactive orders
+        # them, so it needn't be sorted on load.
+        rows = [(cookie, peer, nan) for cookie, peer in self.active.items()]
+        rows += [(cookie, self.peers[cookie], t) for cookie, t in self.inactive.items()]
+
+        peers = b"".join(
+            pack(
+                cookie,
+                hostnames.setdefault(peer.hostname, len(hostnames)),
+                peer.port,
+                peer.last_active_time,
+                peer.ttl,
+                peer.registration_count,
+                peer.active,
+                since,
+            )
+            for cookie, peer, since in rows
+        )
+        names = "\0".join(hostnames).encode()
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            self.id,
+            self.expired,
+            len(names),
+            len(self.peers),
+        )
+        body = header + names + peers
+
+        return body + SNAPSHOT_TRAILER.pack(zlib.crc32(body))
+
+    def decode_snapshot(self, data: bytes) -> None:
+        body, (crc,) = data[: -SNAPSHOT_TRAILER.size], SNAPSHOT_TRAILER.unpack(
+            data[-SNAPSHOT_TRAILER.size :]
+        )
+        if zlib.crc32(body) != crc:
+            raise ValueError("Peer snapshot is corrupt")
+
+        magic, version, self.id, self.expired, names_length, _ = (
+            SNAPSHOT_HEADER.unpack_from(body)
+        )
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unknown peer snapshot format {magic!r} {version}")
+
+        start = SNAPSHOT_HEADER.size
+        names = body[start : start + names_length].decode().split("\0")
+        start += names_length
+
+        rows = list(SNAPSHOT_PEER.iter_unpack(memoryview(body)[start:]))
+
+        # Built a field at a time, by comprehensions, which run much faster than the
+        # equivalent loop.
+        peers = {
+            cookie: Peer(names[name], cookie, port, last, count, is_active, ttl)
+            for cookie, name, port, last, ttl, count, is_active, _ in rows
+        }
+        # An address is only ever held by one peer at a time; once its peer's
+        # purged, it may be taken by a new one.
+        addresses = {(peer.hostname, peer.port): c for c, peer in peers.items()}
+        active = {c: peers[c] for c, *_, is_active, _ in rows if is_active}
+        inactive = ((c, since) for c, *_, is_active, since in rows if not is_active)
+
+        self.peers, self.addresses, self.active = peers, addresses, active
+        self.inactive = collections.OrderedDict(inactive)
+
+    def compact(self, wait: bool = True) -> None:
+        """Folds the log into a new snapshot. The index is packed with the lock held,
+        and the log switched for a new one; the snapshot is written after, in the
+        background unless wait is set."""
+        with self.lock:
+            if self.compaction is not None and self.compaction.is_alive():
+                if not wait:
+                    return
+                self.compaction.join()
+
+            data = self.encode_snapshot()
+            self.wal.close()
+
+            wal, old = self.path(WAL_NAME), self.path(OLD_WAL_NAME)
+            if old.exists():
+                # The last snapshot failed to be written; its log must be kept, too.
+                with old.open("ab") as file:
+                    file.write(wal.read_bytes())
+                wal.unlink()
+            else:
+                os.replace(wal, old)
+
+            self.wal = self.open_wal()
+            self.records = 0
+
+            self.compaction = threading.Thread(
+                target=self.write_snapshot, args=(data,), daemon=True
+            )
+            self.compaction.start()
+
+        if wait:
+            self.compaction.join()
+
+    def write_snapshot(self, data: bytes) -> None:
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.path(SNAPSHOT_NAME))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        self.path(OLD_WAL_NAME).unlink(missing_ok=True)
+        fsync_directory(self.directory)
+
+    def close(self) -> None:
+        """Snapshots the index, so the next start needn't replay the log."""
+        self.closed.set()
+        self.compact()
+        with self.lock:
+            os.fsync(self.wal.fileno())
+            self.wal.close()
+            self.wal = None
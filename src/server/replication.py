@@ -0,0 +1,110 @@
+import socket
+import sys
+import threading
+from typing import *
+
+from src.server.persistence import LoggedPeerIndex, encode_record
+from src.server.shards import Address
+from src.utils.http import (
+    SUCCESS_CODE,
+    Protocol,
+    make_request,
+    send_recv_http_request,
+    use_protocol,
+)
+
+# Seconds between attempts to reach a follower that's down.
+RECONNECT_AFTER = 1.0
+REPLICATION_TIMEOUT = 10.0
+
+
+class Replicator(threading.Thread):
+    """Dedicated thread streaming a LoggedPeerIndex's records to a follower, as
+    Replicate requests, each carrying every record made since the last. On
+    connecting, or reconnecting, the whole index is sent first, marked
+    Index-Sync: full, so the follower starts over from it. Replication is
+    asynchronous: the index only ever appends to a buffer, and never waits on the
+    follower, so a follower may lag its primary by a batch."""
+
+    def __init__(self, peer_index: LoggedPeerIndex, follower: Address) -> None:
+        super().__init__(daemon=True)
+        self.peer_index = peer_index
+        self.follower = follower
+
+        self.pending = bytearray()
+        # Records are only buffered while connected; on reconnecting, the follower
+        # starts over, with a full batch.
+        self.connected = False
+        self.full = True
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.sent = 0
+
+        peer_index.sinks.append(self.push)
+
+    def push(self, body: bytes) -> None:
+        """Buffers a record; called with the index's lock held."""
+        with self.condition:
+            if self.connected:
+                self.pending += encode_record(body)
+                self.condition.notify()
+
+    def resync(self) -> None:
+        # Under the index's lock, so no record is made between the copy of the index
+        # and the records buffered after it.
+        with self.peer_index.lock, self.condition:
+            records = self.peer_index.state_records()
+            self.pending = bytearray(b"".join(map(encode_record, records)))
+            self.connected = self.full = True
+
+    def next_batch(self) -> Optional[tuple[bytes, bool]]:
+        with self.condition:
+            # A full batch is sent even if empty, so the follower empties too.
+            while not self.pending and not self.full and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+
+            batch, full = bytes(self.pending), self.full
+            self.pending.clear()
+            self.full = False
+            return batch, full
+
+    def replicate(self, follower_socket: socket.socket) -> None:
+        self.resync()
+
+        while (batch := self.next_batch()) is not None:
+            records, full = batch
+            headers = {"Index-Sync": "full" if full else "delta"}
+            # Built directly, rather than by an http_request, so batches aren't echoed.
+            request = make_request("replicate", self.follower[0], headers, records)
+
+            if send_recv_http_request(request, follower_socket).status != SUCCESS_CODE:
+                raise ValueError("Follower refused a batch")
+            self.sent += len(records)
+
+    def run(self) -> None:
+        failing = False
+
+        while not self.stopped:
+            try:
+                with socket.create_connection(
+                    self.follower, REPLICATION_TIMEOUT
+                ) as follower_socket, use_protocol(Protocol.binary):
+                    failing = False
+                    self.replicate(follower_socket)
+            except (OSError, ValueError) as e:
+                if not failing:
+                    print(f"Replicator: {self.follower}", e, file=sys.stderr)
+                failing = True
+
+            with self.condition:
+                self.connected = False
+                self.pending.clear()
+                if not self.stopped:
+                    self.condition.wait(RECONNECT_AFTER)
+
+    def cancel(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
@@ -1,22 +1,52 @@
+import argparse
+import asyncio
 import json
+import logging
+import multiprocessing
+import pathlib
+import signal
 import socket
 import sys
 import threading
+import time
 from enum import Enum, auto
 from typing import *
 
-from src.peer.peer import TTL_INTERVAL, PeerIndex, dump_peer
+from src.peer.peer import ExpiryScheduler, PeerIndex, dump_peer
+from src.server.persistence import (
+    FSYNC_INTERVAL,
+    LoggedPeerIndex,
+    PersistentPeerIndex,
+    decode_records,
+)
+from src.server.replication import Replicator
+from src.server.shards import Shard, dump_shards, make_shards
 from src.utils.http import (
     FAIL_CODE,
     FAIL_RESPONSE,
     SUCCESS_CODE,
     HTTPRequest,
     http_response,
+    negotiate,
+    parse_request,
+    with_headers,
+)
+from src.utils.metrics import Counter, ServerMetrics
+from src.utils.utils import (
+    async_recv_message,
+    async_send_message,
+    recv_message,
+    send_message,
 )
-from src.utils.utils import recv_message, send_message
 
 TIMEOUT = 1.0
 PORT = 65243
+BACKLOG = 4096
+
+
+class ServerMode(Enum):
+    threaded = auto()
+    asyncio = auto()
 
 
 class P2ServerCommands(Enum):
@@ -24,6 +54,9 @@ class P2ServerCommands(Enum):
     leave = auto()
     pquery = auto()
     keepalive = auto()
+    stats = auto()
+    shards = auto()
+    replicate = auto()
 
 
 @http_response
@@ -44,19 +77,22 @@ def leave(request: HTTPRequest, peer_index: PeerIndex):
     if peer is None:
         return (FAIL_CODE,)
 
-    peer.leave()
+    peer_index.leave(peer)
 
     return (SUCCESS_CODE,)
 
 
 @http_response
 def p_query(request: HTTPRequest, peer_index: PeerIndex):
-    peer_cookie = int(request.headers["Peer-Cookie"])
-    peer = peer_index.get(peer_cookie)
-    if peer is None:
-        return (FAIL_CODE,)
+    """The active peers, but for the asking peer, which is refreshed. Without a
+    Peer-Cookie, as peers registered with another shard send, every active peer."""
+    peer_cookie = None
+    if "Peer-Cookie" in request.headers:
+        peer_cookie = int(request.headers["Peer-Cookie"])
+        if (peer := peer_index.get(peer_cookie)) is None:
+            return (FAIL_CODE,)
 
-    peer.refresh()
+        peer_index.refresh(peer)
 
     active_peers = [
         dump_peer(peer)
@@ -75,65 +111,352 @@ def keep_alive(request: HTTPRequest, peer_index: PeerIndex):
     if peer is None:
         return (FAIL_CODE,)
 
-    peer.refresh()
+    peer_index.refresh(peer)
 
     return SUCCESS_CODE, {}, dump_peer(peer)
 
 
-def server_receiver(peer_index: PeerIndex, peer_socket: socket.socket) -> None:
-    def handle(request: HTTPRequest) -> bytes:
-        match (command := P2ServerCommands[request.command.lower()]):
-            case P2ServerCommands.register:
-                return register(request, peer_index)
-            case P2ServerCommands.leave:
-                return leave(request, peer_index)
-            case P2ServerCommands.pquery:
-                return p_query(request, peer_index)
-            case P2ServerCommands.keepalive:
-                return keep_alive(request, peer_index)
-            case _:
-                return FAIL_RESPONSE()
+@http_response
+def shard_map(request: HTTPRequest, shards: list[Shard]):
+    return SUCCESS_CODE, {}, dump_shards(shards)
+
+
+@http_response
+def replicate(request: HTTPRequest, peer_index: PeerIndex):
+    """Applies a batch of records from this follower's primary. A full batch holds
+    the primary's whole index, replacing this one's. Only followers, whose indexes
+    record to nowhere, take them."""
+    if not isinstance(peer_index, LoggedPeerIndex) or peer_index.sinks:
+        return (FAIL_CODE,)
+
+    records, _ = decode_records(request.content)
+
+    with peer_index.lock:
+        if request.headers.get("Index-Sync") == "full":
+            peer_index.reset()
+
+        for record in records:
+            peer_index.apply(record)
+            # So that, should the follower take over, its peers still expire.
+            if (peer := peer_index.get(record[1])) is not None and peer.active:
+                peer_index.schedule(peer)
+
+        peer_index.purge()
+
+    return (SUCCESS_CODE,)
+
+
+@http_response
+def stats(request: HTTPRequest, metrics: ServerMetrics):
+    content_type, body = metrics.render(request.headers.get("Accept"))
+    return SUCCESS_CODE, {"Content-Type": content_type}, body
+
+
+def handle(
+    request: HTTPRequest,
+    peer_index: PeerIndex,
+    metrics: ServerMetrics,
+    shards: list[Shard],
+) -> bytes:
+    match (command := P2ServerCommands[request.command.lower()]):
+        case P2ServerCommands.register:
+            return register(request, peer_index)
+        case P2ServerCommands.leave:
+            return leave(request, peer_index)
+        case P2ServerCommands.pquery:
+            return p_query(request, peer_index)
+        case P2ServerCommands.keepalive:
+            return keep_alive(request, peer_index)
+        case P2ServerCommands.stats:
+            return stats(request, metrics)
+        case P2ServerCommands.shards:
+            return shard_map(request, shards)
+        case P2ServerCommands.replicate:
+            return replicate(request, peer_index)
+        case _:
+            return FAIL_RESPONSE()
+
+
+def server_receiver(
+    peer_index: PeerIndex,
+    peer_socket: socket.socket,
+    metrics: ServerMetrics,
+    shards: list[Shard],
+) -> None:
+    metrics.connections.inc()
 
     try:
         while message := recv_message(peer_socket):
-            request = HTTPRequest(message)
-            if (response := handle(request)) is not None:
-                send_message(response, peer_socket)
+            start = time.perf_counter()
+            request = parse_request(message)
+            tags = negotiate(request)
+            sent = 0
+            if (response := handle(request, peer_index, metrics, shards)) is not None:
+                sent = send_message(with_headers(response, tags), peer_socket)
+            metrics.observe_request(
+                request.command.lower(),
+                time.perf_counter() - start,
+                len(message),
+                sent,
+            )
     except Exception as e:
         print("Server: ", e, file=sys.stderr)
     finally:
+        metrics.connections.dec()
         peer_socket.close()
         sys.exit(0)
 
 
-def server() -> None:
-    address = (socket.gethostname(), PORT)
+async def async_server_receiver(
+    peer_index: PeerIndex,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    metrics: ServerMetrics,
+    shards: list[Shard],
+) -> None:
+    metrics.connections.inc()
+
+    try:
+        while message := await async_recv_message(reader):
+            start = time.perf_counter()
+            request = parse_request(message)
+            tags = negotiate(request)
+            sent = 0
+            if (response := handle(request, peer_index, metrics, shards)) is not None:
+                sent = await async_send_message(with_headers(response, tags), writer)
+            metrics.observe_request(
+                request.command.lower(),
+                time.perf_counter() - start,
+                len(message),
+                sent,
+            )
+    except Exception as e:
+        print("Server: ", e, file=sys.stderr)
+    finally:
+        metrics.connections.dec()
+        writer.close()
+
+
+def threaded_server(
+    server_socket: socket.socket,
+    peer_index: PeerIndex,
+    metrics: ServerMetrics,
+    shards: list[Shard],
+) -> None:
+    while True:
+        conn, _ = server_socket.accept()
+        t = threading.Thread(
+            target=server_receiver,
+            args=(peer_index, conn, metrics, shards),
+        )
+        t.start()
+
+
+async def async_server(
+    server_socket: socket.socket,
+    peer_index: PeerIndex,
+    metrics: ServerMetrics,
+    shards: list[Shard],
+) -> None:
+    """Serves every connection from a single event loop; idle peers cost a
+    coroutine rather than an OS thread."""
+
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await async_server_receiver(peer_index, reader, writer, metrics, shards)
+
+    server = await asyncio.start_server(on_connect, sock=server_socket, backlog=BACKLOG)
+
+    async with server:
+        await server.serve_forever()
+
+
+def server(
+    mode: ServerMode = ServerMode.threaded,
+    state_dir: Optional[pathlib.Path] = None,
+    fsync_interval: float = FSYNC_INTERVAL,
+    shards: Optional[list[Shard]] = None,
+    shard: int = 0,
+    follower: bool = False,
+) -> None:
+    """Runs the RS, or one shard of it: shard, of shards, or, if follower is set, the
+    follower replicating it. With a state_dir, the peer index is persisted there,
+    and restored from it on start."""
+    if shards is None:
+        shards = make_shards(socket.gethostname(), PORT, 1)
+    this = shards[shard]
+    address = this.follower if follower else this.address
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(address)
-    server_socket.listen(32)
-
-    peer_index = PeerIndex()
+    server_socket.listen(BACKLOG)
+
+    # Each shard hands out every len(shards)th cookie, from its own index, so no two
+    # shards ever hand out the same one.
+    cookies = {"first_cookie": shard, "cookie_step": len(shards)}
+    if state_dir is not None and not follower:
+        if len(shards) > 1:
+            state_dir = state_dir.joinpath(f"shard-{shard}")
+        start = time.perf_counter()
+        peer_index = PersistentPeerIndex(
+            state_dir, fsync_interval=fsync_interval, **cookies
+        )
+        print(
+            f"Restored {len(peer_index.peers)} peers from {state_dir} in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+    elif follower or this.follower is not None:
+        peer_index = LoggedPeerIndex(**cookies)
+    else:
+        peer_index = PeerIndex(**cookies)
+    metrics = ServerMetrics()
+    metrics.collect(
+        "p2pdi_active_peers",
+        lambda: len(peer_index.active),
+        "Peers registered and alive",
+    )
+    metrics.collect(
+        "p2pdi_peers_expired_total",
+        lambda: peer_index.expired,
+        "Peers deactivated by their TTL running out",
+        Counter,
+    )
 
-    decrement_peer_thread = threading.Timer(
-        TTL_INTERVAL, peer_index.decrement_peer_ttls
+    replicator = None
+    if this.follower is not None and not follower:
+        replicator = Replicator(peer_index, this.follower)
+        replicator.start()
+        metrics.collect(
+            "p2pdi_replicated_bytes_total",
+            lambda: replicator.sent,
+            "Bytes of records sent to this shard's follower",
+            Counter,
+        )
+
+    expiry_scheduler = ExpiryScheduler(peer_index)
+    expiry_scheduler.start()
+
+    role = "follower of shard" if follower else "shard"
+    print(
+        f"Started registration server on {address} ({mode.name}), "
+        f"{role} {shard + 1} of {len(shards)}"
     )
-    decrement_peer_thread.start()
 
     try:
-        while True:
-            conn, _ = server_socket.accept()
-            t = threading.Thread(
-                target=server_receiver,
-                args=(peer_index, conn),
-            )
-            t.start()
-
+        match mode:
+            case ServerMode.threaded:
+                threaded_server(server_socket, peer_index, metrics, shards)
+            case ServerMode.asyncio:
+                asyncio.run(async_server(server_socket, peer_index, metrics, shards))
     except KeyboardInterrupt:
         pass
 
-    decrement_peer_thread.cancel()
+    expiry_scheduler.cancel()
+    if replicator is not None:
+        replicator.cancel()
+
+    if isinstance(peer_index, PersistentPeerIndex):
+        peer_index.close()
+
+
+def shard_process(*args) -> None:
+    """Runs server, shut down by SIGTERM rather than SIGINT, so that a Ctrl-C reaches
+    it only once, forwarded by sharded_server, and can't cut its shutdown short."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server(*args)
+
+
+def sharded_server(
+    mode: ServerMode,
+    state_dir: Optional[pathlib.Path],
+    fsync_interval: float,
+    shards: list[Shard],
+) -> None:
+    """Runs every shard, and every follower, each in a process of its own; followers
+    first, so primaries find them up. Ctrl-C, or SIGTERM, shuts them all down."""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    processes = [
+        multiprocessing.Process(
+            target=shard_process,
+            args=(mode, state_dir, fsync_interval, shards, shard.index, follower),
+        )
+        for follower in (True, False)
+        for shard in shards
+        if shard.follower is not None or not follower
+    ]
+
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="P2P-DI registration server")
+    parser.add_argument(
+        "--mode",
+        choices=[mode.name for mode in ServerMode],
+        default=ServerMode.threaded.name,
+        help="connection handling model",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="echo every response sent"
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=pathlib.Path,
+        help="persist registrations here, and restore them on start",
+    )
+    parser.add_argument(
+        "--fsync-interval",
+        type=float,
+        default=FSYNC_INTERVAL,
+        help="seconds between syncs of the registration log; 0 syncs every change",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help=f"split peers across this many servers, on ports from {PORT} up",
+    )
+    parser.add_argument(
+        "--replicate",
+        action="store_true",
+        help="give each shard a follower, on the ports after the shards'",
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        help="run only this shard, or with --follower its follower; by default, "
+        "every shard and follower is run, each in a process of its own",
+    )
+    parser.add_argument(
+        "--follower", action="store_true", help="run the follower of --shard"
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    server()
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s"
+    )
+    mode = ServerMode[args.mode]
+    shards = make_shards(socket.gethostname(), PORT, args.shards, args.replicate)
+
+    if args.shard is not None:
+        server(
+            mode, args.state_dir, args.fsync_interval, shards, args.shard, args.follower
+        )
+    elif len(shards) > 1 or args.replicate:
+        sharded_server(mode, args.state_dir, args.fsync_interval, shards)
+    else:
+        server(mode, args.state_dir, args.fsync_interval, shards)
@@ -0,0 +1,75 @@
+import bisect
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+from typing import *
+
+from src.utils.http import HTTPRequest, HTTPResponse
+
+Address = tuple[str, int]
+
+# Points each shard takes on the ring; more even out the shards' shares of peers.
+VIRTUAL_NODES = 128
+
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    hostname: str
+    port: int
+    # The follower replicating this shard, if any.
+    follower: Optional[Address] = None
+
+    @property
+    def address(self) -> Address:
+        return self.hostname, self.port
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of peer addresses onto shards. Each shard takes
+    virtual_nodes points on a ring of 64-bit hashes; an address belongs to the
+    shard owning the first point at or after its own hash. Adding a shard moves only
+    the addresses falling just before its points."""
+
+    def __init__(self, shards: Iterable[Shard], virtual_nodes: int = VIRTUAL_NODES):
+        self.shards = list(shards)
+        points = sorted(
+            (ring_hash(f"shard-{shard.index}-{node}"), i)
+            for i, shard in enumerate(self.shards)
+            for node in range(virtual_nodes)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [owner for _, owner in points]
+
+    def shard_for(self, hostname: str, port: int) -> Shard:
+        i = bisect.bisect_left(self.points, ring_hash(f"{hostname}:{port}"))
+        return self.shards[self.owners[i % len(self.points)]]
+
+
+def make_shards(
+    hostname: str, port: int, count: int, followers: bool = False
+) -> list[Shard]:
+    """count shards on hostname, on consecutive ports from port; followers, if any,
+    on the ports after those."""
+    return [
+        Shard(
+            i, hostname, port + i, (hostname, port + count + i) if followers else None
+        )
+        for i in range(count)
+    ]
+
+
+def load_shards(response: HTTPResponse | HTTPRequest) -> list[Shard]:
+    data = json.loads(response.content.decode())
+    return [
+        Shard(**(shard | {"follower": tuple(shard["follower"] or ()) or None}))
+        for shard in data
+    ]
+
+
+def dump_shards(shards: Iterable[Shard]) -> str:
+    return json.dumps([asdict(shard) for shard in shards])
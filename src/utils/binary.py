@@ -0,0 +1,229 @@
+import http
+import struct
+from typing import *
+
+from src.utils.encoding import content_encoding, decode
+from src.utils.headers import Headers
+
+MAGIC = 0xB1
+
+# magic, opcode, flags, status, request ID, meta length, payload length
+FIXED_HEADER = struct.Struct("!BBBHIHI")
+KEY = struct.Struct("!B")
+VALUE_LENGTH = struct.Struct("!H")
+
+FLAG_RESPONSE = 1 << 0
+FLAG_REQUEST_ID = 1 << 1
+
+# Opcodes index into METHODS; opcode 0 carries the method name literally, in the
+# METHOD_KEY header.
+METHODS = [
+    "",
+    "register",
+    "leave",
+    "pquery",
+    "keepalive",
+    "rfcquery",
+    "getrfc",
+    "stats",
+    "search",
+    "shards",
+    "replicate",
+    "findnode",
+    "findvalue",
+    "store",
+    "gossip",
+]
+OPCODES = {method: opcode for opcode, method in enumerate(METHODS)}
+METHOD_KEY = ":method"
+
+# Header keys sent as a single byte; key ID 0 is followed by the key itself.
+KEYS = [
+    "",
+    "Host",
+    "OS",
+    "Date",
+    "Port",
+    "Peer-Cookie",
+    "RFC-Number",
+    "RFC-Size",
+    "Range",
+    "Content-Range",
+    "Index-Version",
+    "Index-Sync",
+    "Accept-Protocol",
+    "Protocol",
+    "Accept",
+    "Content-Type",
+    "Accept-Encoding",
+    "Content-Encoding",
+    "Query",
+    "Limit",
+    "Node-ID",
+    "Node-Host",
+    "Key",
+    "TTL",
+    "Index-Digest",
+]
+KEY_IDS = {key.lower(): key_id for key_id, key in enumerate(KEYS)}
+
+PHRASES = {status.value: status.phrase for status in http.HTTPStatus}
+
+
+class Unencodable(ValueError):
+    """A message too large for the binary format's fields: a path, key or header
+    count over 255, a value or metadata over 64 KB, or a payload over 4 GB. Such a
+    message is sent as text instead, which either end parses."""
+
+
+def is_binary(message: bytes) -> bool:
+    return len(message) > 0 and message[0] == MAGIC
+
+
+def encode_meta(path: str, headers: Mapping[str, Any]) -> bytes:
+    """The path, then the headers: a count, followed by a key ID (and, for unknown
+    keys, the key) and a length-prefixed value for each."""
+    path = path.encode()
+    parts = [KEY.pack(len(path)), path, KEY.pack(len(headers))]
+
+    for key, value in headers.items():
+        key_id = KEY_IDS.get(key.lower(), 0)
+        parts.append(KEY.pack(key_id))
+
+        if key_id == 0:
+            key = key.encode()
+            parts += [KEY.pack(len(key)), key]
+
+        value = str(value).encode()
+        parts += [VALUE_LENGTH.pack(len(value)), value]
+
+    return b"".join(parts)
+
+
+def decode_meta(meta: memoryview) -> tuple[str, Headers]:
+    length, offset = meta[0], 1
+    path = bytes(meta[offset : offset + length]).decode()
+    offset += length
+
+    count, offset = meta[offset], offset + 1
+    headers = Headers()
+
+    for _ in range(count):
+        key_id, offset = meta[offset], offset + 1
+
+        if key_id == 0:
+            length, offset = meta[offset], offset + 1
+            key = bytes(meta[offset : offset + length]).decode()
+            offset += length
+        else:
+            key = KEYS[key_id]
+
+        (length,) = VALUE_LENGTH.unpack_from(meta, offset)
+        offset += VALUE_LENGTH.size
+        headers[key] = bytes(meta[offset : offset + length]).decode()
+        offset += length
+
+    return path, headers
+
+
+def encode_head(
+    opcode: int,
+    status: int,
+    path: str,
+    headers: Optional[Mapping[str, Any]],
+    payload_length: int,
+    response: bool,
+) -> bytes:
+    """Everything but the payload, which is payload_length bytes long. Raises
+    Unencodable if any of it doesn't fit its field."""
+    headers = dict(headers or {})
+    flags = FLAG_RESPONSE if response else 0
+    request_id = 0
+
+    for key in list(headers):
+        if key.lower() == "request-id":
+            request_id = int(headers.pop(key))
+            flags |= FLAG_REQUEST_ID
+        elif key.lower() == "content-length":
+            del headers[key]
+
+    try:
+        meta = encode_meta(path, headers)
+        fixed = FIXED_HEADER.pack(
+            MAGIC, opcode, flags, status, request_id, len(meta), payload_length
+        )
+    except struct.error as e:
+        raise Unencodable(e) from e
+
+    return fixed + meta
+
+
+def encode_request(
+    method: str, path: str = "/", headers: Optional[Mapping[str, Any]] = None, body=b""
+) -> bytes:
+    headers = dict(headers or {})
+
+    if (opcode := OPCODES.get(method.lower(), 0)) == 0:
+        headers[METHOD_KEY] = method
+
+    if not isinstance(body, bytes):
+        body = body.encode()
+
+    return encode_head(opcode, 0, path, headers, len(body), False) + body
+
+
+def encode_response(
+    status: int, headers: Optional[Mapping[str, Any]] = None, body=b""
+) -> bytes:
+    if not isinstance(body, bytes):
+        body = body.encode()
+
+    return encode_head(0, status, "", headers, len(body), True) + body
+
+
+class BinaryMessage:
+    """A decoded binary request or response, exposing the same attributes as
+    HTTPRequest and HTTPResponse."""
+
+    request_version = version = "binary"
+
+    def __init__(self, message: bytes, head_only: bool = False) -> None:
+        view = memoryview(message)
+        (
+            _,
+            opcode,
+            self.flags,
+            self.status,
+            request_id,
+            meta_length,
+            self.length,
+        ) = FIXED_HEADER.unpack_from(view)
+
+        offset = FIXED_HEADER.size
+        self.path, self.headers = decode_meta(view[offset : offset + meta_length])
+        offset += meta_length
+
+        self.command = METHODS[opcode] or self.headers.pop(METHOD_KEY, "")
+        self.reason = PHRASES.get(self.status, "")
+        self.head_length = offset
+
+        if self.flags & FLAG_REQUEST_ID:
+            self.headers["Request-ID"] = str(request_id)
+
+        self.body = b"" if head_only else bytes(view[offset : offset + self.length])
+        self._content: Optional[bytes] = None
+
+    @property
+    def content(self) -> bytes:
+        """The body, with any Content-Encoding undone."""
+        if self._content is None:
+            self._content = decode(self.body, content_encoding(self.headers))
+        return self._content
+
+    def getheader(self, name: str, default: Any = None) -> str | Any:
+        return self.headers.get(name, default)
+
+    def __str__(self) -> str:
+        if self.flags & FLAG_RESPONSE:
+            return f"{self.version} {self.status} {self.reason}\n{self.headers}"
+        return f"{self.command} {self.path} {self.version}\n{self.headers}"
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+from dataclasses import dataclass
+from typing import *
+
+ALGORITHM = "sha256"
+# Downloads are verified, and resumed, a chunk at a time.
+DIGEST_CHUNK_SIZE = 1 << 18
+# Downloads are written into files of this suffix, then moved into place once whole.
+PART_SUFFIX = ".part"
+
+
+@dataclass(frozen=True)
+class Digest:
+    """A file's content hash, and the hash of each chunk_size long chunk of it, the
+    last of which may be short."""
+
+    size: int
+    value: str
+    chunk_size: int
+    chunks: tuple[str, ...]
+    algorithm: str = ALGORITHM
+
+    def check(self, offset: int, chunk: bytes) -> bool:
+        """Whether chunk is the one starting at offset."""
+        index, rest = divmod(offset, self.chunk_size)
+        return (
+            rest == 0
+            and index < len(self.chunks)
+            and hashlib.new(self.algorithm, chunk).hexdigest() == self.chunks[index]
+        )
+
+
+def compute_digest(
+    path: pathlib.Path, chunk_size: int = DIGEST_CHUNK_SIZE, algorithm: str = ALGORITHM
+) -> Digest:
+    whole, chunks = hashlib.new(algorithm), []
+
+    with path.open("rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        while chunk := file.read(chunk_size):
+            whole.update(chunk)
+            chunks.append(hashlib.new(algorithm, chunk).hexdigest())
+
+    return Digest(size, whole.hexdigest(), chunk_size, tuple(chunks), algorithm)
+
+
+def verify_prefix(
+    path: pathlib.Path, digest: Digest, limit: int, whole: Optional[Any] = None
+) -> int:
+    """How much of the first limit bytes of path is made up of whole, verified
+    chunks. Verified chunks are fed into the whole hash, if given."""
+    offset = 0
+
+    with path.open("rb") as file:
+        while offset < limit:
+            chunk = file.read(min(digest.chunk_size, digest.size - offset))
+            if not chunk or not digest.check(offset, chunk):
+                break
+            if whole is not None:
+                whole.update(chunk)
+            offset += len(chunk)
+
+    return min(offset, limit)
+
+
+class VerifyingWriter:
+    """Wraps a file being written from offset, a chunk boundary, onwards, checking
+    every chunk against digest before writing it; the file only ever holds verified
+    chunks, up to offset. A chunk that fails raises ValueError. finish must be called
+    once everything has been written, to check the last, short, chunk."""
+
+    def __init__(
+        self, file: BinaryIO, digest: Digest, offset: int = 0, whole: Any = None
+    ) -> None:
+        if offset % digest.chunk_size != 0:
+            raise ValueError(f"Offset {offset} is not on a chunk boundary")
+
+        self.file = file
+        self.digest = digest
+        self.offset = offset
+        self.whole = whole
+        self.pending = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.pending += data
+        while len(self.pending) >= self.digest.chunk_size:
+            self.commit(self.digest.chunk_size)
+        return len(data)
+
+    def commit(self, length: int) -> None:
+        chunk = bytes(self.pending[:length])
+
+        if not self.digest.check(self.offset, chunk):
+            raise ValueError(f"Chunk at {self.offset} failed verification")
+
+        self.file.write(chunk)
+        if self.whole is not None:
+            self.whole.update(chunk)
+
+        del self.pending[:length]
+        self.offset += length
+
+    def finish(self) -> None:
+        if self.pending:
+            self.commit(len(self.pending))
+
+
+def part_path(out_dir: pathlib.Path, name: Any) -> pathlib.Path:
+    """Where a failed download of name leaves its verified chunks, to resume from."""
+    return out_dir.joinpath(f"{name}{PART_SUFFIX}")
+
+
+def new_part(out_dir: pathlib.Path, name: Any) -> pathlib.Path:
+    """A fresh, empty, .part file for a download of name, of its own; concurrent
+    downloads of the same file never share one."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=out_dir, prefix=f"{name}.", suffix=PART_SUFFIX)
+    os.close(fd)
+    return pathlib.Path(path)
+
+
+def claim_part(out_dir: pathlib.Path, name: Any) -> pathlib.Path:
+    """A .part file for a download of name, of its own: the one a failed download
+    left behind, if any, taken over by an atomic rename, so that no two downloads
+    resume from it; else a fresh one. Downloads still under way write to parts of
+    their own, so are never resumed from."""
+    part = new_part(out_dir, name)
+    try:
+        os.replace(part_path(out_dir, name), part)
+    except FileNotFoundError:
+        pass
+    return part
+
+
+def release_part(part: pathlib.Path, out_dir: pathlib.Path, name: Any) -> None:
+    """Leaves a failed download's part, if it holds anything, to resume from; or
+    removes it."""
+    try:
+        if part.stat().st_size > 0:
+            os.replace(part, part_path(out_dir, name))
+            return
+    except FileNotFoundError:
+        return
+    part.unlink(missing_ok=True)
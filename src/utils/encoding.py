@@ -0,0 +1,235 @@
+import hashlib
+import lzma
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import zlib
+from enum import Enum, auto
+from typing import *
+
+from src.utils.utils import FILE_CHUNK_SIZE
+from src.utils.workers import WorkerPool
+
+ACCEPT_ENCODING = "Accept-Encoding"
+CONTENT_ENCODING = "Content-Encoding"
+
+CACHE_DIR = pathlib.Path(tempfile.gettempdir(), "p2pdi", "encoded")
+# Bodies smaller than this aren't worth compressing on the fly.
+MIN_ENCODE_SIZE = 1 << 10
+# Variants built in the background at once, at most.
+BUILD_WORKERS = 2
+
+
+class Encoding(Enum):
+    """Content codings, named as on the wire. deflate is the zlib format, as in
+    HTTP."""
+
+    identity = auto()
+    gzip = auto()
+    deflate = auto()
+    lzma = auto()
+
+
+# The order the server prefers codings in, where the client has no preference.
+PREFERENCE = [Encoding.gzip, Encoding.deflate, Encoding.lzma]
+SUFFIXES = {Encoding.gzip: ".gz", Encoding.deflate: ".zz", Encoding.lzma: ".xz"}
+
+# What clients send in Accept-Encoding.
+ACCEPTED = ", ".join(encoding.name for encoding in PREFERENCE)
+
+
+def compressor(encoding: Encoding) -> Any:
+    match encoding:
+        case Encoding.gzip:
+            return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        case Encoding.deflate:
+            return zlib.compressobj(9)
+        case Encoding.lzma:
+            return lzma.LZMACompressor(lzma.FORMAT_XZ)
+        case _:
+            raise ValueError(f"No compressor for {encoding.name}")
+
+
+def decompressor(encoding: Encoding) -> Any:
+    match encoding:
+        case Encoding.gzip:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        case Encoding.deflate:
+            return zlib.decompressobj()
+        case Encoding.lzma:
+            return lzma.LZMADecompressor()
+        case _:
+            raise ValueError(f"No decompressor for {encoding.name}")
+
+
+def encode(data: bytes, encoding: Encoding) -> bytes:
+    if encoding is Encoding.identity:
+        return data
+
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+
+def decode(data: bytes, encoding: Encoding) -> bytes:
+    if encoding is Encoding.identity:
+        return data
+
+    d = decompressor(encoding)
+    data = d.decompress(data)
+    return data + d.flush() if hasattr(d, "flush") else data
+
+
+def content_encoding(headers: Mapping[str, str]) -> Encoding:
+    """The coding a message's body is in; unknown codings raise ValueError."""
+    name = headers.get(CONTENT_ENCODING, Encoding.identity.name).strip().lower()
+
+    try:
+        return Encoding[name]
+    except KeyError:
+        raise ValueError(f"Unknown Content-Encoding {name!r}") from None
+
+
+def choose_encoding(accept: Optional[str]) -> Encoding:
+    """Picks the coding to answer with, given an Accept-Encoding header: the one with
+    the highest q-value, ties broken by PREFERENCE; identity if none is acceptable."""
+    if not accept:
+        return Encoding.identity
+
+    weights: dict[str, float] = {}
+
+    for part in accept.split(","):
+        name, *params = (p.strip() for p in part.split(";"))
+        weight = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.lower()] = weight
+
+    candidates = [
+        (weights.get(encoding.name, weights.get("*", 0.0)), -i, encoding)
+        for i, encoding in enumerate(PREFERENCE)
+    ]
+    weight, _, encoding = max(candidates, key=lambda c: c[:2])
+
+    return encoding if weight > 0 else Encoding.identity
+
+
+class DecodingWriter:
+    """Wraps a file, decompressing whatever's written to it. finish must be called
+    once everything has been written."""
+
+    def __init__(self, file: BinaryIO, encoding: Encoding) -> None:
+        self.file = file
+        self.decompressor = decompressor(encoding)
+
+    def write(self, data: bytes) -> int:
+        return self.file.write(self.decompressor.decompress(data))
+
+    def finish(self) -> None:
+        if hasattr(self.decompressor, "flush"):
+            self.file.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise ValueError("Truncated encoded body")
+
+
+class EncodedCache:
+    """Compressed variants of files, kept on disk, so that each file is compressed
+    once, rather than on every request. Variants are built the first time they're
+    asked for, by get, or, through ready, in the background. Each is stamped with its
+    source's mtime, and is rebuilt once the source's mtime changes."""
+
+    def __init__(self, directory: pathlib.Path = CACHE_DIR) -> None:
+        self.directory = directory
+        self.building: dict[pathlib.Path, threading.Lock] = {}
+        self.pending: set[pathlib.Path] = set()
+        self.lock = threading.Lock()
+        self.builders = WorkerPool(BUILD_WORKERS)
+
+    def variant_path(self, source: pathlib.Path, encoding: Encoding) -> pathlib.Path:
+        key = hashlib.sha1(str(source.resolve()).encode()).hexdigest()
+        return self.directory.joinpath(key + SUFFIXES[encoding])
+
+    def get(self, source: pathlib.Path, encoding: Encoding) -> Optional[pathlib.Path]:
+        """The path of source compressed with encoding, or None if compressing doesn't
+        make it any smaller."""
+        stat = source.stat()
+        path = self.variant_path(source, encoding)
+
+        if (variant := self.fresh(path, stat)) is None:
+            with self.lock:
+                lock = self.building.setdefault(path, threading.Lock())
+
+            with lock:
+                if (variant := self.fresh(path, stat)) is None:
+                    variant = self.build(source, encoding, path, stat)
+
+        return path if variant.st_size < stat.st_size else None
+
+    def ready(self, source: pathlib.Path, encoding: Encoding) -> bool:
+        """Whether source's variant is built, and fresh. If not, it's built in the
+        background, so that a cold cache doesn't hold up the request asking."""
+        path = self.variant_path(source, encoding)
+        if self.fresh(path, source.stat()) is not None:
+            return True
+
+        with self.lock:
+            if path not in self.pending:
+                self.pending.add(path)
+                self.builders.submit(self.prepare, source, encoding, path)
+
+        return False
+
+    def prepare(
+        self, source: pathlib.Path, encoding: Encoding, path: pathlib.Path
+    ) -> None:
+        try:
+            self.get(source, encoding)
+        except OSError as e:
+            print("Encoding: ", e, file=sys.stderr)
+        finally:
+            with self.lock:
+                self.pending.discard(path)
+
+    @staticmethod
+    def fresh(path: pathlib.Path, stat: os.stat_result) -> Optional[os.stat_result]:
+        try:
+            variant = path.stat()
+        except FileNotFoundError:
+            return None
+
+        return variant if variant.st_mtime_ns == stat.st_mtime_ns else None
+
+    def build(
+        self,
+        source: pathlib.Path,
+        encoding: Encoding,
+        path: pathlib.Path,
+        stat: os.stat_result,
+    ) -> os.stat_result:
+        """Compresses source into a temporary file, then moves it into place, so
+        readers only ever see whole variants."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        c = compressor(encoding)
+
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as out, source.open("rb") as file:
+                while chunk := file.read(FILE_CHUNK_SIZE):
+                    out.write(c.compress(chunk))
+                out.write(c.flush())
+
+            # Stamped with the mtime seen before reading; if the source changed since,
+            # the next request sees the mismatch, and rebuilds.
+            os.utime(temp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        return path.stat()
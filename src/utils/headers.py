@@ -0,0 +1,46 @@
+from typing import *
+
+
+class Headers(dict):
+    """A dict of header values keyed case-insensitively, as HTTP headers are. Keys
+    keep the case they were first given in."""
+
+    def __init__(self, items: Iterable[tuple[str, str]] | Mapping[str, str] = ()):
+        super().__init__()
+        self.names: dict[str, str] = {}
+        if items:
+            self.update(items)
+
+    def __setitem__(self, key: str, value: str) -> None:
+        name = self.names.setdefault(key.lower(), key)
+        super().__setitem__(name, value)
+
+    def __getitem__(self, key: str) -> str:
+        return super().__getitem__(self.names[key.lower()])
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(self.names.pop(key.lower()))
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and key.lower() in self.names
+
+    def get(self, key: str, default: Any = None) -> str | Any:
+        if (name := self.names.get(key.lower())) is None:
+            return default
+        return super().__getitem__(name)
+
+    def pop(self, key: str, *default: Any) -> str | Any:
+        if (name := self.names.pop(key.lower(), None)) is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return super().pop(name)
+
+    def update(self, items: Iterable[tuple[str, str]] | Mapping[str, str] = ()) -> None:
+        if hasattr(items, "items"):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    def __str__(self) -> str:
+        return "".join(f"{k}: {v}\n" for k, v in self.items()) + "\n"
@@ -1,73 +1,221 @@
+import asyncio
 import datetime
-import http
-import http.client
-import http.server
+import logging
+import os
+import pathlib
 import platform
 import socket
 import time
-from enum import Enum
-from functools import wraps
-from io import BytesIO
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from enum import Enum, auto
+from functools import cache, lru_cache, wraps
 from typing import *
 
-from src.utils.utils import recv_message, send_message
+from src.utils.binary import (
+    FIXED_HEADER,
+    PHRASES,
+    BinaryMessage,
+    Unencodable,
+    encode_head,
+    encode_request,
+    encode_response,
+    is_binary,
+)
+from src.utils.encoding import DecodingWriter, Encoding, content_encoding, decode
+from src.utils.headers import Headers
+from src.utils.utils import (
+    CHUNK_SIZE,
+    HEADER_SIZE,
+    async_send_file,
+    async_send_message,
+    recv_exactly,
+    recv_header,
+    recv_into_file,
+    recv_message,
+    encode_header,
+    send_file,
+    send_message,
+)
 
 HTTP_VERSION = "HTTP/1.1"
 
 SUCCESS_CODE = 200
+PARTIAL_CODE = 206
 FAIL_CODE = 403
 
 TIME_FMT = "%a, %d %b %Y %H:%M:%S"
 
+# Sent with every request; worked out once, rather than per request.
+STATIC_REQUEST_HEADERS = {
+    "Host": socket.gethostname(),
+    "OS": f"{platform.system()} {platform.release()}",
+}
 
-class _FakeSocket(socket.socket):
-    def __init__(self, response: bytes):
-        self._file = BytesIO(response)
+logger = logging.getLogger(__name__)
 
-    def makefile(self, *args, **kwargs):
-        return self._file
+ACCEPT_PROTOCOL = "Accept-Protocol"
+PROTOCOL_HEADER = "Protocol"
 
 
-class HTTPResponse(http.client.HTTPResponse):
-    def __init__(self, response: bytes):
-        super().__init__(_FakeSocket(response))
-        self.content = b""
+class Protocol(Enum):
+    """How messages are encoded. A client that does not yet know what the other end
+    speaks is negotiating: it sends pseudo-HTTP, offering the binary protocol."""
+
+    text = auto()
+    binary = auto()
+    negotiating = auto()
+
+
+# The encoding make_request, make_response and FileResponse use. Every connection
+# handler runs in its own context, so setting it affects that connection only.
+PROTOCOL: ContextVar[Protocol] = ContextVar("protocol", default=Protocol.text)
+
+
+@contextmanager
+def use_protocol(protocol: Protocol):
+    token = PROTOCOL.set(protocol)
+    try:
+        yield
+    finally:
+        PROTOCOL.reset(token)
+
+
+class HTTPMessage:
+    """A parsed pseudo-HTTP message. Only the head is parsed up front; the body is
+    copied out of the message the first time it is read. content is the body with
+    any Content-Encoding undone."""
+
+    def __init__(self, message: bytes) -> None:
+        self.message = message
 
-        self.begin()
+        if (line_end := message.find(b"\r\n")) == -1:
+            line_end = len(message)
 
-        if (length := self.getheader("Content-Length")) is not None:
-            self.content = self.read(len(response))
+        if (head_end := message.find(b"\r\n\r\n", line_end)) == -1:
+            head_end = self.body_start = len(message)
+        else:
+            self.body_start = head_end + 4
+
+        view = memoryview(message)
+        self.start_line = str(view[:line_end], "utf-8")
+        self.headers = parse_headers(view[line_end + 2 : head_end])
+
+        length = self.headers.get("Content-Length")
+        self.body_end = (
+            len(message) if length is None else self.body_start + int(length)
+        )
+        self._content: Optional[bytes] = None
+
+    @property
+    def body(self) -> bytes:
+        return bytes(memoryview(self.message)[self.body_start : self.body_end])
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = decode(self.body, content_encoding(self.headers))
+        return self._content
+
+    def getheader(self, name: str, default: Any = None) -> str | Any:
+        return self.headers.get(name, default)
+
+
+class HTTPResponse(HTTPMessage):
+    def __init__(self, response: bytes):
+        super().__init__(response)
+
+        self.version, status, *reason = self.start_line.split(" ", 2)
+        self.status = int(status)
+        self.reason = reason[0] if reason else ""
 
     def __str__(self) -> str:
         return f"""{self.version} {self.status} {self.reason}
 {self.headers}"""
 
 
-class HTTPRequest(http.server.BaseHTTPRequestHandler):
+class HTTPRequest(HTTPMessage):
     def __init__(self, request: bytes):
-        self.rfile = BytesIO(request)
-        self.raw_requestline = self.rfile.readline()
-        self.error_code = self.error_message = None
-        self.parse_request()
-        self.content = self.rfile.read()
-        self.rfile.seek(0)
+        super().__init__(request)
+
+        self.command, self.path, self.request_version = self.start_line.split(" ", 2)
 
     def __str__(self) -> str:
-        return f"""{self.command} {self.path} {self.protocol_version}
+        return f"""{self.command} {self.path} {self.request_version}
 {self.headers}"""
 
 
+def parse_headers(block: memoryview) -> Headers:
+    """Parses a block of CRLF separated "Key: Value" lines."""
+    headers = Headers()
+
+    for line in str(block, "utf-8").split("\r\n"):
+        key, sep, value = line.partition(":")
+        if sep:
+            headers[key.strip()] = value.strip()
+
+    return headers
+
+
+def parse_request(message: bytes) -> HTTPRequest | BinaryMessage:
+    """Parses a request in either encoding."""
+    return BinaryMessage(message) if is_binary(message) else HTTPRequest(message)
+
+
+def _parse_response(message: bytes) -> HTTPResponse | BinaryMessage:
+    return BinaryMessage(message) if is_binary(message) else HTTPResponse(message)
+
+
+def parse_response(message: bytes) -> HTTPResponse | BinaryMessage:
+    """Parses a received response in either encoding. While negotiating, the first
+    response settles the protocol for the rest of the context."""
+    response = _parse_response(message)
+
+    if PROTOCOL.get() is Protocol.negotiating:
+        PROTOCOL.set(negotiated(response))
+
+    return response
+
+
+def negotiate(request: HTTPRequest | BinaryMessage) -> dict[str, str]:
+    """Answers in the protocol request was sent in. Returns the headers to add to
+    the response: a text request offering the binary protocol is told it may use it."""
+    if isinstance(request, BinaryMessage):
+        PROTOCOL.set(Protocol.binary)
+        return {}
+
+    PROTOCOL.set(Protocol.text)
+
+    if Protocol.binary.name in request.headers.get(ACCEPT_PROTOCOL, ""):
+        return {PROTOCOL_HEADER: Protocol.binary.name}
+
+    return {}
+
+
+def negotiated(response: HTTPResponse | BinaryMessage) -> Protocol:
+    """The protocol to use from now on, given a response to a negotiating request.
+    Servers that don't know of the binary protocol ignore the offer."""
+    if isinstance(response, BinaryMessage):
+        return Protocol.binary
+    if response.getheader(PROTOCOL_HEADER) == Protocol.binary.name:
+        return Protocol.binary
+    return Protocol.text
+
+
+@cache
 def create_status_line(status_code: int = 200) -> bytes:
-    code_phrase = http.HTTPStatus(status_code).phrase
+    code_phrase = PHRASES.get(status_code, "")
     return f"{HTTP_VERSION} {status_code} {code_phrase}".encode()
 
 
+@lru_cache(maxsize=1)
+def format_date(timestamp: int) -> str:
+    return time.strftime(TIME_FMT, time.gmtime(timestamp)) + "GMT"
+
+
 def get_default_request_headers() -> dict[str, str]:
-    return {
-        "Host": socket.gethostname(),
-        "OS": f"{platform.system()} {platform.release()}",
-        "Date": time.strftime(TIME_FMT, time.gmtime()) + "GMT",
-    }
+    return STATIC_REQUEST_HEADERS | {"Date": format_date(int(time.time()))}
 
 
 def format_headers(headers: dict[str, str]) -> bytes:
@@ -103,6 +251,10 @@ def make_response(
     headers: Optional[dict[str, str]] = None,
     body: str | bytes = "",
 ) -> bytes:
+    if PROTOCOL.get() is Protocol.binary:
+        with suppress(Unencodable):
+            return encode_response(status_code, headers, body)
+
     start_line = create_status_line(status_code)
     return _make_response(start_line, headers, body)
 
@@ -116,18 +268,222 @@ def make_request(
     if headers is None:
         headers = {}
 
+    match PROTOCOL.get():
+        case Protocol.binary:
+            with suppress(Unencodable):
+                return encode_request(method, url, headers, body)
+        case Protocol.negotiating:
+            headers[ACCEPT_PROTOCOL] = Protocol.binary.name
+
     headers |= get_default_request_headers()
 
     start_line = f"{method} {url} {HTTP_VERSION}".encode()
     return _make_response(start_line, headers, body)
 
 
+def parse_range(value: str, size: int) -> Optional[tuple[int, int]]:
+    """Resolves a single "bytes=start-end" (or "bytes=start-", or "bytes=-suffix")
+    Range header against a body of size bytes, into an inclusive (start, end) pair.
+    Returns None if the range is malformed or unsatisfiable."""
+    unit, _, spec = value.strip().partition("=")
+    start, sep, end = spec.strip().partition("-")
+
+    if unit.strip().lower() != "bytes" or not sep:
+        return None
+
+    try:
+        if start == "":
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start = int(start)
+            end = size - 1 if end == "" else min(int(end), size - 1)
+    except ValueError:
+        return None
+
+    if start < 0 or start > end:
+        return None
+
+    return start, end
+
+
+@dataclass
+class FileResponse:
+    """A response whose body is streamed from a file on disk, rather than held in
+    memory. On the wire it is identical to the equivalent make_response output, in
+    the protocol of the connection it is sent on. If a byte_range is given, only that
+    inclusive span of the file is sent, as a 206 response."""
+
+    path: pathlib.Path
+    status_code: int = SUCCESS_CODE
+    headers: Optional[dict[str, str]] = None
+    byte_range: Optional[tuple[int, int]] = None
+
+    def span(self, size: int) -> tuple[bytes, int, int]:
+        """The response head, and the offset and length of the file to send after it,
+        given the file is size bytes long."""
+        headers = dict(self.headers or {})
+        status_code, offset, count = self.status_code, 0, size
+
+        if self.byte_range is not None:
+            start, end = self.byte_range
+            end = min(end, size - 1)
+            status_code, offset, count = PARTIAL_CODE, start, max(0, end - start + 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        if PROTOCOL.get() is Protocol.binary:
+            with suppress(Unencodable):
+                head = encode_head(0, status_code, "", headers, count, True)
+                return head, offset, count
+
+        headers["Content-Length"] = str(count)
+
+        start_line = create_status_line(status_code)
+        head = b"\r\n".join([start_line, format_headers(headers), b"", b""])
+
+        return head, offset, count
+
+
+@dataclass(frozen=True)
+class FramedResponse:
+    """One or more responses, made and framed ahead of time, so they go out in a
+    single write. ends holds the offset each framed message ends at, so that the
+    messages can be taken apart again."""
+
+    data: bytes
+    ends: tuple[int, ...]
+
+    def messages(self) -> Iterator[bytes]:
+        start = 0
+        for end in self.ends:
+            yield self.data[start + HEADER_SIZE : end]
+            start = end
+
+
+Response = bytes | FileResponse | FramedResponse
+
+
+def read_response(response: Response) -> bytes:
+    """The message a response is sent as, read into memory."""
+    match response:
+        case FileResponse(path=path):
+            with path.open("rb") as file:
+                head, offset, count = response.span(os.fstat(file.fileno()).st_size)
+                file.seek(offset)
+                return head + file.read(count)
+        case _:
+            return response
+
+
+def frame(responses: list[Response]) -> FramedResponse:
+    """Joins responses into one FramedResponse, in the current protocol."""
+    parts, ends, end = [], [], 0
+
+    for response in responses:
+        if isinstance(response, FramedResponse):
+            messages = list(response.messages())
+        else:
+            messages = [read_response(response)]
+
+        for message in messages:
+            parts += [encode_header(len(message)), message]
+            end += HEADER_SIZE + len(message)
+            ends.append(end)
+
+    return FramedResponse(b"".join(parts), tuple(ends))
+
+
+def with_headers(response: Response, headers: dict[str, str]) -> Response:
+    """Adds headers to an already made response."""
+    if not headers:
+        return response
+
+    match response:
+        case FramedResponse():
+            return frame([with_headers(m, headers) for m in response.messages()])
+        case FileResponse():
+            return replace(response, headers=(response.headers or {}) | headers)
+        case _ if is_binary(response):
+            message = BinaryMessage(response)
+            message.headers.update(headers)
+            with use_protocol(Protocol.binary):
+                return make_response(message.status, message.headers, message.body)
+        case _:
+            # Every response has at least its status line terminated by a CRLF.
+            end = response.find(b"\r\n") + 2
+            return b"".join(
+                [response[:end], format_headers(headers), b"\r\n", response[end:]]
+            )
+
+
+def send_response(response: Response, peer_socket: socket.socket) -> int:
+    match response:
+        case FileResponse(path=path):
+            with path.open("rb") as file:
+                head, offset, count = response.span(os.fstat(file.fileno()).st_size)
+                return send_file(head, file, count, peer_socket, offset=offset)
+        case FramedResponse(data=data):
+            peer_socket.sendall(data)
+            return len(data)
+        case _:
+            return send_message(response, peer_socket)
+
+
+async def async_send_response(response: Response, writer: asyncio.StreamWriter) -> int:
+    match response:
+        case FileResponse(path=path):
+            with path.open("rb") as file:
+                head, offset, count = response.span(os.fstat(file.fileno()).st_size)
+                return await async_send_file(head, file, count, writer, offset=offset)
+        case FramedResponse(data=data):
+            writer.write(data)
+            await writer.drain()
+            return len(data)
+        case _:
+            return await async_send_message(response, writer)
+
+
+def recv_file_response(
+    peer_socket: socket.socket, file: BinaryIO
+) -> HTTPResponse | BinaryMessage:
+    """Receives a response, writing its body into file as it arrives, decoded. Only
+    the response head is ever buffered in memory."""
+    if (message_len := recv_header(peer_socket)) is None:
+        raise ConnectionError("Connection closed before response")
+
+    head = bytes(recv_exactly(peer_socket, min(FIXED_HEADER.size, message_len)))
+
+    if is_binary(head):
+        *_, meta_length, _ = FIXED_HEADER.unpack(head)
+        head += recv_exactly(peer_socket, meta_length)
+        response, body = BinaryMessage(head, head_only=True), b""
+    else:
+        while (end := head.find(b"\r\n\r\n")) == -1 and len(head) < message_len:
+            head += recv_exactly(peer_socket, min(CHUNK_SIZE, message_len - len(head)))
+
+        if end == -1:
+            return parse_response(head)
+
+        response, body = HTTPResponse(head[: end + 4]), head[end + 4 :]
+
+    # An encoded body is decompressed as it arrives.
+    if (encoding := content_encoding(response.headers)) is not Encoding.identity:
+        file = DecodingWriter(file, encoding)
+
+    file.write(body)
+    recv_into_file(peer_socket, file, message_len - len(head))
+
+    if isinstance(file, DecodingWriter):
+        file.finish()
+
+    return response
+
+
 def send_recv_http_request(
     request: bytes, server_socket: socket.socket
-) -> HTTPResponse:
+) -> HTTPResponse | BinaryMessage:
     send_message(request, server_socket)
     response = recv_message(server_socket)
-    return HTTPResponse(response)
+    return parse_response(response)
 
 
 HTTPRequestReturn = tuple[str, str] | tuple[str, str, dict] | tuple[str, str, dict, str]
@@ -138,7 +494,8 @@ HTTPResponseReturn = tuple[int] | tuple[int, dict] | tuple[int, dict, str]
 def http_request(func: Callable[..., HTTPRequestReturn]):
     """Decorator that allows for a HTTP request to be returned in a Flask-like manner.
     The first item returned must be the request method, then the URL path.
-    Optional headers and body content may also be returned."""
+    Optional headers and body content may also be returned. Requests are echoed at
+    DEBUG level."""
 
     @wraps(func)
     def wrapper(*args, **kwargs) -> HTTPRequest:
@@ -151,8 +508,8 @@ def http_request(func: Callable[..., HTTPRequestReturn]):
 
         request = make_request(method=method, url=url, headers=headers, body=body)
 
-        r = HTTPRequest(bytes(request))
-        print(r)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(parse_request(request))
 
         return request
 
@@ -162,7 +519,8 @@ def http_request(func: Callable[..., HTTPRequestReturn]):
 def http_response(func: Callable[..., HTTPResponseReturn]):
     """Decorator that allows for a HTTP response to be returned in a Flask-like manner.
     The first item returned must be the integer status code
-    Optional headers and body content may also be returned."""
+    Optional headers and body content may also be returned. Responses are echoed at
+    DEBUG level."""
 
     @wraps(func)
     def wrapper(*args, **kwargs) -> bytes:
@@ -172,8 +530,9 @@ def http_response(func: Callable[..., HTTPResponseReturn]):
 
         response = make_response(status_code=status_code, headers=headers, body=body)
 
-        r = HTTPResponse(bytes(response))
-        print(r)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Echoed without negotiating: logging mustn't change the protocol.
+            logger.debug(_parse_response(response))
 
         return response
 
@@ -0,0 +1,271 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import *
+
+# Latency histogram bucket upper bounds, in seconds: 50us doubling up to ~6.5s.
+BUCKETS = tuple(5e-5 * 2**i for i in range(18))
+QUANTILES = (0.5, 0.95, 0.99)
+
+PROMETHEUS_TYPE = "text/plain; version=0.0.4"
+JSON_TYPE = "application/json"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: int | float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self) -> int | float:
+        return self.value
+
+
+class Gauge(Counter):
+    def dec(self, amount: int | float = 1) -> None:
+        self.inc(-amount)
+
+    def set(self, value: int | float) -> None:
+        self.value = value
+
+
+class Histogram:
+    """Counts of observations falling into each of a fixed set of buckets, from which
+    quantiles are estimated, as Prometheus does; observing is O(log buckets), in
+    constant memory."""
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS) -> None:
+        self.buckets = buckets
+        # One more count than buckets, for observations beyond the last.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Interpolates within the bucket holding the q-th observation."""
+        with self.lock:
+            counts, count = list(self.counts), self.count
+
+        if count == 0:
+            return 0.0
+
+        rank, seen = q * count, 0
+        for i, n in enumerate(counts):
+            if n > 0 and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+
+        return self.buckets[-1]
+
+    def snapshot(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            **{f"p{round(q * 100)}": self.quantile(q) for q in QUANTILES},
+        }
+
+
+Metric = Counter | Gauge | Histogram
+
+KINDS: dict[type, str] = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}
+
+
+def format_labels(labels: Labels, **extra: str) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metrics:
+    """A registry of metrics, each identified by a name and a set of labels. Metrics
+    are created on first use; the hot path is a dict lookup and a short lock. Values
+    that already live elsewhere (e.g. an index's size) are read through collectors, at
+    snapshot time, so cost nothing until asked for."""
+
+    def __init__(self) -> None:
+        self.metrics: dict[tuple[str, Labels], Metric] = {}
+        self.kinds: dict[str, type] = {}
+        self.help: dict[str, str] = {}
+        self.collectors: dict[str, Callable[[], int | float]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind: type, name: str, help: str = "", **labels: Any) -> Metric:
+        key = (name, tuple(labels.items()))
+
+        if (metric := self.metrics.get(key)) is None:
+            with self.lock:
+                if (metric := self.metrics.get(key)) is None:
+                    if self.kinds.setdefault(name, kind) is not kind:
+                        raise ValueError(
+                            f"{name} is already a {KINDS[self.kinds[name]]}"
+                        )
+                    if help:
+                        self.help[name] = help
+                    metric = self.metrics[key] = kind()
+
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels: Any) -> Counter:
+        return self.get(Counter, name, help, **labels)
+
+    def gauge(self, name: str, help: str = "", **labels: Any) -> Gauge:
+        return self.get(Gauge, name, help, **labels)
+
+    def histogram(self, name: str, help: str = "", **labels: Any) -> Histogram:
+        return self.get(Histogram, name, help, **labels)
+
+    def collect(
+        self,
+        name: str,
+        read: Callable[[], int | float],
+        help: str = "",
+        kind: type = Gauge,
+    ) -> None:
+        """Registers a metric whose value is read when a snapshot is taken."""
+        with self.lock:
+            self.collectors[name] = read
+            self.kinds[name] = kind
+            if help:
+                self.help[name] = help
+
+    def timed(self, name: str, help: str = "", **labels: Any):
+        """Decorator observing every call's duration, in seconds, into a histogram."""
+
+        def decorator(func: Callable[..., Any]):
+            histogram = self.histogram(name, help, **labels)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    def items(self) -> list[tuple[str, Labels, Metric | int | float]]:
+        with self.lock:
+            items = [(name, labels, m) for (name, labels), m in self.metrics.items()]
+            collectors = list(self.collectors.items())
+
+        items += [(name, (), read()) for name, read in collectors]
+        return sorted(items, key=lambda item: item[:2])
+
+    def snapshot(self) -> dict[str, Any]:
+        """Every metric's current value, keyed by name, then by its labels (as
+        "key=value,..."); histograms are summarised by their count, sum and
+        quantiles."""
+        snapshot: dict[str, dict[str, Any]] = {}
+
+        for name, labels, metric in self.items():
+            value = metric if isinstance(metric, (int, float)) else metric.snapshot()
+            key = ",".join(f"{k}={v}" for k, v in labels)
+            snapshot.setdefault(name, {})[key] = value
+
+        return snapshot
+
+    def prometheus(self) -> str:
+        """A snapshot in the Prometheus text exposition format."""
+        lines, described = [], set()
+
+        for name, labels, metric in self.items():
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {KINDS[self.kinds[name]]}")
+
+            match metric:
+                case Histogram():
+                    with metric.lock:
+                        counts, total, count = (
+                            list(metric.counts),
+                            metric.sum,
+                            metric.count,
+                        )
+
+                    cumulative = 0
+                    bounds = [*map(repr, metric.buckets), "+Inf"]
+                    for bound, n in zip(bounds, counts):
+                        cumulative += n
+                        lines.append(
+                            f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+                case Counter():
+                    lines.append(f"{name}{format_labels(labels)} {metric.value}")
+                case _:
+                    lines.append(f"{name}{format_labels(labels)} {metric}")
+
+        return "\n".join(lines) + "\n"
+
+    def render(self, accept: Optional[str]) -> tuple[str, str]:
+        """The snapshot body, and its content type: Prometheus text if accept asks for
+        plain text, JSON otherwise."""
+        if accept is not None and "text/plain" in accept:
+            return PROMETHEUS_TYPE, self.prometheus()
+        return JSON_TYPE, json.dumps(self.snapshot())
+
+
+class ServerMetrics(Metrics):
+    """A server's metrics, including those of the requests it handles: per command
+    counts and latencies, bytes in and out, and connections open."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.received = self.counter(
+            "p2pdi_received_bytes_total", "Request bytes received"
+        )
+        self.sent = self.counter("p2pdi_sent_bytes_total", "Response bytes sent")
+        self.connections = self.gauge("p2pdi_active_connections", "Connections open")
+        self.commands: dict[str, tuple[Counter, Histogram]] = {}
+
+    def observe_request(
+        self, command: str, seconds: float, received: int, sent: int
+    ) -> None:
+        """Records a handled request: how long it took to handle and answer, and the
+        bytes it and its responses took up."""
+        if (metrics := self.commands.get(command)) is None:
+            metrics = self.commands[command] = (
+                self.counter(
+                    "p2pdi_requests_total", "Requests handled", command=command
+                ),
+                self.histogram(
+                    "p2pdi_request_duration_seconds",
+                    "Time from receiving a request to sending its last response",
+                    command=command,
+                ),
+            )
+
+        requests, duration = metrics
+        requests.inc()
+        duration.observe(seconds)
+        self.received.inc(received)
+        self.sent.inc(sent)
+
+
+# Process-wide registry, for code not tied to any one server, such as the client.
+METRICS = Metrics()
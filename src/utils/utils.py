@@ -1,67 +1,222 @@
-from datetime import datetime
-from functools import wraps
+import asyncio
 import socket
+import struct
+from enum import Enum, auto
 from typing import *
 
 HEADER_SIZE = 10
 CHUNK_SIZE = 1024
+FILE_CHUNK_SIZE = 1 << 16
+# Below this size, the header and payload are joined and sent with one write; above
+# it, they're handed to the kernel as separate buffers to avoid the copy.
+COALESCE_SIZE = 1 << 16
 
 
-def parse_message(message: bytes, header_size: int = HEADER_SIZE) -> tuple[int, bytes]:
-    if len(message) == 0:
-        return 0, message
-    else:
-        message_length = int(message[:header_size].decode())
-        data = message[header_size:]
-        return message_length, data
+class Framing(Enum):
+    """Length prefix formats: text is a space-padded, HEADER_SIZE-byte long ASCII
+    decimal (the original format); binary is a fixed 8-byte big-endian integer."""
+
+    text = auto()
+    binary = auto()
+
+
+BINARY_HEADER = struct.Struct("!Q")
+
+
+def header_length(
+    framing: Framing = Framing.text, header_size: int = HEADER_SIZE
+) -> int:
+    return header_size if framing is Framing.text else BINARY_HEADER.size
+
+
+def encode_header(
+    length: int, framing: Framing = Framing.text, header_size: int = HEADER_SIZE
+) -> bytes:
+    match framing:
+        case Framing.text:
+            return f"{length:<{header_size}}".encode()
+        case Framing.binary:
+            return BINARY_HEADER.pack(length)
+
+
+def decode_header(header: bytes, framing: Framing = Framing.text) -> int:
+    match framing:
+        case Framing.text:
+            return int(bytes(header).decode())
+        case Framing.binary:
+            return BINARY_HEADER.unpack(header)[0]
+
+
+def recv_into(peer_socket: socket.socket, view: memoryview) -> int:
+    """Fills view entirely, however many reads that takes. Returns 0 if the
+    connection was closed before any byte arrived."""
+    size = len(view)
+
+    while len(view) > 0:
+        if (n := peer_socket.recv_into(view)) == 0:
+            if len(view) == size:
+                return 0
+            raise ConnectionError("Connection closed mid-message")
+        view = view[n:]
+
+    return size
+
+
+def recv_exactly(peer_socket: socket.socket, size: int) -> bytearray:
+    buffer = bytearray(size)
+
+    if recv_into(peer_socket, memoryview(buffer)) != size and size > 0:
+        raise ConnectionError("Connection closed mid-message")
+
+    return buffer
+
+
+def recv_header(
+    peer_socket: socket.socket,
+    framing: Framing = Framing.text,
+    header_size: int = HEADER_SIZE,
+) -> Optional[int]:
+    """Reads a length prefix, returning None if the peer closed the connection."""
+    header = bytearray(header_length(framing, header_size))
+
+    if recv_into(peer_socket, memoryview(header)) == 0:
+        return None
+
+    return decode_header(header, framing)
 
 
 def recv_message(
     peer_socket: socket.socket,
     header_size: int = HEADER_SIZE,
-    chunk_size: int = CHUNK_SIZE,
-) -> bytes:
-    message = b""
-    t_message = peer_socket.recv(header_size)
-    message_len, _ = parse_message(t_message, header_size)
+    framing: Framing = Framing.text,
+) -> bytearray:
+    """Receives one length-prefixed message. The buffer is allocated once from the
+    declared length and filled in place, so cost is linear in the message size. An
+    empty message means the peer closed the connection."""
+    if (message_len := recv_header(peer_socket, framing, header_size)) is None:
+        return bytearray()
 
-    while message_len > 0:
-        chunk_size = min(chunk_size, message_len)
+    return recv_exactly(peer_socket, message_len)
 
-        response = peer_socket.recv(chunk_size)
-        message += response
 
-        message_len -= chunk_size
+def sendall_buffers(peer_socket: socket.socket, buffers: list[bytes]) -> int:
+    """Writes every buffer, in order, with scatter-gather sends; short writes are
+    resumed from wherever the kernel stopped."""
+    views = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+    total = sum(len(view) for view in views)
 
-    return message
+    if not hasattr(peer_socket, "sendmsg"):
+        for view in views:
+            peer_socket.sendall(view)
+        return total
+
+    while views:
+        sent = peer_socket.sendmsg(views)
+
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent > 0:
+            views[0] = views[0][sent:]
+
+    return total
 
 
 def send_message(
-    data: bytes, peer_socket: socket.socket, header_size: int = HEADER_SIZE
+    data: bytes,
+    peer_socket: socket.socket,
+    header_size: int = HEADER_SIZE,
+    framing: Framing = Framing.text,
+) -> int:
+    header = encode_header(len(data), framing, header_size)
+
+    if len(data) < COALESCE_SIZE:
+        message = header + data
+        peer_socket.sendall(message)
+        return len(message)
+    else:
+        return sendall_buffers(peer_socket, [header, data])
+
+
+def recv_into_file(
+    peer_socket: socket.socket,
+    file: BinaryIO,
+    size: int,
+    chunk_size: int = FILE_CHUNK_SIZE,
+) -> int:
+    """Copies the next size bytes of the socket into file, through a single reused
+    chunk-sized buffer."""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    remaining = size
+
+    while remaining > 0:
+        if (n := peer_socket.recv_into(view, min(chunk_size, remaining))) == 0:
+            raise ConnectionError("Connection closed mid-transfer")
+        file.write(view[:n])
+        remaining -= n
+
+    return size
+
+
+def send_file(
+    header: bytes,
+    file: BinaryIO,
+    size: int,
+    peer_socket: socket.socket,
+    header_size: int = HEADER_SIZE,
+    framing: Framing = Framing.text,
+    offset: int = 0,
 ) -> int:
-    header = f"{len(data):<{header_size}}"
-    message = header.encode() + data
-    return peer_socket.send(message)
+    """Sends a single message made up of header followed by size bytes of file,
+    starting at offset. The file contents are handed to the kernel via sendfile,
+    never touching user space."""
+    prefix = encode_header(len(header) + size, framing, header_size)
+    peer_socket.sendall(prefix + header)
+    return len(prefix) + len(header) + peer_socket.sendfile(file, offset, size)
 
 
-def timethat(func: Callable[..., Any]):
-    total_time = 0
+async def async_recv_message(
+    reader: asyncio.StreamReader,
+    header_size: int = HEADER_SIZE,
+    framing: Framing = Framing.text,
+) -> bytes:
+    try:
+        header = await reader.readexactly(header_length(framing, header_size))
+        message_len = decode_header(header, framing)
 
-    @wraps(func)
-    def wrapper(*args, **kwargs) -> Any:
-        nonlocal total_time
-        start = datetime.now()
-        result = func(*args, **kwargs)
-        end = datetime.now()
+        return await reader.readexactly(message_len)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return b""
+        raise ConnectionError("Connection closed mid-message") from e
 
-        delta = (end - start).total_seconds() / 1000
-        total_time += delta
 
-        print(f"Timing for {func.__name__}")
-        print(f"Took {delta}ms!")
-        print(f"Total time: {total_time}")
-        print()
+async def async_send_message(
+    data: bytes,
+    writer: asyncio.StreamWriter,
+    header_size: int = HEADER_SIZE,
+    framing: Framing = Framing.text,
+) -> int:
+    header = encode_header(len(data), framing, header_size)
+    writer.writelines([header, data])
+    await writer.drain()
+    return len(header) + len(data)
+
+
+async def async_send_file(
+    header: bytes,
+    file: BinaryIO,
+    size: int,
+    writer: asyncio.StreamWriter,
+    header_size: int = HEADER_SIZE,
+    framing: Framing = Framing.text,
+    offset: int = 0,
+) -> int:
+    prefix = encode_header(len(header) + size, framing, header_size)
+    writer.write(prefix + header)
+    await writer.drain()
 
-        return result
+    loop = asyncio.get_running_loop()
+    sent = await loop.sendfile(writer.transport, file, offset, size)
 
-    return wrapper
+    return len(prefix) + len(header) + sent
@@ -0,0 +1,62 @@
+import asyncio
+import queue
+import sys
+import threading
+from typing import *
+
+# Background work runs in daemon threads of our own, rather than through
+# concurrent.futures: executors refuse new work once the main thread has finished,
+# and src.peer's main thread returns as soon as it has started its peers, which then
+# carry on serving from threads of their own.
+
+T = TypeVar("T")
+
+
+def spawn(target: Callable[..., Any], *args: Any) -> threading.Thread:
+    """Runs target(*args) in a daemon thread of its own, returning the thread."""
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class WorkerPool:
+    """A fixed number of long-lived daemon threads, taking work from a queue in turn."""
+
+    def __init__(self, workers: int) -> None:
+        self.tasks: queue.SimpleQueue = queue.SimpleQueue()
+        self.threads = [spawn(self.work) for _ in range(workers)]
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        """Queues fn(*args), to run on the first free worker."""
+        self.tasks.put((fn, args))
+
+    def work(self) -> None:
+        while True:
+            fn, args = self.tasks.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print("Worker: ", e, file=sys.stderr)
+
+    async def call(self, fn: Callable[[], T]) -> T:
+        """Awaits fn, run on a worker, from an event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def settle(result: Any, error: Optional[BaseException]) -> None:
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def run() -> None:
+            try:
+                result, error = fn(), None
+            except BaseException as e:
+                result, error = None, e
+            loop.call_soon_threadsafe(settle, result, error)
+
+        self.submit(run)
+        return await future